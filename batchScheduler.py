@@ -0,0 +1,225 @@
+"""
+Scheduler running extractions of a batch in separate worker processes with
+per-file limits. Every extraction gets its own process, so an extraction
+that exceeds the wall-clock limit or whose resident memory (RSS) exceeds the
+memory limit is killed without affecting the others, and reported as an
+ERROR document, e.g.:
+  {"ERROR": "Extraction exceeded the time limit of 600 seconds", "FILE": "..."}
+
+Files are routed to one of two lanes by their (compressed) size on disk.
+Large files run in their own lane with its own worker slots, so a few big
+workbooks never hold up the small estimates queued behind them.
+
+Finished extractions are returned by "poll" as (key, status, output) tuples,
+where status is one of:
+- "DONE": output is the extractor's JSON document
+- "KILLED": a limit was exceeded, output is the ERROR document
+- "FAILED": the worker process died, output is the ERROR document
+
+"""
+
+from collections import deque
+from multiprocessing.connection import wait
+import json
+import multiprocessing
+import os
+import time
+
+from extractors import runExtraction
+from memoryProfile import residentMemory
+
+
+SMALL_LANE = "SMALL"
+LARGE_LANE = "LARGE"
+
+# Seconds between limit checks of running extractions
+CHECK_INTERVAL = 0.1
+
+
+def runJob(connection, extractorName, path):
+    """
+    Worker process entry point, sends the extractor output back to the scheduler.
+
+    """
+
+    try:
+        connection.send(("DONE", runExtraction(extractorName, path)))
+    except Exception as e:
+        connection.send(("FAILED", str(e)))
+    finally:
+        connection.close()
+
+
+class BatchScheduler:
+    timeLimit = 600.0
+    memoryLimit = 2048
+    largeFileSize = 5
+    # Worker slots of each lane
+    slots = {SMALL_LANE: 2, LARGE_LANE: 1}
+
+    def __init__(self, workers=2, largeWorkers=1, timeLimit=600.0, memoryLimit=2048,
+                 largeFileSize=5):
+        self.slots = {SMALL_LANE: workers, LARGE_LANE: largeWorkers}
+        # Limits and sizes in seconds and megabytes, 0 disables a limit
+        self.timeLimit = timeLimit
+        self.memoryLimit = memoryLimit
+        self.largeFileSize = largeFileSize
+
+        # Jobs waiting for a free slot, per lane: (key, extractor name, path)
+        self.queued = {SMALL_LANE: deque(), LARGE_LANE: deque()}
+        # Running jobs: connection -> (key, path, lane, process, start time)
+        self.running = {}
+
+    def laneOf(self, path):
+        """
+        Returns the lane of supplied file, based on its size on disk.
+
+        """
+
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+        if(self.largeFileSize > 0 and size >= self.largeFileSize * 1024 * 1024):
+            return LARGE_LANE
+        return SMALL_LANE
+
+    def pending(self, lane=None):
+        """
+        Returns the number of queued and running jobs, of one lane or in total.
+
+        """
+
+        lanes = [lane] if lane is not None else list(self.queued)
+        running = sum(1 for job in self.running.values() if job[2] in lanes)
+        return running + sum(len(self.queued[name]) for name in lanes)
+
+    def accepting(self, lane, jobs=1):
+        """
+        Checks if supplied lane takes supplied number of jobs more, keeping at
+        most two jobs per slot queued or running so a bulk copy doesn't flood the
+        scheduler. An idle lane always takes them, however many there are.
+
+        """
+
+        pending = self.pending(lane)
+        return pending == 0 or pending + jobs <= self.slots[lane] * 2
+
+    def submit(self, key, extractorName, path, lane=None):
+        """
+        Queues an extraction of supplied file in its lane.
+
+        """
+
+        lane = lane or self.laneOf(path)
+        self.queued[lane].append((key, extractorName, path))
+        self.start()
+
+    def start(self):
+        """
+        Starts queued jobs in lanes with free slots.
+
+        """
+
+        for lane, queue in self.queued.items():
+            running = sum(1 for job in self.running.values() if job[2] == lane)
+            while(len(queue) > 0 and running < self.slots[lane]):
+                key, extractorName, path = queue.popleft()
+                receiver, sender = multiprocessing.Pipe(duplex=False)
+                process = multiprocessing.Process(target=runJob,
+                                                  args=(sender, extractorName, path),
+                                                  daemon=True)
+                process.start()
+                # Only the worker writes to the pipe
+                sender.close()
+                self.running[receiver] = (key, path, lane, process, time.monotonic())
+                running += 1
+
+    def poll(self, timeout):
+        """
+        Waits up to supplied timeout for running extractions, enforcing the
+        limits meanwhile. Returns the finished jobs as (key, status, output).
+
+        """
+
+        finished = []
+        deadline = time.monotonic() + timeout
+
+        while True:
+            if(len(self.running) > 0):
+                ready = wait(list(self.running), timeout=max(
+                    0, min(CHECK_INTERVAL, deadline - time.monotonic())))
+                for connection in ready:
+                    finished.append(self.receive(connection))
+                finished.extend(self.enforceLimits())
+                self.start()
+            else:
+                time.sleep(max(0, deadline - time.monotonic()))
+
+            if(len(finished) > 0 or time.monotonic() >= deadline):
+                return finished
+
+    def receive(self, connection):
+        """
+        Reads the result of a finished job and releases its process.
+
+        """
+
+        key, path, lane, process, startTime = self.running.pop(connection)
+        try:
+            status, output = connection.recv()
+        except EOFError:
+            process.join()
+            status, output = "FAILED", "Worker process exited with code {}".format(
+                process.exitcode)
+        connection.close()
+        process.join()
+
+        if(status == "FAILED"):
+            output = json.dumps({"ERROR": output, "FILE": path})
+        return key, status, output
+
+    def enforceLimits(self):
+        """
+        Kills running jobs over the time or memory limit and returns their
+        ERROR results.
+
+        """
+
+        killed = []
+        now = time.monotonic()
+
+        for connection, (key, path, lane, process, startTime) in list(self.running.items()):
+            error = None
+            if(self.timeLimit > 0 and now - startTime > self.timeLimit):
+                error = "Extraction exceeded the time limit of {:g} seconds".format(
+                    self.timeLimit)
+            elif(self.memoryLimit > 0):
+                memory = residentMemory(process.pid)
+                if(memory is not None and memory > self.memoryLimit * 1024 * 1024):
+                    error = "Extraction exceeded the memory limit of {:g} MB".format(
+                        self.memoryLimit)
+
+            if(error is not None):
+                process.kill()
+                process.join()
+                connection.close()
+                del self.running[connection]
+                killed.append((key, "KILLED", json.dumps(
+                    {"ERROR": error, "FILE": path})))
+
+        return killed
+
+    def shutdown(self):
+        """
+        Kills all running jobs and drops queued ones.
+
+        """
+
+        for connection, job in list(self.running.items()):
+            job[3].kill()
+            job[3].join()
+            connection.close()
+        self.running.clear()
+        for queue in self.queued.values():
+            queue.clear()
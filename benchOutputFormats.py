@@ -0,0 +1,120 @@
+"""
+Benchmark comparing the output encodings of the extraction scripts. Encodes
+the same document in every available format (see outputEncoding.py) and
+reports the encoded size and the best encode and decode times, one JSON line
+per format, e.g.:
+  {"FORMAT": "json", "BYTES": 26724998, "ENCODE SECONDS": 0.1522, "DECODE SECONDS": 0.0976}
+  {"FORMAT": "msgpack", "BYTES": 20525350, "ENCODE SECONDS": 0.0377, "DECODE SECONDS": 0.0897}
+
+The document is the materialLabour output of an estimate file, or synthetic
+cost code records shaped like it. Formats whose package isn't installed are
+reported as skipped.
+
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+
+from extractors import runExtraction
+from outputEncoding import OUTPUT_FORMATS, decodeDocument, encodeDocument, importEncoder
+
+
+def syntheticDocument(records, seed=0):
+    """
+    Returns a VALID document of supplied number of cost code records.
+
+    """
+
+    generator = random.Random(seed)
+    document = [{"DATA": "VALID"}]
+    for index in range(records):
+        qty = generator.randint(1, 500)
+        unitPrice = generator.randint(100, 500000) / 100
+        document.append({"CODE": "{:02d} {:02d} {:02d}".format(index % 100, index // 100 % 100, index % 7),
+                         "COST TYPE": "Labour" if index % 2 else "Material",
+                         "PHASE": "P{}".format(index % 9),
+                         "LOCATION": "L{}".format(index % 13),
+                         "DESCRIPTION": "Cost code line {}".format(index),
+                         "QTY.": qty,
+                         "UNITS": "ea",
+                         "UNIT PRICE": unitPrice,
+                         "ESTIMATED AMOUNT": round(qty * unitPrice, 2),
+                         "GROUPING NAME": "SECTION {}".format(index // 500),
+                         "SUMMARY NAME": "Section {} total".format(index // 500)})
+    return document
+
+
+def bestTime(function, repeat):
+    """
+    Returns the result of supplied function and its best run time in seconds.
+
+    """
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def benchmark(document, repeat=5):
+    """
+    Encodes and decodes supplied document in every output format. Returns one
+    result dictionary per format.
+
+    """
+
+    results = []
+    for outputFormat in OUTPUT_FORMATS:
+        try:
+            importEncoder(outputFormat)
+        except ValueError as e:
+            results.append({"FORMAT": outputFormat, "SKIPPED": str(e)})
+            continue
+
+        encoded, encodeSeconds = bestTime(
+            lambda: encodeDocument(document, outputFormat), repeat)
+        decoded, decodeSeconds = bestTime(
+            lambda: decodeDocument(encoded, outputFormat), repeat)
+        if(decoded != document):
+            raise ValueError('"{}" did not round-trip the document'.format(outputFormat))
+
+        results.append({"FORMAT": outputFormat,
+                        "BYTES": len(encoded),
+                        "ENCODE SECONDS": round(encodeSeconds, 4),
+                        "DECODE SECONDS": round(decodeSeconds, 4)})
+    return results
+
+
+def parseArguments(argv):
+    """
+    Parses command line arguments of the script.
+
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Compares size and speed of the output encodings of the extraction scripts.')
+    parser.add_argument('path', nargs='?',
+                        help='estimate file whose materialLabour output is encoded '
+                        '(default: synthetic records)')
+    parser.add_argument('--records', type=int, default=100000,
+                        help='number of synthetic records (default: 100000)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs per measurement, the best one is reported (default: 5)')
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parseArguments(sys.argv[1:])
+    if(args.path is not None):
+        document = json.loads(runExtraction("materialLabour", args.path))
+    else:
+        document = syntheticDocument(args.records)
+
+    for result in benchmark(document, args.repeat):
+        print(json.dumps(result))
@@ -0,0 +1,150 @@
+"""
+Benchmark comparing the two ways pool workers can hand extracted records back
+to the parent process:
+- "pickle": workers return the record dictionaries, which are pickled, copied
+  through the pool pipe and unpickled, then encoded for the output
+- "shared": workers encode the records and return a shared memory segment
+  handle, the parent writes the segments to the output (see recordBatches.py)
+
+Synthetic cost code records are generated in the workers (not measured), then
+handed off and written to a null device. Reports the best times per mode and
+output format, one JSON line each, e.g.:
+  {"MODE": "pickle", "FORMAT": "json", "RECORDS": 100000, "BYTES": 26368056, "WORKER SECONDS": 0.0,
+   "HANDOFF SECONDS": 0.0166, "OUTPUT SECONDS": 0.1691, "TOTAL SECONDS": 0.1857}
+  {"MODE": "shared", "FORMAT": "json", "RECORDS": 100000, "BYTES": 26368056, "WORKER SECONDS": 0.0512,
+   "HANDOFF SECONDS": 0.0002, "OUTPUT SECONDS": 0.0011, "TOTAL SECONDS": 0.0526}
+"WORKER SECONDS" is the slowest worker's time spent encoding its records,
+"HANDOFF SECONDS" the time from the last worker finishing to the parent holding
+all results (pickling, copying and unpickling) and "OUTPUT SECONDS" the time
+the parent spends writing the output. Both modes must write the same bytes.
+
+"""
+
+from multiprocessing import Pool
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+from benchOutputFormats import syntheticDocument
+from outputEncoding import OUTPUT_FORMATS, encodeDocument, importEncoder
+from recordBatches import BatchedDocument, batchPrefix, segmentName, shareRecords
+
+
+HANDOFF_MODES = ("pickle", "shared")
+
+
+def produceRecords(job):
+    """
+    Generates the records of one shard in a worker process and hands them off
+    in the mode of the job. Returns the records or their segment handle, the
+    time spent handing them off and when the worker finished.
+
+    """
+
+    mode, outputFormat, prefix, index, records = job
+    shardRecords = syntheticDocument(records, seed=index)[1:]
+
+    start = time.monotonic()
+    if(mode == "shared"):
+        shardRecords = shareRecords(shardRecords, segmentName(prefix, index), outputFormat)
+    finished = time.monotonic()
+    return shardRecords, finished - start, finished
+
+
+def runHandoff(pool, prefix, mode, outputFormat, records, shards, stream):
+    """
+    Hands off supplied number of records in shards and writes them to the
+    stream. Returns the measured times in seconds.
+
+    """
+
+    shardSize = -(-records // shards)
+    jobs = [(mode, outputFormat, prefix, index, min(shardSize, records - index * shardSize))
+            for index in range(shards) if index * shardSize < records]
+
+    results = pool.map(produceRecords, jobs)
+    received = time.monotonic()
+
+    if(mode == "shared"):
+        document = BatchedDocument({"DATA": "VALID"}, [batch for batch, _, _ in results])
+        document.writeTo(stream.write, outputFormat)
+        document.release()
+    else:
+        document = [{"DATA": "VALID"}]
+        for shardRecords, _, _ in results:
+            document.extend(shardRecords)
+        stream.write(encodeDocument(document, outputFormat))
+    written = time.monotonic()
+
+    return {"WORKER SECONDS": max(seconds for _, seconds, _ in results),
+            "HANDOFF SECONDS": received - max(finished for _, _, finished in results),
+            "OUTPUT SECONDS": written - received}
+
+
+def benchmark(records, workers, repeat=5, outputFormats=OUTPUT_FORMATS):
+    """
+    Runs the hand-off of every mode in every available output format. Returns
+    one result dictionary per mode and format.
+
+    """
+
+    results = []
+    # Segments of a run are released before the next one, names are reused
+    prefix = batchPrefix()
+    with Pool(workers) as pool, open(os.devnull, 'wb') as sink:
+        for outputFormat in outputFormats:
+            try:
+                importEncoder(outputFormat)
+            except ValueError as e:
+                results.append({"FORMAT": outputFormat, "SKIPPED": str(e)})
+                continue
+
+            # Both modes must write the same document
+            outputs = {}
+            for mode in HANDOFF_MODES:
+                outputs[mode] = io.BytesIO()
+                runHandoff(pool, prefix, mode, outputFormat, records, workers * 4, outputs[mode])
+            if(outputs["pickle"].getvalue() != outputs["shared"].getvalue()):
+                raise ValueError('Hand-off modes wrote different "{}" documents'.format(outputFormat))
+
+            for mode in HANDOFF_MODES:
+                best = None
+                for _ in range(repeat):
+                    times = runHandoff(pool, prefix, mode, outputFormat, records, workers * 4, sink)
+                    times["TOTAL SECONDS"] = sum(times.values())
+                    if(best is None or times["TOTAL SECONDS"] < best["TOTAL SECONDS"]):
+                        best = times
+                result = {"MODE": mode, "FORMAT": outputFormat, "RECORDS": records,
+                          "BYTES": len(outputs[mode].getvalue())}
+                result.update({name: round(seconds, 4) for name, seconds in best.items()})
+                results.append(result)
+    return results
+
+
+def parseArguments(argv):
+    """
+    Parses command line arguments of the script.
+
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Compares hand-off of extracted records from pool workers by pickling and through shared memory.')
+    parser.add_argument('--records', type=int, default=100000,
+                        help='number of synthetic records (default: 100000)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of worker processes (default: 4)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs per measurement, the best one is reported (default: 5)')
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, action='append',
+                        help='output format to measure, may be repeated (default: all)')
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parseArguments(sys.argv[1:])
+    for result in benchmark(args.records, args.workers, args.repeat,
+                            args.output_format or OUTPUT_FORMATS):
+        print(json.dumps(result))
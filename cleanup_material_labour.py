@@ -1,6 +1,10 @@
 from openpyxl import load_workbook, Workbook
 import pandas as pd
 import numpy as np
+from pandas.io.parsers import TextParser
+
+from currency import columnToCents
+from snapshots import loadSnapshot
 
 
 class CleanUpML:
@@ -29,9 +33,10 @@ class CleanUpML:
         Loads the Excel workbook and extracting the sheet 'Est. Summary';
         sheet name has to be the exact match to 'Est. Summary'
         **File has to be in .xlsm format
+        Workbook is read through its binary snapshot, compiled on first use
         """
 
-        wb = load_workbook(filename=path)
+        wb = loadSnapshot(path)
         self.sheet = wb['Est. Summary']
 
     def get_index(self):
@@ -63,12 +68,33 @@ class CleanUpML:
 
         # print(self.row_index, self.col_index)
 
+    def sheet_frame(self):
+        """
+        Builds the frame of the loaded sheet the same way read_excel builds it,
+        without parsing the workbook again
+        """
+
+        # Empty cells as '', trailing empty cells and rows dropped, like read_excel's reader
+        data = []
+        for row in self.sheet.iter_rows(values_only=True):
+            row = ['' if value is None else value for value in row]
+            while len(row) > 0 and row[-1] == '':
+                row.pop()
+            data.append(row)
+        while len(data) > 0 and len(data[-1]) == 0:
+            data.pop()
+
+        width = max((len(row) for row in data), default=0)
+        data = [row + [''] * (width - len(row)) for row in data]
+
+        return TextParser(data, header=0).read()
+
     def clean_header(self):
         """
         Extracting and renaming relevant headers to the correct names and in order
         """
 
-        df = pd.read_excel(self.path, sheet_name='Est. Summary')
+        df = self.sheet_frame()
 
         df = df.iloc[self.row_index - 1:, self.col_index:]
 
@@ -106,29 +132,33 @@ class CleanUpML:
 
     def clean_material_col(self):
         """
-        Replacing string inputs in material column with 0
+        Converting currency string inputs in material column to amounts, replacing
+        other string inputs with 0
         ** this method will be removed when incorporating error raising
         """
 
-        string_inputs_material_total = self.cleaned_df[(self.cleaned_df['MATERIAL TOTAL'].str.isdigit() == False)][
-            'MATERIAL TOTAL'].unique()
+        string_inputs = self.cleaned_df['MATERIAL TOTAL'].map(lambda value: isinstance(value, str))
 
-        for i in string_inputs_material_total:
-            self.cleaned_df['MATERIAL TOTAL'].replace(i, 0, inplace=True)
+        # Whole column is converted in one vectorised pass, amounts are exact to
+        # the cent and invalid strings become 0
+        cents = columnToCents(self.cleaned_df.loc[string_inputs, 'MATERIAL TOTAL'], default=0)
+        self.cleaned_df.loc[string_inputs, 'MATERIAL TOTAL'] = cents / 100
 
         # print(self.cleaned_df.shape)
 
     def clean_labour_col(self):
         """
-        Replacing string inputs in labour column with 0
+        Converting currency string inputs in labour column to amounts, replacing
+        other string inputs with 0
         ** this method will be removed when incorporating error raising
         """
 
-        string_inputs_labour_total = self.cleaned_df[(self.cleaned_df['LABOUR TOTAL'].str.isdigit() == False)][
-            'LABOUR TOTAL'].unique()
+        string_inputs = self.cleaned_df['LABOUR TOTAL'].map(lambda value: isinstance(value, str))
 
-        for i in string_inputs_labour_total:
-            self.cleaned_df['LABOUR TOTAL'].replace(i, 0, inplace=True)
+        # Whole column is converted in one vectorised pass, amounts are exact to
+        # the cent and invalid strings become 0
+        cents = columnToCents(self.cleaned_df.loc[string_inputs, 'LABOUR TOTAL'], default=0)
+        self.cleaned_df.loc[string_inputs, 'LABOUR TOTAL'] = cents / 100
 
         # print(self.cleaned_df.shape)
         # print(self.cleaned_df)
@@ -0,0 +1,186 @@
+"""
+Master cost-code catalog (chart of accounts) used to validate the codes of
+extracted rows. The catalog is a CSV file with one code per line and the cost
+types it may be used for, e.g.:
+  CODE,COST TYPES
+  01 10 00,Material;Labour
+  02 20 10,Subcontract
+  03 30 00,
+An empty COST TYPES column allows the code for every cost type.
+
+The CSV is compiled once into a compact lookup index: one byte per possible
+6-digit code holding a bit mask of the allowed cost types, so checking a row
+is a single indexed read. The index is persisted next to the CSV
+("catalog.csv.index") and compiled again whenever the SHA-256 hash of the CSV
+differs from the one it was compiled from. Compile the index from the command
+line with:
+  python costCatalog.py catalog.csv
+
+"""
+
+import argparse
+import csv
+import hashlib
+import os
+import re
+import sys
+
+
+INDEX_MAGIC = b'ESTCAT\x00\x01'
+INDEX_EXTENSION = '.index'
+
+# Every possible 6-digit code has one entry
+CODE_COUNT = 1000000
+
+# Bit of each cost type in an index entry, bit 0 marks known codes
+COST_TYPES = {
+    "Material": 2,
+    "Labour": 4,
+    "Subcontract": 8,
+}
+KNOWN = 1
+ALL_COST_TYPES = KNOWN | sum(COST_TYPES.values())
+
+CODE_PATTERN = re.compile(r'^\d{6}$|^\d{2}( |-)\d{2}( |-)\d{2}$')
+
+
+def codeNumber(code):
+    """
+    Returns the index entry of supplied cost code, in any of the accepted
+    formats, or None if it isn't a valid code.
+
+    """
+
+    if(not isinstance(code, str) or CODE_PATTERN.match(code) is None):
+        return None
+    return int(code.replace(" ", "").replace("-", ""))
+
+
+class CostCatalog:
+    path = None
+    sourceHash = None
+    # One bit mask byte per code
+    entries = b''
+
+    def __init__(self, path):
+        self.path = path
+        self.sourceHash = self.hashSource()
+
+        # Reuse the persisted index if it was compiled from the same CSV
+        self.entries = self.readIndex()
+        if(self.entries is None):
+            self.entries = self.compile()
+            self.writeIndex()
+
+    def hashSource(self):
+        """
+        Returns the SHA-256 hash of the catalog CSV.
+
+        """
+
+        with open(self.path, 'rb') as f:
+            return hashlib.sha256(f.read()).digest()
+
+    def indexPath(self):
+        return self.path + INDEX_EXTENSION
+
+    def compile(self):
+        """
+        Builds the index entries from the catalog CSV. Raises ValueError on
+        invalid codes or unknown cost types.
+
+        """
+
+        entries = bytearray(CODE_COUNT)
+        with open(self.path, newline='', encoding='utf-8-sig') as f:
+            reader = csv.reader(f)
+            for lineNumber, line in enumerate(reader, 1):
+                if(len(line) == 0 or line[0].strip() == ""):
+                    continue
+                number = codeNumber(line[0].strip())
+                if(number is None):
+                    # Header line
+                    if(lineNumber == 1):
+                        continue
+                    raise ValueError("Invalid cost code on line {}: {}".format(lineNumber, line[0]))
+
+                costTypes = line[1].strip() if len(line) > 1 else ""
+                if(costTypes == ""):
+                    entries[number] |= ALL_COST_TYPES
+                    continue
+                entries[number] |= KNOWN
+                for costType in costTypes.split(';'):
+                    bit = COST_TYPES.get(costType.strip())
+                    if(bit is None):
+                        raise ValueError("Unknown cost type on line {}: {}".format(lineNumber, costType))
+                    entries[number] |= bit
+
+        return bytes(entries)
+
+    def readIndex(self):
+        """
+        Returns the entries of the persisted index, or None if it's missing,
+        unreadable or was compiled from a different CSV.
+
+        """
+
+        try:
+            with open(self.indexPath(), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+
+        header = len(INDEX_MAGIC) + len(self.sourceHash)
+        if(len(data) != header + CODE_COUNT or not data.startswith(INDEX_MAGIC)
+           or data[len(INDEX_MAGIC):header] != self.sourceHash):
+            return None
+        return data[header:]
+
+    def writeIndex(self):
+        """
+        Persists the index atomically. Failing to persist isn't an error, the
+        index is simply compiled again next time.
+
+        """
+
+        try:
+            tempPath = "{}.{}.tmp".format(self.indexPath(), os.getpid())
+            with open(tempPath, 'wb') as f:
+                f.write(INDEX_MAGIC + self.sourceHash + self.entries)
+            os.replace(tempPath, self.indexPath())
+        except OSError:
+            pass
+
+    def checkCode(self, code, costType):
+        """
+        Checks supplied cost code (of valid format) against the catalog. Returns
+        None if it may be used for the cost type, otherwise the FIELD of the error:
+        "CODE" for codes missing from the catalog, "COST TYPE" for codes that
+        don't allow the cost type.
+
+        """
+
+        entry = self.entries[codeNumber(code)]
+        if(not entry & KNOWN):
+            return "CODE"
+        if(not entry & COST_TYPES[costType]):
+            return "COST TYPE"
+        return None
+
+
+def parseArguments(argv):
+    """
+    Parses command line arguments of the script.
+
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Compiles the lookup index of a cost-code catalog CSV.')
+    parser.add_argument('path', help='path to the catalog .csv file')
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parseArguments(sys.argv[1:])
+    catalog = CostCatalog(args.path)
+    print(catalog.indexPath())
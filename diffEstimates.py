@@ -0,0 +1,188 @@
+"""
+Script designed to report what changed between two revisions of the A6
+Estimate Excel file. Both files are extracted with materialLabour.py in
+parallel and their cost codes are joined on CODE, COST TYPE, PHASE,
+LOCATION and DESCRIPTION. Lines sharing the same key are paired in sheet
+order. Script prints one out of two possible outputs:
+- Master error if either revision could not be extracted, e.g.:
+  {"ERROR": "Revision could not be extracted", "FILE": "...", "RESULT": [{"DATA": "INVALID"}, ...]}
+- The difference between the revisions, e.g.:
+  {"ADDED": [{"CODE": "", ...}, ...],
+   "REMOVED": [{"CODE": "", ...}, ...],
+   "CHANGED": [{"OLD": {"CODE": "", ...},
+                "NEW": {"CODE": "", ...},
+                "DELTA": {"QTY.": 0, "UNIT PRICE": 0, "ESTIMATED AMOUNT": 0}}, ...],
+   "SECTIONS": [{"GROUPING NAME": "", "OLD TOTAL": 0, "NEW TOTAL": 0, "DELTA": 0}, ...]}
+
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import argparse
+import json
+import sys
+
+from extractors import runExtraction
+
+
+class DiffEstimates:
+    oldPath = None
+    newPath = None
+
+    # Fields identifying the same estimate line in both revisions
+    keyFields = ("CODE", "COST TYPE", "PHASE", "LOCATION", "DESCRIPTION")
+
+    # Fields compared between matched lines, numeric ones also get a delta
+    comparedFields = ("QTY.", "UNITS", "UNIT PRICE", "ESTIMATED AMOUNT",
+                      "GROUPING NAME", "SUMMARY NAME")
+    deltaFields = ("QTY.", "UNIT PRICE", "ESTIMATED AMOUNT")
+
+    # Read revisions through their compiled workbook snapshots
+    snapshot = False
+
+    def __init__(self, oldPath=None, newPath=None, snapshot=False):
+        self.oldPath = oldPath
+        self.newPath = newPath
+        self.snapshot = snapshot
+
+    def extractRevisions(self):
+        """
+        Extracts both revisions in parallel and returns their cost code lists.
+        If either extraction isn't VALID, prints a master error and exits.
+
+        """
+
+        with ProcessPoolExecutor(max_workers=2) as pool:
+            outputs = list(pool.map(partial(runExtraction, snapshot=self.snapshot),
+                                    ["materialLabour", "materialLabour"],
+                                    [self.oldPath, self.newPath]))
+
+        revisions = []
+        for path, output in zip([self.oldPath, self.newPath], outputs):
+            result = json.loads(output)
+            if(not isinstance(result, list) or result[0] != {"DATA": "VALID"}):
+                print(json.dumps({"ERROR": "Revision could not be extracted",
+                                  "FILE": path,
+                                  "RESULT": result}))
+                exit()
+            revisions.append(result[1:])
+
+        return revisions
+
+    def diff(self, oldRecords, newRecords):
+        """
+        Hash-joins supplied revisions on the key fields and returns the
+        difference dictionary. Runs in time linear to the number of lines.
+
+        """
+
+        # Index old lines by key, lines sharing a key keep their sheet order
+        oldIndex = {}
+        for record in oldRecords:
+            oldIndex.setdefault(self.recordKey(record), []).append(record)
+
+        added = []
+        changed = []
+        # Position of the next unmatched old line for each key
+        matched = {}
+
+        for record in newRecords:
+            key = self.recordKey(record)
+            candidates = oldIndex.get(key)
+            position = matched.get(key, 0)
+
+            if(candidates is None or position >= len(candidates)):
+                added.append(record)
+                continue
+
+            matched[key] = position + 1
+            oldRecord = candidates[position]
+            if(any(oldRecord[field] != record[field] for field in self.comparedFields)):
+                changed.append({"OLD": oldRecord,
+                                "NEW": record,
+                                "DELTA": self.recordDelta(oldRecord, record)})
+
+        # Old lines left unmatched were removed. Lines of a key are matched in
+        # sheet order, so walking the old revision once and skipping the first
+        # "matched" lines of every key keeps its sheet order
+        removed = []
+        seen = {}
+        for record in oldRecords:
+            key = self.recordKey(record)
+            position = seen.get(key, 0)
+            seen[key] = position + 1
+            if(position >= matched.get(key, 0)):
+                removed.append(record)
+
+        return {"ADDED": added,
+                "REMOVED": removed,
+                "CHANGED": changed,
+                "SECTIONS": self.sectionTotals(oldRecords, newRecords)}
+
+    def recordKey(self, record):
+        """
+        Returns the join key of supplied cost code dictionary.
+
+        """
+
+        return tuple(record[field] for field in self.keyFields)
+
+    def recordDelta(self, oldRecord, newRecord):
+        """
+        Returns the differences of the numeric fields of two matched lines.
+
+        """
+
+        delta = {}
+        for field in self.deltaFields:
+            delta[field] = round((newRecord[field] or 0) -
+                                 (oldRecord[field] or 0), 2)
+        return delta
+
+    def sectionTotals(self, oldRecords, newRecords):
+        """
+        Returns estimated amount totals of every grouping name in both revisions,
+        in order of first appearance (new revision first).
+
+        """
+
+        totals = {}
+        for column, records in ((1, newRecords), (0, oldRecords)):
+            for record in records:
+                sectionTotal = totals.setdefault(
+                    record["GROUPING NAME"], [0, 0])
+                sectionTotal[column] += record["ESTIMATED AMOUNT"] or 0
+
+        sections = []
+        for name, (oldTotal, newTotal) in totals.items():
+            sections.append({"GROUPING NAME": name,
+                             "OLD TOTAL": round(oldTotal, 2),
+                             "NEW TOTAL": round(newTotal, 2),
+                             "DELTA": round(newTotal - oldTotal, 2)})
+        return sections
+
+    def main(self):
+
+        oldRecords, newRecords = self.extractRevisions()
+        print(json.dumps(self.diff(oldRecords, newRecords)))
+
+
+def parseArguments(argv):
+    """
+    Parses command line arguments of the script.
+
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Reports added, removed and changed cost codes between two estimate revisions.')
+    parser.add_argument('old', help='path to the older estimate revision')
+    parser.add_argument('new', help='path to the newer estimate revision')
+    parser.add_argument('--snapshot', action='store_true',
+                        help='read both revisions through their binary snapshots, compiled on first use')
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parseArguments(sys.argv[1:])
+    differ = DiffEstimates(oldPath=args.old, newPath=args.new, snapshot=args.snapshot)
+    differ.main()
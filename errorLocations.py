@@ -0,0 +1,56 @@
+"""
+Cell locations used in the "LOCATION" of data errors, e.g.:
+  {"FIELD": "QUANTITY", "LOCATION": "E14"}
+and their optional run-length compression. When a whole column is mis-typed,
+errors of the same FIELD in vertically adjacent cells of one column are
+collapsed into a single error with a range location, e.g.:
+  {"FIELD": "QUANTITY", "LOCATION": "E14:E9000"}
+Errors in a single cell keep the plain location.
+
+"""
+
+from openpyxl.utils import get_column_letter
+import re
+
+
+LOCATION_PATTERN = re.compile(r'^([A-Z]+)(\d+)$')
+
+
+def cellLocation(column, row):
+    """
+    Returns the Excel location of supplied 0-based column and 1-based row,
+    e.g. (6, 14) -> "G14". Columns past Z get multi-letter names (AA, AB, ...).
+
+    """
+
+    return "{}{}".format(get_column_letter(column + 1), row)
+
+
+def compressErrorLocations(errorData):
+    """
+    Collapses errors of the same FIELD in vertically adjacent cells of one
+    column into one error with a range location. Errors keep the order of
+    their first cell and the leading {"DATA": "INVALID"} entry is kept as is.
+
+    """
+
+    compressed = errorData[:1]
+    # Open run for each (field, column): [error dictionary, first row, last row]
+    runs = {}
+
+    for error in errorData[1:]:
+        match = LOCATION_PATTERN.match(error["LOCATION"])
+        column = match.group(1)
+        row = int(match.group(2))
+        key = (error["FIELD"], column)
+
+        run = runs.get(key)
+        if(run is not None and run[2] == row - 1):
+            run[2] = row
+            run[0]["LOCATION"] = "{}{}:{}{}".format(column, run[1], column, row)
+        else:
+            newError = dict(error)
+            compressed.append(newError)
+            runs[key] = [newError, row, row]
+
+    return compressed
@@ -0,0 +1,402 @@
+"""
+Local HTTP service running the extraction scripts on uploaded workbooks, for
+web tiers that need request/response extraction. Workbooks are uploaded as
+the raw request body (Content-Length or chunked) and extracted in a pool of
+worker processes that is started once, so no process is forked per upload.
+Workers are started by a fork server, so they never inherit the listening
+socket or client connections open at the time:
+  POST /extract/materialLabour           body: .xlsx/.xlsm bytes
+  POST /extract/subcontracted?format=msgpack
+The extractor's document is streamed back in chunks, in the requested output
+format (see outputEncoding.py, JSON by default).
+
+At most "concurrency" extractions run at a time and at most "queueLimit"
+more wait for a worker. Requests beyond that are answered 503 right away,
+with a Retry-After header, instead of being queued, and so are uploads
+larger than the upload limit (413). Further endpoints:
+  GET /health    {"STATUS": "OK", "RUNNING": 2, "QUEUED": 0, "CONCURRENCY": 4, "QUEUE LIMIT": 16}
+  GET /metrics   request, error and rejection counts and latency percentiles
+                 (seconds, over the last LATENCY_WINDOW requests) per extractor
+
+Every response closes its connection.
+
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from urllib.parse import parse_qs, urlsplit
+import argparse
+import asyncio
+import json
+import multiprocessing
+import sys
+import time
+
+from extractors import EXTRACTORS, runExtraction
+from outputEncoding import OUTPUT_FORMATS, importEncoder
+
+
+# Latencies kept per extractor for the percentiles
+LATENCY_WINDOW = 1000
+
+# Size of the response chunks streamed back
+CHUNK_SIZE = 1 << 16
+
+# Longest request line and headers accepted
+HEADER_LIMIT = 1 << 16
+
+CONTENT_TYPES = {
+    "json": "application/json",
+    "msgpack": "application/msgpack",
+    "cbor": "application/cbor",
+}
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+class HttpError(Exception):
+    status = 400
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def percentile(values, fraction):
+    """
+    Returns the percentile of supplied sorted values at the fraction (0 to 1),
+    or None if there are none.
+
+    """
+
+    if(len(values) == 0):
+        return None
+    return round(values[min(len(values) - 1, int(fraction * len(values)))], 3)
+
+
+class ExtractionService:
+    host = "127.0.0.1"
+    port = 8080
+    concurrency = 4
+    queueLimit = 16
+    # Largest upload accepted, in megabytes
+    maxUpload = 100
+
+    def __init__(self, host="127.0.0.1", port=8080, concurrency=4, queueLimit=16, maxUpload=100):
+        self.host = host
+        self.port = port
+        self.concurrency = concurrency
+        self.queueLimit = queueLimit
+        self.maxUpload = maxUpload
+
+        # Extractions waiting for a worker and running
+        self.queued = 0
+        self.running = 0
+        self.slots = None
+        self.pool = None
+        self.started = time.monotonic()
+
+        # Metrics per extractor
+        self.requests = {name: 0 for name in EXTRACTORS}
+        self.errors = {name: 0 for name in EXTRACTORS}
+        self.rejected = 0
+        self.latencies = {name: deque(maxlen=LATENCY_WINDOW) for name in EXTRACTORS}
+
+    async def serve(self):
+        """
+        Starts the worker pool and serves requests until cancelled.
+
+        """
+
+        self.slots = asyncio.Semaphore(self.concurrency)
+        self.pool = self.createPool()
+        server = await asyncio.start_server(self.handleConnection, self.host, self.port,
+                                            limit=HEADER_LIMIT)
+        print(json.dumps({"LISTENING": "{}:{}".format(self.host, self.port)}), flush=True)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.pool.shutdown(cancel_futures=True)
+
+    def createPool(self):
+        """
+        Returns a new worker pool. Forked workers would hold copies of the sockets
+        open when they start and keep client connections from closing, so they
+        are started from a fork server instead (spawned where there is none).
+
+        """
+
+        if("forkserver" in multiprocessing.get_all_start_methods()):
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(["extractors"])
+        else:
+            context = multiprocessing.get_context("spawn")
+        return ProcessPoolExecutor(max_workers=self.concurrency, mp_context=context)
+
+    async def handleConnection(self, reader, writer):
+        """
+        Handles one request of a connection and closes it.
+
+        """
+
+        try:
+            method, target, headers = await self.readHead(reader)
+            url = urlsplit(target)
+            await self.route(method, url.path, parse_qs(url.query), headers, reader, writer)
+        except HttpError as e:
+            await self.respond(writer, e.status, {"ERROR": str(e)})
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            await self.respond(writer, 400, {"ERROR": "Malformed request"})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def readHead(self, reader):
+        """
+        Reads the request line and headers. Returns the method, target and a
+        dictionary of lower case header names to values.
+
+        """
+
+        head = await reader.readuntil(b"\r\n\r\n")
+        lines = head.decode('latin-1').split("\r\n")
+        method, target, _ = lines[0].split(" ", 2)
+
+        headers = {}
+        for line in lines[1:]:
+            if(line):
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        return method, target, headers
+
+    async def route(self, method, path, query, headers, reader, writer):
+        """
+        Dispatches a request to its endpoint.
+
+        """
+
+        if(path == "/health"):
+            await self.respond(writer, 200, self.health())
+        elif(path == "/metrics"):
+            await self.respond(writer, 200, self.metrics())
+        elif(path.startswith("/extract/")):
+            extractorName = path[len("/extract/"):]
+            if(extractorName not in EXTRACTORS):
+                raise HttpError(404, "Unknown extractor: " + extractorName)
+            if(method != "POST"):
+                raise HttpError(405, "Workbooks must be uploaded with POST")
+            outputFormat = query.get("format", ["json"])[0]
+            if(outputFormat not in OUTPUT_FORMATS):
+                raise HttpError(400, "Unknown output format: " + outputFormat)
+            try:
+                importEncoder(outputFormat)
+            except ValueError as e:
+                raise HttpError(400, str(e))
+            await self.extract(extractorName, outputFormat, headers, reader, writer)
+        else:
+            raise HttpError(404, "Unknown endpoint: " + path)
+
+    async def extract(self, extractorName, outputFormat, headers, reader, writer):
+        """
+        Reads the uploaded workbook, runs the extractor in the worker pool and
+        streams its document back. Requests over the queue limit are rejected
+        before their upload is read.
+
+        """
+
+        started = time.monotonic()
+
+        # Backpressure: reject instead of queueing without bound
+        if(self.queued + self.running >= self.concurrency + self.queueLimit):
+            self.rejected += 1
+            await self.respond(writer, 503, {"ERROR": "Too many extractions in progress, retry later"},
+                               extraHeaders={"Retry-After": "1"})
+            return
+
+        options = {} if outputFormat == "json" else {"outputFormat": outputFormat}
+        self.requests[extractorName] += 1
+        self.queued += 1
+        waiting = True
+        try:
+            workbook = await self.readBody(headers, reader)
+            async with self.slots:
+                self.queued -= 1
+                waiting = False
+                self.running += 1
+                try:
+                    output = await asyncio.get_running_loop().run_in_executor(
+                        self.pool, partial(runExtraction, extractorName, workbook, **options))
+                finally:
+                    self.running -= 1
+        except BrokenProcessPool:
+            # A worker died, the pool is replaced for the following requests
+            self.errors[extractorName] += 1
+            self.pool = self.createPool()
+            raise HttpError(500, "Extraction worker failed")
+        except HttpError:
+            self.errors[extractorName] += 1
+            raise
+        except Exception as e:
+            self.errors[extractorName] += 1
+            if(isinstance(e, (asyncio.IncompleteReadError, ConnectionError))):
+                raise
+            raise HttpError(500, "Extraction failed: " + str(e))
+        finally:
+            if(waiting):
+                self.queued -= 1
+
+        await self.streamBody(writer, output, CONTENT_TYPES[outputFormat])
+        self.latencies[extractorName].append(time.monotonic() - started)
+
+    async def readBody(self, headers, reader):
+        """
+        Reads the request body as it streams in, sized by Content-Length or in
+        chunked transfer encoding. Raises HttpError if it's missing or over the
+        upload limit.
+
+        """
+
+        limit = int(self.maxUpload * 1024 * 1024)
+        body = bytearray()
+
+        if(headers.get("transfer-encoding", "").lower() == "chunked"):
+            while True:
+                sizeLine = await reader.readuntil(b"\r\n")
+                size = int(sizeLine.split(b";")[0], 16)
+                if(size == 0):
+                    # Skip trailers
+                    while(await reader.readuntil(b"\r\n") != b"\r\n"):
+                        pass
+                    break
+                if(len(body) + size > limit):
+                    raise HttpError(413, "Upload exceeds {} MB".format(self.maxUpload))
+                body += await reader.readexactly(size)
+                await reader.readexactly(2)
+        elif("content-length" in headers):
+            length = int(headers["content-length"])
+            if(length > limit):
+                raise HttpError(413, "Upload exceeds {} MB".format(self.maxUpload))
+            while(len(body) < length):
+                chunk = await reader.read(min(CHUNK_SIZE, length - len(body)))
+                if(not chunk):
+                    raise asyncio.IncompleteReadError(bytes(body), length)
+                body += chunk
+        else:
+            raise HttpError(400, "Workbook upload is missing")
+
+        if(len(body) == 0):
+            raise HttpError(400, "Workbook upload is empty")
+        return bytes(body)
+
+    async def respond(self, writer, status, document, extraHeaders=None):
+        """
+        Writes a complete JSON response.
+
+        """
+
+        body = json.dumps(document).encode('utf-8')
+        headers = {"Content-Type": "application/json",
+                   "Content-Length": str(len(body)),
+                   "Connection": "close"}
+        headers.update(extraHeaders or {})
+        writer.write(self.head(status, headers) + body)
+        await writer.drain()
+
+    async def streamBody(self, writer, output, contentType):
+        """
+        Streams an extractor document back in chunks.
+
+        """
+
+        if(isinstance(output, str)):
+            output = output.encode('utf-8')
+        writer.write(self.head(200, {"Content-Type": contentType,
+                                     "Transfer-Encoding": "chunked",
+                                     "Connection": "close"}))
+        view = memoryview(output)
+        for start in range(0, len(view), CHUNK_SIZE):
+            chunk = view[start:start + CHUNK_SIZE]
+            writer.write(b"%x\r\n" % len(chunk) + chunk + b"\r\n")
+            # Wait for slow clients instead of buffering the whole document
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    def head(self, status, headers):
+        lines = ["HTTP/1.1 {} {}".format(status, REASONS[status])]
+        lines.extend("{}: {}".format(name, value) for name, value in headers.items())
+        return ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1')
+
+    def health(self):
+        return {"STATUS": "OK",
+                "RUNNING": self.running,
+                "QUEUED": self.queued,
+                "CONCURRENCY": self.concurrency,
+                "QUEUE LIMIT": self.queueLimit,
+                "UPTIME SECONDS": round(time.monotonic() - self.started, 1)}
+
+    def metrics(self):
+        """
+        Returns request counts and latency percentiles per extractor.
+
+        """
+
+        extractors = {}
+        for name in EXTRACTORS:
+            latencies = sorted(self.latencies[name])
+            extractors[name] = {"REQUESTS": self.requests[name],
+                                "ERRORS": self.errors[name],
+                                "LATENCY P50": percentile(latencies, 0.5),
+                                "LATENCY P90": percentile(latencies, 0.9),
+                                "LATENCY P99": percentile(latencies, 0.99),
+                                "LATENCY MAX": percentile(latencies, 1)}
+        return {"REJECTED": self.rejected,
+                "RUNNING": self.running,
+                "QUEUED": self.queued,
+                "EXTRACTORS": extractors}
+
+
+def parseArguments(argv):
+    """
+    Parses command line arguments of the script.
+
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Serves the extraction scripts over HTTP for uploaded workbooks.')
+    parser.add_argument('--host', default="127.0.0.1", help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on (default: 8080)')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='number of extractions run at a time, one worker process each (default: 4)')
+    parser.add_argument('--queue-limit', type=int, default=16,
+                        help='number of extractions that may wait for a worker before requests are '
+                        'rejected with 503 (default: 16)')
+    parser.add_argument('--max-upload', type=float, default=100,
+                        help='largest accepted upload in MB (default: 100)')
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parseArguments(sys.argv[1:])
+    service = ExtractionService(host=args.host, port=args.port, concurrency=args.concurrency,
+                                queueLimit=args.queue_limit, maxUpload=args.max_upload)
+    try:
+        asyncio.run(service.serve())
+    except KeyboardInterrupt:
+        pass
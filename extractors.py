@@ -0,0 +1,116 @@
+"""
+Shared entry point for running the extraction scripts from other tools
+(watch folders, batch runs, services). Each extractor is looked up by the
+name of its script and run in-process; the JSON document it would have
+printed to stdout is captured and returned as a string, e.g.:
+  output = runExtraction('materialLabour', 'C:\\Estimates\\A6.xlsm')
+
+Master errors terminate the scripts through exit(), which is caught here so
+the calling process keeps running and still receives the ERROR document.
+With a binary "outputFormat" option (see outputEncoding.py) the document is
+returned as bytes instead.
+
+The version of an extractor is a hash of the sources it runs (its script,
+the modules of the script folder it imports and the template schemas), so
+batch runs can tell outputs of older scripts apart.
+
+"""
+
+import ast
+import contextlib
+import glob
+import hashlib
+import io
+import os
+
+import materialLabour
+import subcontracted
+from templateSchemas import SCHEMA_DIRECTORY
+
+
+# Extractor classes by script name
+EXTRACTORS = {
+    "materialLabour": materialLabour.CleanUpML,
+    "subcontracted": subcontracted.CleanUpML,
+}
+
+# Folder holding the scripts
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def runExtraction(extractorName, path, **options):
+    """
+    Runs the named extractor on supplied file and returns its printed output.
+    Additional keyword options are passed to the extractor's constructor.
+
+    """
+
+    extractor = EXTRACTORS[extractorName](path=path, **options)
+
+    # Binary documents are written to the binary stdout, captured as bytes
+    binary = options.get("outputFormat", "json") != "json"
+    buffer = io.BytesIO()
+    output = io.TextIOWrapper(buffer, encoding='utf-8') if binary else io.StringIO()
+    with contextlib.redirect_stdout(output):
+        try:
+            extractor.main()
+        # Master errors print the ERROR document and exit
+        except SystemExit:
+            pass
+
+    if(binary):
+        output.flush()
+        output.detach()
+        return buffer.getvalue()
+    return output.getvalue()
+
+
+def localImports(path):
+    """
+    Returns the paths of the modules of the script folder imported by supplied
+    source file.
+
+    """
+
+    with open(path, 'rb') as f:
+        tree = ast.parse(f.read(), path)
+
+    names = []
+    for node in ast.walk(tree):
+        if(isinstance(node, ast.Import)):
+            names.extend(alias.name for alias in node.names)
+        elif(isinstance(node, ast.ImportFrom) and node.module is not None and node.level == 0):
+            names.append(node.module)
+
+    paths = []
+    for name in names:
+        modulePath = os.path.join(SCRIPT_DIRECTORY, name + '.py')
+        if(os.path.exists(modulePath)):
+            paths.append(modulePath)
+    return paths
+
+
+def extractorVersion(extractorName):
+    """
+    Returns the version of the named extractor: the first 16 hex digits of
+    the SHA-256 hash of its script, the modules of the script folder it
+    imports (directly or through each other) and the template schema files.
+
+    """
+
+    script = os.path.join(SCRIPT_DIRECTORY, extractorName + '.py')
+    sources = set()
+    pending = [script]
+    while(len(pending) > 0):
+        path = pending.pop()
+        if(path not in sources):
+            sources.add(path)
+            pending.extend(localImports(path))
+    sources.update(glob.glob(os.path.join(SCHEMA_DIRECTORY, '*.json')))
+
+    digest = hashlib.sha256()
+    for path in sorted(sources):
+        digest.update(os.path.basename(path).encode('utf-8'))
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
@@ -0,0 +1,578 @@
+"""
+Evaluation of formulas whose cached results are missing. Workbooks are read
+with data_only=True, which returns the results Excel cached when it saved the
+file. Tools that write workbooks without recalculating them store no such
+results, so computed QTY and price cells read as None. For those workbooks the
+formulas are evaluated in-process, supporting the subset the estimate
+templates use:
+- numbers, text and references to cells and ranges of the same sheet
+- arithmetic (+, -, *, /, ^, unary minus, %) and text concatenation (&)
+- the SUM and ROUND functions
+
+Cells are evaluated on demand in dependency (topological) order, every result
+is memoized, and cells with cached results are never re-evaluated. Formulas
+outside the subset (other functions, references to other sheets, circular
+references) leave the cell empty, as it would be without the evaluator.
+Formula errors become the Excel error text (e.g. "#DIV/0!"), as they would
+have been cached.
+
+"""
+
+from decimal import Decimal, ROUND_HALF_UP
+from openpyxl import load_workbook
+from openpyxl.formula import Tokenizer
+from openpyxl.formula.tokenizer import Token, TokenizerError
+from openpyxl.utils.cell import get_column_letter, range_boundaries
+from xml.etree import ElementTree
+import posixpath
+import re
+import zipfile
+
+
+# Cell holding a formula without a cached value: "<f>...</f>" or "<f .../>"
+# closing the cell without a "<v>" element, or with an empty one. Captures the
+# column letters of the cell reference
+UNCACHED_PATTERN = re.compile(
+    rb'<c\b(?:[^>]*?\br="([A-Z]+)[0-9]+")?[^>]*>\s*<f\b(?:[^>]*/>|[^>]*>[^<]*</f>)'
+    rb'\s*(?:<v\s*/>|<v>\s*</v>)?\s*</c>')
+
+# Namespaces of the workbook part and its relationships
+SPREADSHEET_NAMESPACE = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+RELATIONSHIP_ID = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+
+# Excel error values, as openpyxl returns them from cached results
+ERROR_CODES = ("#NULL!", "#DIV/0!", "#VALUE!", "#REF!", "#NAME?", "#NUM!", "#N/A")
+
+# Binding power of the operators, prefix minus binds tightest like in Excel
+INFIX_PRECEDENCE = {"&": 1, "+": 2, "-": 2, "*": 3, "/": 3, "^": 4}
+POSTFIX_PRECEDENCE = 5
+PREFIX_PRECEDENCE = 6
+
+
+class UnsupportedFormula(Exception):
+    """
+    Raised for formulas outside the supported subset.
+
+    """
+
+
+class FormulaError(Exception):
+    """
+    Raised for Excel error values, carrying the error text.
+
+    """
+
+
+def worksheetParts(archive, sheetNames):
+    """
+    Returns the archive paths of the worksheet parts of supplied sheet names,
+    resolved through the workbook part and its relationships. Sheets missing
+    from the workbook are left out.
+
+    """
+
+    relationships = ElementTree.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+    targets = {relationship.get('Id'): relationship.get('Target') for relationship in relationships}
+
+    parts = []
+    for sheet in ElementTree.fromstring(archive.read('xl/workbook.xml')).iter(SPREADSHEET_NAMESPACE + 'sheet'):
+        target = targets.get(sheet.get(RELATIONSHIP_ID))
+        if(sheet.get('name') in sheetNames and target is not None):
+            # Targets are relative to the workbook part, or absolute in the archive
+            parts.append(target.lstrip('/') if target.startswith('/')
+                         else posixpath.normpath(posixpath.join('xl', target)))
+    return parts
+
+
+def hasUncachedFormulas(source, sheetNames=None, columns=None):
+    """
+    Checks if supplied workbook (path or binary buffer) holds a formula without
+    a cached result in the named sheets (every worksheet by default), only in
+    supplied 0-based columns if given. Only the parts of those sheets are
+    streamed through a single pattern, which is much cheaper than loading the
+    workbook again.
+
+    """
+
+    if(not isinstance(source, str)):
+        source.seek(0)
+    if(columns is not None):
+        columns = {get_column_letter(column + 1).encode('ascii') for column in columns}
+
+    try:
+        with zipfile.ZipFile(source) as archive:
+            if(sheetNames is None):
+                parts = [name for name in archive.namelist()
+                         if name.startswith('xl/worksheets/') and name.endswith('.xml')]
+            else:
+                parts = worksheetParts(archive, sheetNames)
+
+            for name in parts:
+                with archive.open(name) as f:
+                    tail = b''
+                    for chunk in iter(lambda: f.read(1 << 20), b''):
+                        # Cells cut by the chunk end are matched with the next chunk
+                        data = tail + chunk
+                        end = data.rfind(b'</c>')
+                        end = end + 4 if end >= 0 else 0
+                        for match in UNCACHED_PATTERN.finditer(data, 0, end):
+                            # Cells without a reference may be in any column
+                            if(columns is None or match.group(1) is None or match.group(1) in columns):
+                                return True
+                        tail = data[end:]
+        return False
+    finally:
+        if(not isinstance(source, str)):
+            source.seek(0)
+
+
+def loadFormulaWorkbook(source):
+    """
+    Loads supplied workbook with its formulas instead of their cached results.
+
+    """
+
+    if(not isinstance(source, str)):
+        source.seek(0)
+    return load_workbook(filename=source)
+
+
+class FormulaEvaluator:
+    valueSheet = None
+
+    def __init__(self, valueSheet, formulaSheet):
+        self.valueSheet = valueSheet
+        self.maxRow = formulaSheet.max_row
+        self.maxColumn = formulaSheet.max_column
+
+        # Cached values and formulas of cells without a cached value, by (row, column)
+        self.values = []
+        self.formulas = {}
+        for rowNumber, (valueRow, formulaRow) in enumerate(zip(
+                valueSheet.iter_rows(min_row=1, max_row=self.maxRow, min_col=1,
+                                     max_col=self.maxColumn, values_only=True),
+                formulaSheet.iter_rows(values_only=True)), 1):
+            self.values.append(valueRow)
+            for columnNumber, (value, formula) in enumerate(zip(valueRow, formulaRow), 1):
+                if(value is None and isinstance(formula, str) and formula.startswith('=')):
+                    self.formulas[(rowNumber, columnNumber)] = formula
+
+        # Memoized results and parsed formulas
+        self.results = {}
+        self.parsed = {}
+
+    def evaluateColumns(self, columns, minRow=1):
+        """
+        Evaluates the formulas of supplied 0-based columns from the given row on
+        and writes the results to the value sheet. Returns the number of cells
+        filled in.
+
+        """
+
+        columns = set(column + 1 for column in columns)
+        filled = 0
+        for (rowNumber, columnNumber) in self.formulas:
+            if(columnNumber not in columns or rowNumber < minRow):
+                continue
+            result = self.evaluate((rowNumber, columnNumber))
+            if(result is not None):
+                self.valueSheet.cell(row=rowNumber, column=columnNumber).value = result
+                filled += 1
+        return filled
+
+    def evaluateAll(self):
+        """
+        Evaluates all formulas without cached results. Returns the number of cells
+        filled in.
+
+        """
+
+        return self.evaluateColumns(range(self.maxColumn))
+
+    def evaluate(self, cell):
+        """
+        Returns the result of supplied formula cell, or None if it can't be
+        evaluated. Cells it depends on are evaluated first, depth first with an
+        explicit stack, so long chains of references don't hit the recursion limit.
+
+        """
+
+        stack = [cell]
+        visiting = set()
+
+        while(len(stack) > 0):
+            current = stack[-1]
+            if(current in self.results):
+                stack.pop()
+                continue
+
+            if(current not in visiting):
+                visiting.add(current)
+                try:
+                    dependencies = self.dependencies(current)
+                except UnsupportedFormula:
+                    self.results[current] = None
+                    visiting.discard(current)
+                    stack.pop()
+                    continue
+                pending = [dependency for dependency in dependencies
+                           if dependency in self.formulas and dependency not in self.results]
+                # Circular references aren't evaluated
+                if(any(dependency in visiting for dependency in pending)):
+                    self.results[current] = None
+                    visiting.discard(current)
+                    stack.pop()
+                    continue
+                stack.extend(pending)
+                continue
+
+            # Dependencies are done, evaluate the cell itself
+            self.results[current] = self.compute(current)
+            visiting.discard(current)
+            stack.pop()
+
+        return self.results[cell]
+
+    def compute(self, cell):
+        """
+        Evaluates the parsed formula of supplied cell from memoized results.
+
+        """
+
+        try:
+            value = self.evaluateNode(self.parse(cell))
+            if(isinstance(value, list)):
+                value = self.single(value)
+        except UnsupportedFormula:
+            return None
+        except FormulaError as e:
+            return str(e)
+
+        # Whole numbers are cached as integers
+        if(isinstance(value, float) and value.is_integer()):
+            return int(value)
+        return value
+
+    def parse(self, cell):
+        """
+        Returns the syntax tree of supplied cell's formula, parsing it once.
+
+        """
+
+        tree = self.parsed.get(cell)
+        if(tree is None):
+            try:
+                tokens = [token for token in Tokenizer(self.formulas[cell]).items
+                          if token.type != Token.WSPACE]
+            except TokenizerError:
+                raise UnsupportedFormula(self.formulas[cell])
+            parser = FormulaParser(tokens)
+            tree = parser.parseExpression(0)
+            if(parser.position != len(tokens)):
+                raise UnsupportedFormula(self.formulas[cell])
+            self.parsed[cell] = tree
+        return tree
+
+    def dependencies(self, cell):
+        """
+        Returns the cells referenced by supplied cell's formula.
+
+        """
+
+        cells = []
+        nodes = [self.parse(cell)]
+        while(len(nodes) > 0):
+            node = nodes.pop()
+            if(node[0] == "ref"):
+                minColumn, minRow, maxColumn, maxRow = node[1]
+                for rowNumber in range(minRow, maxRow + 1):
+                    for columnNumber in range(minColumn, maxColumn + 1):
+                        cells.append((rowNumber, columnNumber))
+            elif(node[0] in ("call", "op")):
+                nodes.extend(node[2])
+        return cells
+
+    def cellValue(self, cell):
+        """
+        Returns the value of a referenced cell: its memoized result if it holds a
+        formula, its cached value otherwise.
+
+        """
+
+        if(cell in self.formulas):
+            value = self.results.get(cell)
+            # Formula that couldn't be evaluated, or a circular reference
+            if(value is None):
+                raise UnsupportedFormula(cell)
+            return value
+
+        rowNumber, columnNumber = cell
+        if(rowNumber > len(self.values) or columnNumber > len(self.values[rowNumber - 1])):
+            return None
+        return self.values[rowNumber - 1][columnNumber - 1]
+
+    def evaluateNode(self, node):
+        """
+        Evaluates a syntax tree node. Ranges evaluate to lists of values.
+
+        """
+
+        kind = node[0]
+        if(kind == "value"):
+            return node[1]
+        if(kind == "error"):
+            raise FormulaError(node[1])
+        if(kind == "ref"):
+            minColumn, minRow, maxColumn, maxRow = node[1]
+            values = [self.cellValue((rowNumber, columnNumber))
+                      for rowNumber in range(minRow, maxRow + 1)
+                      for columnNumber in range(minColumn, maxColumn + 1)]
+            if(len(values) == 1):
+                return self.checkError(values[0])
+            return values
+        if(kind == "call"):
+            return self.callFunction(node[1], [self.evaluateNode(argument) for argument in node[2]])
+
+        # Operators
+        operator = node[1]
+        operands = [self.single(self.evaluateNode(operand)) for operand in node[2]]
+        if(operator == "&"):
+            return "".join(self.text(operand) for operand in operands)
+        numbers = [self.number(operand) for operand in operands]
+        if(operator == "neg"):
+            return -numbers[0]
+        if(operator == "%"):
+            return numbers[0] / 100
+        if(operator == "+"):
+            return numbers[0] + numbers[1]
+        if(operator == "-"):
+            return numbers[0] - numbers[1]
+        if(operator == "*"):
+            return numbers[0] * numbers[1]
+        if(operator == "/"):
+            if(numbers[1] == 0):
+                raise FormulaError("#DIV/0!")
+            return numbers[0] / numbers[1]
+        if(operator == "^"):
+            try:
+                result = numbers[0] ** numbers[1]
+            except (ZeroDivisionError, OverflowError):
+                raise FormulaError("#NUM!")
+            if(isinstance(result, complex)):
+                raise FormulaError("#NUM!")
+            return result
+        raise UnsupportedFormula(operator)
+
+    def callFunction(self, name, arguments):
+        """
+        Calls one of the supported functions.
+
+        """
+
+        if(name == "SUM"):
+            total = 0
+            for argument in arguments:
+                if(isinstance(argument, list)):
+                    # Ranges only add up their numbers
+                    for value in argument:
+                        self.checkError(value)
+                        if(isinstance(value, (int, float)) and not isinstance(value, bool)):
+                            total += value
+                else:
+                    total += self.number(argument)
+            return total
+
+        if(name == "ROUND"):
+            if(len(arguments) != 2):
+                raise UnsupportedFormula(name)
+            number = self.number(self.single(arguments[0]))
+            digits = int(self.number(self.single(arguments[1])))
+            # Half away from zero, on the decimal digits Excel shows
+            rounded = Decimal(repr(float(number))).quantize(
+                Decimal(1).scaleb(-digits), rounding=ROUND_HALF_UP)
+            return float(rounded)
+
+        raise UnsupportedFormula(name)
+
+    def single(self, value):
+        """
+        Returns the value of a single cell, ranges can't be used as one.
+
+        """
+
+        if(isinstance(value, list)):
+            raise FormulaError("#VALUE!")
+        return value
+
+    def checkError(self, value):
+        """
+        Raises cached error values of referenced cells.
+
+        """
+
+        if(isinstance(value, str) and value in ERROR_CODES):
+            raise FormulaError(value)
+        return value
+
+    def number(self, value):
+        """
+        Coerces an operand to a number like Excel: empty cells are 0, booleans
+        are 0 or 1 and numeric text is converted.
+
+        """
+
+        self.checkError(value)
+        if(value is None):
+            return 0
+        if(isinstance(value, bool)):
+            return int(value)
+        if(isinstance(value, (int, float))):
+            return value
+        if(isinstance(value, str)):
+            try:
+                return float(value.strip())
+            except ValueError:
+                raise FormulaError("#VALUE!")
+        raise UnsupportedFormula(value)
+
+    def text(self, value):
+        """
+        Coerces an operand to text like Excel.
+
+        """
+
+        self.checkError(value)
+        if(value is None):
+            return ""
+        if(isinstance(value, bool)):
+            return "TRUE" if value else "FALSE"
+        if(isinstance(value, float) and value.is_integer()):
+            return str(int(value))
+        return str(value)
+
+
+class FormulaParser:
+    """
+    Precedence climbing parser turning formula tokens into syntax tree tuples:
+    ("value", value), ("ref", (minColumn, minRow, maxColumn, maxRow)),
+    ("call", name, arguments), ("op", operator, operands) and ("error", text).
+
+    """
+
+    tokens = []
+    position = 0
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        if(self.position < len(self.tokens)):
+            return self.tokens[self.position]
+        return None
+
+    def next(self):
+        token = self.peek()
+        if(token is None):
+            raise UnsupportedFormula("Unexpected end of formula")
+        self.position += 1
+        return token
+
+    def parseExpression(self, minPrecedence):
+        """
+        Parses operators binding at least as tight as supplied precedence.
+
+        """
+
+        left = self.parsePrefix()
+
+        while True:
+            token = self.peek()
+            if(token is None):
+                return left
+            if(token.type == Token.OP_POST and token.value == "%"):
+                if(POSTFIX_PRECEDENCE < minPrecedence):
+                    return left
+                self.next()
+                left = ("op", "%", [left])
+                continue
+            if(token.type != Token.OP_IN):
+                return left
+            precedence = INFIX_PRECEDENCE.get(token.value)
+            if(precedence is None):
+                raise UnsupportedFormula(token.value)
+            if(precedence < minPrecedence):
+                return left
+            self.next()
+            # Excel operators are all left associative
+            right = self.parseExpression(precedence + 1)
+            left = ("op", token.value, [left, right])
+
+    def parsePrefix(self):
+        """
+        Parses an operand with its prefix operators.
+
+        """
+
+        token = self.next()
+
+        if(token.type == Token.OP_PRE):
+            operand = self.parseExpression(PREFIX_PRECEDENCE)
+            return ("op", "neg", [operand]) if token.value == "-" else operand
+
+        if(token.type == Token.PAREN and token.subtype == Token.OPEN):
+            expression = self.parseExpression(0)
+            self.expect(Token.PAREN)
+            return expression
+
+        if(token.type == Token.FUNC and token.subtype == Token.OPEN):
+            name = token.value[:-1].upper()
+            arguments = []
+            closing = self.peek()
+            if(closing is not None and closing.type == Token.FUNC and closing.subtype == Token.CLOSE):
+                self.next()
+                return ("call", name, arguments)
+            while True:
+                arguments.append(self.parseExpression(0))
+                separator = self.next()
+                if(separator.type == Token.FUNC and separator.subtype == Token.CLOSE):
+                    return ("call", name, arguments)
+                if(separator.type != Token.SEP or separator.subtype != Token.ARG):
+                    raise UnsupportedFormula(separator.value)
+
+        if(token.type == Token.OPERAND):
+            return self.parseOperand(token)
+
+        raise UnsupportedFormula(token.value)
+
+    def expect(self, tokenType):
+        token = self.next()
+        if(token.type != tokenType or token.subtype != Token.CLOSE):
+            raise UnsupportedFormula(token.value)
+
+    def parseOperand(self, token):
+        """
+        Parses numbers, texts, booleans, error values and same-sheet references.
+
+        """
+
+        if(token.subtype == Token.NUMBER):
+            value = float(token.value)
+            return ("value", int(value) if value.is_integer() and 'E' not in token.value.upper() else value)
+        if(token.subtype == Token.TEXT):
+            return ("value", token.value[1:-1].replace('""', '"'))
+        if(token.subtype == Token.LOGICAL):
+            return ("value", token.value.upper() == "TRUE")
+        if(token.subtype == Token.ERROR):
+            return ("error", token.value)
+
+        # References to other sheets, names and whole rows/columns aren't supported
+        if('!' in token.value):
+            raise UnsupportedFormula(token.value)
+        try:
+            minColumn, minRow, maxColumn, maxRow = range_boundaries(token.value.replace('$', ''))
+        except (ValueError, TypeError):
+            raise UnsupportedFormula(token.value)
+        if(None in (minColumn, minRow, maxColumn, maxRow)):
+            raise UnsupportedFormula(token.value)
+        return ("ref", (minColumn, minRow, maxColumn, maxRow))
@@ -0,0 +1,136 @@
+"""
+Registry of known estimate header layouts. Estimate files come from a handful
+of template versions, so the column positions found for a pair of header rows
+are remembered under a fingerprint of those rows and reused the next time the
+same layout is seen, skipping column discovery. The fingerprint includes the
+hash of the template schema definition, so layouts found with earlier column
+rules are discovered again once the schema file is edited. Layouts are
+persisted as JSON, e.g.:
+  {"Est. Summary:9b2e04c1d7aa:3f5a...": {"MATERIAL UNIT": 7, "LABOUR UNIT": 9, ...}, ...}
+
+The registry file is kept in the per-user cache directory unless another
+path is supplied, so installed copies of the scripts never write next to
+themselves.
+
+"""
+
+import hashlib
+import json
+import os
+
+
+# Folder of the registry file inside the per-user cache directory
+CACHE_FOLDER = 'estimateExtractors'
+
+
+def defaultRegistryPath():
+    """
+    Returns the registry file used when no other path is supplied, in the
+    per-user cache directory (XDG_CACHE_HOME or ~/.cache, LOCALAPPDATA on
+    Windows).
+
+    """
+
+    if(os.name == 'nt'):
+        cacheDirectory = os.environ.get('LOCALAPPDATA') or os.path.join(
+            os.path.expanduser('~'), 'AppData', 'Local')
+    else:
+        cacheDirectory = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+            os.path.expanduser('~'), '.cache')
+    return os.path.join(cacheDirectory, CACHE_FOLDER, 'headerLayouts.json')
+
+
+class HeaderLayoutRegistry:
+    path = None
+    layouts = {}
+
+    def __init__(self, path=None):
+        self.path = path or defaultRegistryPath()
+        self.layouts = self.loadLayouts()
+
+    def loadLayouts(self):
+        """
+        Reads persisted layouts, returns an empty registry if the file is missing
+        or unreadable.
+
+        """
+
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def fingerprint(self, layoutName, rawHeaderRows, definitionHash=""):
+        """
+        Returns the fingerprint of supplied header rows of the named layout (template
+        schema) with supplied schema definition hash. Trailing empty cells are
+        ignored so the same layout matches regardless of sheet width.
+
+        """
+
+        headers = []
+        for row in rawHeaderRows:
+            row = list(row)
+            while(len(row) > 0 and row[-1] is None):
+                row.pop()
+            headers.append(row)
+
+        digest = hashlib.sha1(repr(headers).encode('utf-8')).hexdigest()
+        return "{}:{}:{}".format(layoutName, definitionHash, digest)
+
+    def lookup(self, fingerprint):
+        """
+        Returns a copy of the column positions of a known layout, or None.
+
+        """
+
+        columns = self.layouts.get(fingerprint)
+        if(columns is None):
+            return None
+        return dict(columns)
+
+    def remember(self, fingerprint, columns):
+        """
+        Adds a newly discovered layout and persists the registry. Layouts saved
+        meanwhile by other processes are kept, except those of the same layout
+        name found with another schema definition, which can't match anymore.
+        Failing to persist isn't an error, the layout is simply discovered again
+        next time.
+
+        """
+
+        self.layouts[fingerprint] = dict(columns)
+
+        try:
+            layouts = self.dropOutdated(self.loadLayouts(), fingerprint)
+            layouts[fingerprint] = dict(columns)
+            directory = os.path.dirname(self.path)
+            if(directory != ""):
+                os.makedirs(directory, exist_ok=True)
+            tempPath = "{}.{}.tmp".format(self.path, os.getpid())
+            with open(tempPath, 'w') as f:
+                json.dump(layouts, f, indent=2, sort_keys=True)
+            os.replace(tempPath, self.path)
+            self.layouts = layouts
+        except OSError:
+            pass
+
+    def dropOutdated(self, layouts, fingerprint):
+        """
+        Returns supplied layouts without those of the layout name of the
+        fingerprint that were found with another schema definition hash.
+
+        """
+
+        layoutName, definitionHash, _ = fingerprint.rsplit(":", 2)
+        kept = {}
+        for key, columns in layouts.items():
+            parts = key.rsplit(":", 2)
+            # Fingerprints without a definition hash predate schema hashing
+            if(len(parts) < 3):
+                parts = [key.rsplit(":", 1)[0], None]
+            if(parts[0] == layoutName and parts[1] != definitionHash):
+                continue
+            kept[key] = columns
+        return kept
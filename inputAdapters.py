@@ -0,0 +1,299 @@
+"""
+Input adapters letting the extraction scripts read estimates that were
+exported as CSV or TSV instead of Excel workbooks, and read estimates from
+stdin or in-memory buffers instead of files on disk. Compiled workbook
+snapshots are read by "snapshots.SnapshotWorkbook" and rows already held in
+memory by "RowSheet". An adapter exposes the
+subset of the openpyxl worksheet interface the scripts use (iter_rows,
+row access by number, column_dimensions/row_dimensions lengths), and rows
+are streamed from the file in the same shape as
+iter_rows(values_only=True): one tuple per row, padded to the sheet width,
+with empty cells as None and numeric text converted to int or float.
+
+"""
+
+import csv
+import io
+import os
+import re
+import sys
+
+
+# Input formats that can be requested explicitly
+INPUT_FORMATS = ("xlsx", "csv", "tsv", "snapshot")
+
+# Formats read as delimited text, with their delimiters
+DELIMITERS = {
+    "csv": ",",
+    "tsv": "\t",
+}
+
+# First bytes of compiled workbook snapshots
+SNAPSHOT_MAGIC = b'ESTSNAP\x00'
+
+# Numbers as Excel would store them; leading zeros (e.g. cost code "012345")
+# mean the cell was text and the value stays a string
+NUMBER_PATTERN = re.compile(
+    r'^[+-]?(?:(?:0|[1-9]\d*)(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?$')
+
+
+def readSource(source):
+    """
+    Returns supplied workbook source in a form both load_workbook and "CsvSheet"
+    accept. "-" reads all of stdin into a buffer, bytes are wrapped in a buffer
+    and streams that can't seek are read into one. Paths and seekable buffers
+    are returned unchanged, so nothing is written to disk.
+
+    """
+
+    if(isinstance(source, str)):
+        if(source == "-"):
+            return io.BytesIO(sys.stdin.buffer.read())
+        return source
+    if(isinstance(source, (bytes, bytearray, memoryview))):
+        return io.BytesIO(source)
+    if(not source.seekable()):
+        return io.BytesIO(source.read())
+    return source
+
+
+def detectFormat(source, inputFormat=None):
+    """
+    Returns the input format of supplied source, one of "INPUT_FORMATS". An
+    explicitly requested format wins, paths are recognized by extension and
+    buffers by content (workbooks are zip archives, snapshots start with their
+    magic, TSV has tabs in its first line).
+
+    """
+
+    if(inputFormat is not None):
+        return inputFormat
+
+    if(isinstance(source, str)):
+        extension = os.path.splitext(source)[1].lower().lstrip('.')
+        return extension if extension in DELIMITERS or extension == "snapshot" else "xlsx"
+
+    position = source.tell()
+    head = source.read(4096)
+    source.seek(position)
+
+    if(head.startswith(b'PK')):
+        return "xlsx"
+    if(head.startswith(SNAPSHOT_MAGIC)):
+        return "snapshot"
+    if(b'\t' in head.split(b'\n', 1)[0]):
+        return "tsv"
+    return "csv"
+
+
+def convertCell(text):
+    """
+    Converts a raw CSV cell to the value openpyxl would return for it.
+
+    """
+
+    if(text == ""):
+        return None
+
+    if(NUMBER_PATTERN.match(text) is None):
+        return text
+    if('.' in text or 'e' in text or 'E' in text):
+        return float(text)
+    return int(text)
+
+
+class CsvCell:
+    """
+    Cell returned by row access, holding the converted value.
+
+    """
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+
+class CsvSheet:
+    source = None
+    delimiter = ","
+    encoding = "utf-8-sig"
+
+    max_row = 0
+    max_column = 0
+
+    def __init__(self, source, delimiter=None, encoding="utf-8-sig"):
+        self.encoding = encoding
+        if(delimiter is None):
+            delimiter = DELIMITERS[detectFormat(source)]
+        self.delimiter = delimiter
+
+        # Path, or the content of a buffer as bytes, so that nested row streams
+        # (e.g. footer lookups during digestion) don't share a file position
+        if(isinstance(source, str)):
+            self.source = source
+        else:
+            source.seek(0)
+            self.source = source.read()
+
+        # File offset of every row start, so streams can begin at any row
+        # without re-parsing the rows before it
+        self.rowOffsets = []
+        self.indexRows()
+
+        # Only the lengths of these are used by the scripts
+        self.row_dimensions = range(self.max_row)
+        self.column_dimensions = range(self.max_column)
+
+    def indexRows(self):
+        """
+        Streams the whole file once, recording row offsets, row count and the
+        width of the widest row.
+
+        """
+
+        with self.openSource() as f:
+            position = [0]
+            reader = csv.reader(self.readLines(f, position),
+                                delimiter=self.delimiter)
+            while True:
+                # The reader pulls lines only as needed, so the position
+                # read so far is where the next row starts
+                offset = position[0]
+                try:
+                    row = next(reader)
+                except StopIteration:
+                    break
+                self.rowOffsets.append(offset)
+                self.max_column = max(self.max_column, len(row))
+
+        self.max_row = len(self.rowOffsets)
+
+    def openSource(self):
+        """
+        Opens a new binary stream over the source.
+
+        """
+
+        if(isinstance(self.source, str)):
+            return open(self.source, 'rb')
+        return io.BytesIO(self.source)
+
+    def readLines(self, f, position):
+        """
+        Yields decoded lines of supplied binary file, adding the byte length of
+        each line to "position[0]".
+
+        """
+
+        for line in f:
+            position[0] += len(line)
+            yield line.decode(self.encoding)
+
+    def iter_rows(self, min_row=1, max_row=None, min_col=1, max_col=None, values_only=False):
+        """
+        Streams rows in the shape openpyxl's Worksheet.iter_rows returns them.
+        Row and column numbers are 1-based and inclusive.
+
+        """
+
+        # Like openpyxl, bounds of 0 (e.g. empty dimension lengths) are unbounded
+        min_row = min_row or 1
+        min_col = min_col or 1
+        max_row = max_row or self.max_row
+        max_col = max_col or self.max_column
+        width = max_col - min_col + 1
+
+        if(min_row > max_row or min_row > self.max_row):
+            # openpyxl yields empty rows for rows past the end of the sheet
+            for _ in range(min_row, max_row + 1):
+                yield self.makeRow([], min_col, width, values_only)
+            return
+
+        with self.openSource() as f:
+            f.seek(self.rowOffsets[min_row - 1])
+            reader = csv.reader(self.readLines(f, [0]),
+                                delimiter=self.delimiter)
+            rowNumber = min_row
+            for raw in reader:
+                if(rowNumber > max_row):
+                    return
+                yield self.makeRow(raw, min_col, width, values_only)
+                rowNumber += 1
+
+        # Rows requested past the end of the file are empty
+        for _ in range(rowNumber, max_row + 1):
+            yield self.makeRow([], min_col, width, values_only)
+
+    def makeRow(self, raw, min_col, width, values_only):
+        """
+        Converts the requested columns of a raw CSV row, padding it to the width.
+
+        """
+
+        values = [convertCell(text) for text in raw[min_col - 1:min_col - 1 + width]]
+        values.extend([None] * (width - len(values)))
+
+        if(values_only):
+            return tuple(values)
+        return tuple(CsvCell(value) for value in values)
+
+    def __getitem__(self, rowNumber):
+        """
+        Returns cells of supplied 1-based row number, like sheet[rowNumber].
+
+        """
+
+        return next(self.iter_rows(min_row=rowNumber, max_row=rowNumber))
+
+
+class RowSheet:
+    """
+    Sheet over rows already read into memory (tuples of cell values starting at
+    row 1), e.g. rows handed to a worker process. Exposes the same interface as
+    "CsvSheet".
+
+    """
+
+    rows = []
+    max_row = 0
+    max_column = 0
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.max_row = len(rows)
+        self.max_column = max((len(row) for row in rows), default=0)
+
+        # Only the lengths of these are used by the scripts
+        self.row_dimensions = range(self.max_row)
+        self.column_dimensions = range(self.max_column)
+
+    def iter_rows(self, min_row=1, max_row=None, min_col=1, max_col=None, values_only=False):
+        """
+        Yields rows in the shape openpyxl's Worksheet.iter_rows returns them.
+        Row and column numbers are 1-based and inclusive.
+
+        """
+
+        # Like openpyxl, bounds of 0 (e.g. empty dimension lengths) are unbounded
+        min_row = min_row or 1
+        min_col = min_col or 1
+        max_row = max_row or self.max_row
+        max_col = max_col or self.max_column
+        width = max_col - min_col + 1
+
+        for rowNumber in range(min_row, max_row + 1):
+            # Rows past the end of the sheet are empty
+            raw = self.rows[rowNumber - 1] if rowNumber <= self.max_row else ()
+            values = tuple(raw[min_col - 1:max_col])
+            if(len(values) < width):
+                values += (None,) * (width - len(values))
+            yield values if values_only else tuple(CsvCell(value) for value in values)
+
+    def __getitem__(self, rowNumber):
+        """
+        Returns cells of supplied 1-based row number, like sheet[rowNumber].
+
+        """
+
+        return next(self.iter_rows(min_row=rowNumber, max_row=rowNumber))
@@ -26,13 +26,42 @@ Script design and implementation by Michal Zarnowski and Hannah Cheng
 """
 
 from openpyxl import load_workbook, Workbook
+from multiprocessing import Pool
+from operator import itemgetter
 import pandas as pd
 import numpy as np
+import argparse
 import sys
 import re
+import contextlib
 import copy
 import json
-from string import ascii_uppercase
+from fnmatch import fnmatchcase
+from zipfile import BadZipFile
+
+from currency import parseAmount, roundToScale, multiplyToCents, centsToNumber
+from costCatalog import CostCatalog
+from errorLocations import cellLocation, compressErrorLocations
+from formulaEvaluator import FormulaEvaluator, hasUncachedFormulas, loadFormulaWorkbook
+from headerLayouts import HeaderLayoutRegistry
+from inputAdapters import CsvSheet, DELIMITERS, INPUT_FORMATS, readSource, detectFormat
+from multiSheet import PROBE_ROWS, discoverSheets, extractSheets, mergeSheets, readSheetRows
+from memoryProfile import MemoryProfiler
+from outputEncoding import OUTPUT_FORMATS, importEncoder, writeDocument
+from priceStatistics import PriceStatistics
+from recordBatches import BatchedDocument, batchPrefix, releaseSegments, segmentName, shareRecords
+from progress import ProgressReporter, writeToStderr
+from snapshots import INCOMPLETE_SNAPSHOT_ERROR, SnapshotWorkbook, loadSnapshot
+from templateSchemas import SchemaRegistry
+
+
+# Rows scanned for the header in preview mode, where sheets are read lazily
+PREVIEW_HEADER_ROWS = 200
+
+
+# Worker process context for parallel digestion, populated once per worker
+# by "initShardWorker" so sheet rows aren't re-sent with every shard
+shardContext = {}
 
 
 class CleanUpML:
@@ -43,9 +72,16 @@ class CleanUpML:
     tempHeader = ""
     tempFooter = ""
     tempFooterIndex = 0
+    # Number of section headers passed so far
+    sectionCount = 0
+    # Rows of the current section are passed over, see "sectionFilter"
+    skipSection = False
 
     cleanData = [{"DATA": "VALID"}]
     errorData = [{"DATA": "INVALID"}]
+    # Records digested by worker processes, held in shared memory until output
+    # (see recordBatches.py)
+    recordBatches = []
     dataTemplate = {
         "CODE": "",
         "COST TYPE": "",
@@ -71,27 +107,165 @@ class CleanUpML:
         "UNITS": 0,
     }
 
+    # Once usable columns are known, rows are read in the narrowest column window
+    # holding them and projected to compact tuples of only the usable cells.
+    # "rowColumns" gives the position of each usable column inside those tuples
+    minColumn = 1
+    maxColumn = 1
+    rowColumns = {}
+    rowGetter = None
+
     masterError = {"ERROR": ""}
 
     # path = 'C:\\Users\\zarnowm\\Documents\\GitHub\\materialLabourConverter\\Template.xlsm'
-    path = sys.argv[1]
-
-    def __init__(self):
-        pass
+    path = None
+
+    # Number of worker processes used to digest sections, 1 digests sequentially
+    workers = 1
+
+    # Number of data errors after which scanning stops, 0 scans the whole sheet
+    errorBudget = 0
+
+    # Known header layouts are reused from the registry file at "layoutsPath"
+    # (default registry file if None) unless "layoutCache" is False
+    layoutCache = True
+    layoutsPath = None
+
+    # Format of the input, one of "INPUT_FORMATS", detected from the path or
+    # content if None
+    inputFormat = None
+
+    # Errors of one field in adjacent cells of a column are reported as a range
+    errorRanges = False
+
+    # Reporter receiving progress events, None if progress isn't reported
+    progress = None
+
+    # Read workbooks through their compiled snapshot
+    snapshot = False
+
+    # Evaluate formulas whose cached results are missing, the workbook source
+    # checked for them and the workbook holding them, loaded on first use
+    evaluateFormulas = True
+    formulaSource = None
+    formulaWorkbook = None
+
+    # Cost-code catalog CSV the codes are checked against, None skips the check
+    catalogPath = None
+    catalog = None
+
+    # Unit-price statistics index the unit prices are checked against, None skips
+    # the check and leaves out the "PRICE OUTLIER" flag
+    priceStatisticsPath = None
+    priceStatistics = None
+
+    # Encoding of the printed document, one of "OUTPUT_FORMATS"
+    outputFormat = "json"
+
+    # Read the workbook lazily (preview mode) and the workbook read that way
+    lazyLoad = False
+    workbook = None
+
+    # Memory profile report file, None if the run isn't profiled, and the profiler
+    memoryProfilePath = None
+    profiler = None
+
+    # Extract every template sheet of the workbook, and the names of those found
+    allSheets = False
+    sheetNames = []
+
+    # Names or wildcard patterns of the sections to extract, matched against their
+    # GROUPING NAME and SUMMARY NAME, None extracts every section
+    sectionFilter = None
+
+    # Known template schemas and the one detected for the current sheet
+    schemas = None
+    schema = None
+
+    def __init__(self, path=None, workers=1, errorBudget=0, layoutCache=True, layoutsPath=None,
+                 inputFormat=None, errorRanges=False, progress=None,
+                 schemaPaths=None, snapshot=False, evaluateFormulas=True,
+                 catalogPath=None, outputFormat="json", sectionFilter=None, allSheets=False,
+                 priceStatisticsPath=None, memoryProfilePath=None):
+        self.path = path
+        self.workers = workers
+        self.errorBudget = errorBudget
+        self.layoutCache = layoutCache
+        self.layoutsPath = layoutsPath
+        self.inputFormat = inputFormat
+        self.errorRanges = errorRanges
+        # Progress callback receives one event dictionary per report
+        self.progress = ProgressReporter(progress) if progress is not None else None
+        self.snapshot = snapshot
+        self.evaluateFormulas = evaluateFormulas
+        self.catalogPath = catalogPath
+        self.priceStatisticsPath = priceStatisticsPath
+        self.memoryProfilePath = memoryProfilePath
+        # Binary encodings need their optional package, fail before extracting
+        if(outputFormat != "json"):
+            importEncoder(outputFormat)
+        self.outputFormat = outputFormat
+        self.sectionFilter = sectionFilter
+        self.allSheets = allSheets
+        # Schema folders searched in addition to the built-in schemas
+        self.schemas = SchemaRegistry('materialLabour', schemaPaths)
+
+        # Give every instance its own copy of the mutable state so several
+        # extractions can run in one process
+        self.cleanData = copy.deepcopy(CleanUpML.cleanData)
+        self.errorData = copy.deepcopy(CleanUpML.errorData)
+        self.recordBatches = []
+        self.usableColumns = copy.deepcopy(CleanUpML.usableColumns)
+        self.masterError = copy.deepcopy(CleanUpML.masterError)
 
     def loadWorkbook(self, path):
         """
-        Loads the Excel workbook and extracts the sheet 'Est. Summary'.
-        Sheet name has to be the exact match to 'Est. Summary'.
+        Loads the Excel workbook and extracts the sheet 'Est. Summary', or the first sheet
+        named by another known template schema. Sheet name has to be an exact match. With
+        "allSheets" set, all template sheets of the workbook are found instead. CSV and TSV
+        exports of the sheet are read directly through "CsvSheet" and compiled
+        snapshots through "SnapshotWorkbook". With "snapshot" set, workbook paths
+        are read through their snapshot, compiled on first use (of every sheet
+        with "allSheets" set, so sheets are also found by header). Path may also
+        be "-" (stdin), workbook bytes or a binary file object.
 
         """
 
         try:
-            wb = load_workbook(filename=path, data_only=True)
-            self.sheet = wb['Est. Summary']
+            source = readSource(path)
+            inputFormat = detectFormat(source, self.inputFormat)
+            if(inputFormat in DELIMITERS):
+                self.sheet = CsvSheet(
+                    source, delimiter=DELIMITERS[inputFormat])
+            else:
+                if(inputFormat == "snapshot"):
+                    wb = SnapshotWorkbook(source)
+                    # Sheets found only by their header are missing from snapshots
+                    # of the template sheets
+                    if(self.allSheets and not wb.holdsAllSheets):
+                        raise ValueError(INCOMPLETE_SNAPSHOT_ERROR)
+                elif(self.snapshot and isinstance(source, str)):
+                    wb = loadSnapshot(source, allSheets=self.allSheets)
+                else:
+                    wb = load_workbook(filename=source, data_only=True,
+                                       read_only=self.lazyLoad)
+                self.workbook = wb
+                if(self.allSheets):
+                    self.sheetNames = discoverSheets(wb, self.schemas, self.probeSheet)
+                    sheetNames = self.sheetNames
+                else:
+                    sheetNames = [name for name in self.schemas.sheetNames()
+                                  if name in wb.sheetnames]
+                self.sheet = wb[sheetNames[0] if len(sheetNames) > 0 else 'Est. Summary']
+                # Workbooks saved without cached formula results get them evaluated
+                # once the usable columns are known, snapshots were evaluated when compiled
+                if(self.evaluateFormulas and not self.lazyLoad and not isinstance(wb, SnapshotWorkbook)):
+                    self.formulaSource = source
         # Handle any possible exceptions resulting from incorrect file format/structure
         except Exception as e:
-            if("file format" in str(e)):
+            if(str(e) == INCOMPLETE_SNAPSHOT_ERROR):
+                self.masterError['ERROR'] = INCOMPLETE_SNAPSHOT_ERROR
+            elif("file format" in str(e) or isinstance(e, BadZipFile)):
                 self.masterError['ERROR'] = 'You have selected an invalid file. The estimate file must be of type .xlsx or .xlsm'
             elif("Worksheet" in str(e)):
                 self.masterError['ERROR'] = 'The file must have a worksheet titled "Est. Summary". Please ensure that worksheet exists in the selected file'
@@ -100,8 +274,7 @@ class CleanUpML:
 
         # If errors occured, print and exit
         if(len(self.masterError['ERROR']) > 0):
-            jsonError = json.dumps(self.masterError)
-            print(jsonError)
+            writeDocument(self.masterError, self.outputFormat)
             exit()
 
     def getHeaderRows(self):
@@ -110,8 +283,14 @@ class CleanUpML:
 
         """
 
-        maxCol = len(self.sheet.column_dimensions)
-        maxRow = len(self.sheet.row_dimensions)
+        if(self.lazyLoad):
+            # Lazily read sheets have no dimension records, only the header area
+            # at the top of the sheet is scanned
+            maxCol = self.sheet.max_column
+            maxRow = min(self.sheet.max_row or PREVIEW_HEADER_ROWS, PREVIEW_HEADER_ROWS)
+        else:
+            maxCol = len(self.sheet.column_dimensions)
+            maxRow = len(self.sheet.row_dimensions)
 
         # Create a map of the excel file in usable format
         text = []
@@ -122,92 +301,138 @@ class CleanUpML:
                                           values_only=True):
             text.append(value)
 
-        # Scan the map for cell containing "CS" which indicates first cell of the header
-        for i in text:
-            for j in i:
-                if j == 'CS':
-                    # File data starts after two headers
-                    self.startRowIndex = text.index(i) + 3
-                    self.rowIndex = text.index(i) + 3
-
-        # If "CS" wasn't found, return an error and exit, otherwise proceed to find required columns
-        if(self.startRowIndex == 0):
-            self.masterError['ERROR'] = 'Column Heading error, please ensure the template header structure is unchanged. Missing header: CS CODE'
-            jsonError = json.dumps(self.masterError)
-            print(jsonError)
+        # Find the template schema by its header marker (e.g. "CS"), scanning the map once
+        markerRow = self.detectSchema(text)
+
+        # If no marker was found, return an error and exit, otherwise proceed to find required columns
+        if(markerRow is None):
+            self.masterError['ERROR'] = 'Column Heading error, please ensure the template header structure is unchanged. Missing header: ' + \
+                ', '.join(schema.markerName for schema in self.schemas.schemas)
+            writeDocument(self.masterError, self.outputFormat)
             exit()
         else:
+            # File data starts after the header rows
+            self.startRowIndex = markerRow + self.schema.dataOffset
+            self.rowIndex = markerRow + self.schema.dataOffset
             self.findUsableColumns(
-                text[self.startRowIndex - 3], text[self.startRowIndex - 2])
+                self.schemas.headerRows(self.schema, markerRow, text) or [])
+            self.projectColumns()
 
-    def findUsableColumns(self, rawHeaderOne, rawHeaderTwo):
+    def probeSheet(self, sheet):
         """
-        Extracts the column position of all columns required for script's functionality.
+        Checks if the top rows of supplied sheet hold the header of a known
+        template schema with all required columns. Returns True or False.
 
         """
 
-        # Clean header rows of white spaces
-        headerRowOne = self.stripWhiteSpaces(rawHeaderOne)
-        headerRowTwo = self.stripWhiteSpaces(rawHeaderTwo)
+        text = readSheetRows(sheet, min(sheet.max_row or PROBE_ROWS, PROBE_ROWS))
+        schema, markerRow = self.schemas.detect(
+            text, self.stripWhiteSpaces, list(CleanUpML.usableColumns))
+        if(schema is None):
+            return False
+        headerRows = self.schemas.headerRows(schema, markerRow, text)
+        if(headerRows is None):
+            return False
+        _, missing = schema.resolveColumns(
+            [self.stripWhiteSpaces(row) for row in headerRows], list(CleanUpML.usableColumns))
+        return len(missing) == 0
+
+    def detectSchema(self, text):
+        """
+        Selects the template schema matching supplied sheet map and returns the
+        0-based row of its header marker, or None if no known marker was found.
 
-        # MATERIAL UNIT COLUMN
-        # Look for "MAT." in first header row
-        if("MAT." in headerRowOne):
-            self.usableColumns['MATERIAL UNIT'] = headerRowOne.index("MAT.")
+        """
 
-        # LABOUR UNIT COLUMN
-        # Look for "LABUNIT" in first header row
-        if("LABUNIT" in headerRowOne):
-            self.usableColumns['LABOUR UNIT'] = headerRowOne.index("LABUNIT")
+        self.schema, markerRow = self.schemas.detect(
+            text, self.stripWhiteSpaces, list(CleanUpML.usableColumns))
+        return markerRow
 
-        # LOCATION COLUMN
-        # Look for "LOCATION" in second header row
-        if("LOCATION" in headerRowTwo):
-            self.usableColumns['LOCATION'] = headerRowTwo.index(
-                "LOCATION")
+    def evaluateMissingFormulas(self):
+        """
+        Fills in usable columns of the data rows whose formulas have no cached
+        results, so they are digested as if the workbook had been recalculated.
+        Only the part of the sheet is scanned for them, the workbook is loaded
+        with its formulas if any usable column has one.
+
+        """
+
+        if(self.formulaSource is None or not hasUncachedFormulas(
+                self.formulaSource, [self.sheet.title], self.usableColumns.values())):
+            return
 
-        # PHASE COLUMN
-        # Look for "PHASE" in second header row
-        if("PHASE" in headerRowTwo):
-            self.usableColumns['PHASE'] = headerRowTwo.index(
-                "PHASE")
+        if(self.formulaWorkbook is None):
+            self.formulaWorkbook = loadFormulaWorkbook(self.formulaSource)
+        evaluator = FormulaEvaluator(self.sheet, self.formulaWorkbook[self.sheet.title])
+        evaluator.evaluateColumns(self.usableColumns.values(), self.startRowIndex)
 
-        # CODE COLUMN
-        # Check if "CODE" in cell after "PHASE" cell in second header row
-        if(headerRowTwo[self.usableColumns['PHASE'] + 1] == "CODE"):
-            self.usableColumns['CODE'] = self.usableColumns['PHASE'] + 1
+    def projectColumns(self):
+        """
+        Works out the narrowest column window holding all usable columns and how
+        rows read in that window are projected to compact tuples of usable cells.
 
-        # DESCRIPTION COLUMN
-        # Look for "DESCRIPTION" in second header row
-        if("DESCRIPTION" in headerRowTwo):
-            self.usableColumns['DESCRIPTION'] = headerRowTwo.index(
-                "DESCRIPTION")
+        """
 
-        # QTY COLUMN
-        # Look for "QTY." in second header row
-        if("QTY." in headerRowTwo):
-            self.usableColumns['QTY'] = headerRowTwo.index(
-                "QTY.")
+        columns = sorted(set(self.usableColumns.values()))
 
-        # UNITS COLUMN
-        # Check if only one column between "QTY" and "DESCRIPTION"
-        if((self.usableColumns['DESCRIPTION'] - self.usableColumns['QTY']) == 2):
-            self.usableColumns['UNITS'] = self.usableColumns['QTY'] + 1
+        # Window is 1-based and inclusive, like iter_rows arguments
+        self.minColumn = columns[0] + 1
+        self.maxColumn = columns[-1] + 1
 
-        # If any columns were invalid, add to missingColumnList
-        missingColumnList = []
+        self.rowColumns = {}
         for key, value in self.usableColumns.items():
-            if(value == 0):
-                missingColumnList.append(key)
+            self.rowColumns[key] = columns.index(value)
+
+        self.rowGetter = itemgetter(*[column - columns[0] for column in columns])
+
+    def iterProjectedRows(self, minRow):
+        """
+        Yields compact tuples of the usable cells of all rows starting at supplied
+        row number.
+
+        """
+
+        return map(self.rowGetter, self.sheet.iter_rows(min_row=minRow,
+                                                        min_col=self.minColumn,
+                                                        max_col=self.maxColumn,
+                                                        values_only=True))
+
+    def findUsableColumns(self, rawHeaderRows):
+        """
+        Extracts the column position of all columns required for script's functionality,
+        following the column rules of the detected template schema.
+
+        """
+
+        # Reuse column positions of a known header layout
+        if(self.layoutCache):
+            registry = HeaderLayoutRegistry(self.layoutsPath)
+            fingerprint = registry.fingerprint(self.schema.name, rawHeaderRows,
+                                               self.schema.definitionHash)
+            knownColumns = registry.lookup(fingerprint)
+            if(knownColumns is not None):
+                self.usableColumns = knownColumns
+                return
+
+        # Clean header rows of white spaces and resolve columns
+        headerRows = [self.stripWhiteSpaces(row) for row in rawHeaderRows]
+        columns, missingColumnList = self.schema.resolveColumns(
+            headerRows, list(CleanUpML.usableColumns))
+        self.usableColumns.update(columns)
+
+        # If any columns were invalid, list them in the error message
         missingColumns = ', '.join(missingColumnList)
 
         # Print error message with missing columns and exit
         if(len(missingColumnList) > 0):
             self.masterError['ERROR'] = 'Column Heading error, please ensure the template header structure is unchanged. Missing headers: ' + missingColumns
-            jsonError = json.dumps(self.masterError)
-            print(jsonError)
+            writeDocument(self.masterError, self.outputFormat)
             exit()
 
+        # Remember newly seen layout
+        if(self.layoutCache):
+            registry.remember(fingerprint, self.usableColumns)
+
     def stripWhiteSpaces(self, input):
         """
         Strips all white spaces from entities inside supplied list
@@ -231,36 +456,298 @@ class CleanUpML:
 
         """
 
+        if(self.progress is not None):
+            self.progress.start(self.sheet.max_row - self.startRowIndex + 1)
+
+        with self.phase("digest"):
+            if(self.workers > 1):
+                self.digestRowsParallel()
+            else:
+                # Digest all workable rows
+                for _ in self.iterDigestRows():
+                    pass
+
+        # Report no more errors than the budget allows
+        if(self.errorBudget > 0):
+            del self.errorData[self.errorBudget + 1:]
+
+        # Collapse errors in adjacent cells of one column into ranges
+        if(self.errorRanges):
+            self.errorData = compressErrorLocations(self.errorData)
+
+        if(self.progress is not None):
+            self.reportProgress(final=True)
+
+        # Write output in the selected format (JSON by default)
+        with self.phase("output"):
+            if(len(self.errorData) > 1):
+                writeDocument(self.errorData, self.outputFormat)
+            elif(len(self.recordBatches) > 0):
+                writeDocument(BatchedDocument(self.cleanData[0], self.recordBatches), self.outputFormat)
+            else:
+                writeDocument(self.cleanData, self.outputFormat)
+
+        # SAVE OUTPUT IN TXT
+        # f = open('output.txt', 'w')
+        # print(jsonData, file=f)
+
+    def iterDigestRows(self):
+        """
+        Digests workable rows lazily, yielding after each row. Created dictionaries
+        and errors are collected in "cleanData" and "errorData", so callers can stop
+        early without the rest of the sheet being read.
+
+        """
+
+        # Rows preceeding the first header belong to an unnamed section
+        self.skipSection = not self.sectionSelected(self.tempHeader, self.tempFooter)
+
         # Iterate over all workable rows
-        for row in self.sheet.iter_rows(min_row=self.startRowIndex, values_only=True):
+        for row in self.iterProjectedRows(self.startRowIndex):
+
+            # Stop scanning once the error budget is used up
+            if(self.errorBudgetReached()):
+                return
+
+            # Report progress, the reporter limits how often
+            if(self.progress is not None and self.rowIndex - self.startRowIndex >= self.progress.nextCheckRow):
+                self.reportProgress()
+
+            # Pass over rows of a skipped section up to its footer
+            if(self.skipSection and self.rowIndex <= self.tempFooterIndex):
+                self.rowIndex += 1
+                yield
+                continue
 
             # Skip empty row
             emptyRow = self.checkIfEmptyRow(row)
             if(emptyRow):
                 self.rowIndex += 1
-                continue
             # Skip footer and footer preceeding row
             elif(self.rowIndex == self.tempFooterIndex or self.rowIndex == (self.tempFooterIndex - 1)):
                 self.rowIndex += 1
-                continue
             else:
-                if(not self.checkIfHeaderRow(row)):
+                if(self.checkIfHeaderRow(row)):
+                    self.skipSection = not self.sectionSelected(self.tempHeader, self.tempFooter)
+                elif(not self.skipSection):
                     self.createLabourObj(row)
                     self.createMaterialObj(row)
                 self.rowIndex += 1
 
-        # Convert output to JSON format and print
-        jsonData = json.dumps(self.cleanData)
-        jsonErrors = json.dumps(self.errorData)
+            yield
+
+    def preview(self, limit=50, sections=None):
+        """
+        Digests rows only until "limit" cost codes were created (no limit if None) or,
+        with "sections", until the first that many sections were digested. Returns the preview
+        document with a flag telling if the sheet continues and the row count
+        estimated from the sheet dimensions, e.g.:
+          {"DATA": "PREVIEW", "RECORDS": [...], "ERRORS": [...], "MORE": true, "ESTIMATED ROWS": 1200}
+
+        """
+
+        digested = self.iterDigestRows()
+        more = False
+        for _ in digested:
+            # Header of the first section past the limit was reached
+            if(sections is not None and self.sectionCount > sections):
+                more = True
+                break
+            if(limit is not None and len(self.cleanData) - 1 >= limit):
+                # Digest one more row to tell if the sheet continues
+                more = next(digested, StopIteration) is not StopIteration
+                break
+        digested.close()
+
+        # Collapse errors in adjacent cells of one column into ranges
+        errors = self.errorData
+        if(self.errorRanges):
+            errors = compressErrorLocations(errors)
+
+        records = self.cleanData[1:] if limit is None else self.cleanData[1:limit + 1]
+        return {"DATA": "PREVIEW",
+                "RECORDS": records,
+                "ERRORS": errors[1:],
+                "MORE": more or len(records) < len(self.cleanData) - 1,
+                "ESTIMATED ROWS": self.estimateRowCount()}
+
+    def estimateRowCount(self):
+        """
+        Returns the number of workable rows estimated from the sheet dimensions,
+        without reading the rows.
+
+        """
+
+        return max(0, (self.sheet.max_row or 0) - self.startRowIndex + 1)
+
+    def digestRowsParallel(self):
+        """
+        Digests workable rows across "self.workers" processes. Section boundaries are
+        found first in a single pass, then sections are validated and converted in
+        contiguous shards and the results are merged back in sheet order, so output
+        is identical to the sequential digestion. Workers pass the records back
+        encoded in shared memory, see recordBatches.py.
+
+        """
+
+        rows = list(self.iterProjectedRows(self.startRowIndex))
+        sections = [section for section in self.buildSections(rows)
+                    if self.sectionSelected(section[0], section[1])]
+
+        # Split sections into contiguous shards of roughly equal row counts,
+        # a few per worker so one slow shard doesn't hold up the rest
+        totalRows = sum(len(rowIndexes) for _, _, rowIndexes in sections)
+        shardSize = max(1, totalRows // (self.workers * 4))
+        shards = []
+        shard = []
+        shardRows = 0
+        for section in sections:
+            shard.append(section)
+            shardRows += len(section[2])
+            if(shardRows >= shardSize):
+                shards.append(shard)
+                shard = []
+                shardRows = 0
+        if(len(shard) > 0):
+            shards.append(shard)
+
+        prefix = batchPrefix()
+        completed = False
+        try:
+            with Pool(self.workers, initializer=initShardWorker,
+                      initargs=(self.usableColumns, self.startRowIndex, rows, self.errorBudget,
+                                self.catalog, self.priceStatistics, self.outputFormat, prefix)) as pool:
+                # Merge shard outputs in sheet order, remaining shards are cancelled
+                # once the error budget is used up
+                self.rowIndex = self.startRowIndex
+                for shard, (shardBatch, shardErrors) in zip(shards, pool.imap(digestShard, enumerate(shards))):
+                    self.recordBatches.append(shardBatch)
+                    self.errorData.extend(shardErrors)
+                    if(self.errorBudgetReached()):
+                        break
+
+                    # Report progress up to the last row of the merged shard
+                    self.sectionCount += len(shard)
+                    for _, _, rowIndexes in reversed(shard):
+                        if(len(rowIndexes) > 0):
+                            self.rowIndex = rowIndexes[-1] + 1
+                            break
+                    if(self.progress is not None):
+                        self.reportProgress(sectionOpen=False)
+                else:
+                    self.rowIndex = self.startRowIndex + len(rows)
+            completed = len(self.errorData) == 1
+        finally:
+            # Records aren't written if errors were found or the run failed,
+            # segments of shards left unread are released as well
+            if(not completed):
+                self.recordBatches = []
+                releaseSegments(prefix, len(shards))
+
+    def buildSections(self, rows):
+        """
+        Walks supplied rows the same way "digestRows" does, without converting them,
+        and returns a list of sections in sheet order. Each section is a tuple of its
+        grouping name, summary name and the row indexes of its cost code rows.
+
+        """
+
+        sections = []
+        sectionRows = None
 
-        if(len(self.errorData) > 1):
-            print(jsonErrors)
+        for position, row in enumerate(rows):
+            self.rowIndex = self.startRowIndex + position
+
+            # Skip empty row
+            if(self.checkIfEmptyRow(row)):
+                continue
+            # Skip footer and footer preceeding row
+            elif(self.rowIndex == self.tempFooterIndex or self.rowIndex == (self.tempFooterIndex - 1)):
+                continue
+
+            # Header row opens a new section
+            description = row[self.rowColumns['DESCRIPTION']]
+            if(description is not None and isinstance(description, str) and description.isupper()):
+                self.tempHeader = description
+                self.findSiblingFooterInRows(rows, position)
+                sectionRows = []
+                sections.append((self.tempHeader, self.tempFooter, sectionRows))
+            else:
+                # Rows preceeding the first header belong to an unnamed section
+                if(sectionRows is None):
+                    sectionRows = []
+                    sections.append((self.tempHeader, self.tempFooter, sectionRows))
+                sectionRows.append(self.rowIndex)
+
+        self.rowIndex = self.startRowIndex + len(rows)
+        return sections
+
+    def findSiblingFooterInRows(self, rows, position):
+        """
+        Same as "findSiblingFooter", but scans already loaded rows starting at
+        supplied position instead of re-reading the sheet.
+
+        """
+
+        descColumn = self.rowColumns['DESCRIPTION']
+
+        for tempPosition in range(position, len(rows)):
+            description = rows[tempPosition][descColumn]
+            # If value in description column containes minimu of 3 "*", next row is the footer
+            if description is not None and '***' in description:
+                # Assign section footer, footer row may lie past the last loaded row
+                if(tempPosition + 1 < len(rows)):
+                    self.tempFooter = rows[tempPosition + 1][descColumn]
+                else:
+                    self.tempFooter = None
+                # Assign section footer index
+                self.tempFooterIndex = self.startRowIndex + tempPosition + 1
+                return
+
+    def reportProgress(self, final=False, sectionOpen=True):
+        """
+        Passes rows processed, sections completed and errors found so far to the
+        progress reporter. "sectionOpen" tells whether the section of the current
+        row is still in progress, which isn't the case between merged shards.
+
+        """
+
+        rows = self.rowIndex - self.startRowIndex
+        errors = len(self.errorData) - 1
+
+        if(final):
+            self.progress.finish(rows, self.sectionCount, errors)
         else:
-            print(jsonData)
+            # Section of the current row may still be in progress
+            completed = self.sectionCount - 1 if sectionOpen else self.sectionCount
+            self.progress.update(rows, max(0, completed), errors)
 
-        # SAVE OUTPUT IN TXT
-        # f = open('output.txt', 'w')
-        # print(jsonData, file=f)
+    def sectionSelected(self, groupingName, summaryName):
+        """
+        Checks supplied section names against the section filter. Returns True if
+        there is no filter or either name matches one of its names or wildcard
+        patterns (case insensitive), False otherwise.
+
+        """
+
+        if(self.sectionFilter is None):
+            return True
+        for name in (groupingName, summaryName):
+            if(not isinstance(name, str)):
+                continue
+            for pattern in self.sectionFilter:
+                if(fnmatchcase(name.strip().upper(), pattern.strip().upper())):
+                    return True
+        return False
+
+    def errorBudgetReached(self):
+        """
+        Returns True if an error budget is set and the number of data errors
+        found so far has reached it, False otherwise.
+
+        """
+
+        return self.errorBudget > 0 and len(self.errorData) - 1 >= self.errorBudget
 
     def checkIfEmptyRow(self, row):
         """
@@ -269,8 +756,8 @@ class CleanUpML:
 
         """
         # Loop through all usable columns to check for cell values.
-        for i in range(0, 22):
-            if row[i] is not None:
+        for value in row:
+            if value is not None:
                 return False
         return True
 
@@ -282,10 +769,11 @@ class CleanUpML:
 
         """
         # If value in description column is not null and a upper case String, this is a header row
-        if(row[self.usableColumns['DESCRIPTION']] is not None and
-           isinstance(row[self.usableColumns['DESCRIPTION']], str) and row[self.usableColumns['DESCRIPTION']].isupper()):
+        if(row[self.rowColumns['DESCRIPTION']] is not None and
+           isinstance(row[self.rowColumns['DESCRIPTION']], str) and row[self.rowColumns['DESCRIPTION']].isupper()):
             # Assign section header
-            self.tempHeader = row[self.usableColumns['DESCRIPTION']]
+            self.tempHeader = row[self.rowColumns['DESCRIPTION']]
+            self.sectionCount += 1
             # Find section footer
             self.findSiblingFooter()
             return True
@@ -300,11 +788,13 @@ class CleanUpML:
         """
 
         tempRowIndex = self.rowIndex
+        descColumn = self.usableColumns['DESCRIPTION'] + 1
 
-        # Loop through rows starting on current row
-        for row in self.sheet.iter_rows(min_row=self.rowIndex, values_only=True):
+        # Loop through description cells starting on current row
+        for (description,) in self.sheet.iter_rows(min_row=self.rowIndex, min_col=descColumn,
+                                                   max_col=descColumn, values_only=True):
             # If value in description column containes minimu of 3 "*", next row is the footer
-            if row[self.usableColumns['DESCRIPTION']] is not None and '***' in row[self.usableColumns['DESCRIPTION']]:
+            if description is not None and '***' in description:
                 # Assign section footer
                 self.tempFooter = self.sheet[tempRowIndex +
                                              1][self.usableColumns['DESCRIPTION']].value
@@ -321,21 +811,21 @@ class CleanUpML:
         """
 
         try:
-            # Get labour unit price column index
+            # Get labour unit price column index and cell value
             labourUnitPriceCol = self.usableColumns['LABOUR UNIT']
+            labourUnitPrice = row[self.rowColumns['LABOUR UNIT']]
 
             # If labour unit price column contains dashes "-", return without making labour obj
-            if(re.search(r'^[\-]*$', str(row[labourUnitPriceCol])) is not None):
+            if(re.search(r'^[\-]*$', str(labourUnitPrice)) is not None):
                 return
             else:
                 # Check if labour unit cell contains a valid currency value
-                validLabourUnitPrice = self.validateUnitPrice(
-                    row[labourUnitPriceCol])
+                validLabourUnitPrice = self.validateUnitPrice(labourUnitPrice)
 
                 # If invalid, create error dictionary and add to class' errorData
                 if(not validLabourUnitPrice):
                     errorDict = {"FIELD": "LABOUR UNIT PRICE",
-                                 "LOCATION": "{}{}".format(ascii_uppercase[labourUnitPriceCol], self.rowIndex)}
+                                 "LOCATION": cellLocation(labourUnitPriceCol, self.rowIndex)}
                     # Only add if not already in the list (potential duplicate if row contains
                     # labour and material cost code)
                     if(errorDict not in self.errorData):
@@ -355,21 +845,22 @@ class CleanUpML:
         """
 
         try:
-            # Get material unit price column index
+            # Get material unit price column index and cell value
             materialUnitPriceCol = self.usableColumns['MATERIAL UNIT']
+            materialUnitPrice = row[self.rowColumns['MATERIAL UNIT']]
 
             # If labour unit price column contains dashes "-", return without making labour obj
-            if(re.search(r'^[\-]*$', str(row[materialUnitPriceCol])) is not None):
+            if(re.search(r'^[\-]*$', str(materialUnitPrice)) is not None):
                 return
             else:
                 # Check if material unit cell contains a valid currency value
                 validMaterialUnitPrice = self.validateUnitPrice(
-                    row[materialUnitPriceCol])
+                    materialUnitPrice)
 
                 # If invalid, create error dictionary and add to class' errorData
                 if(not validMaterialUnitPrice):
                     errorDict = {"FIELD": "MATERIAL UNIT PRICE",
-                                 "LOCATION": "{}{}".format(ascii_uppercase[materialUnitPriceCol], self.rowIndex)}
+                                 "LOCATION": cellLocation(materialUnitPriceCol, self.rowIndex)}
                     # Only add if not already in the list (potential duplicate if row contains
                     # labour and material cost code)
                     if(errorDict not in self.errorData):
@@ -390,45 +881,71 @@ class CleanUpML:
 
         # Determine column position of unit price based on cost type
         if(objType == "Labour"):
-            unitPriceColumn = self.usableColumns['LABOUR UNIT']
+            unitPriceColumn = self.rowColumns['LABOUR UNIT']
         else:
-            unitPriceColumn = self.usableColumns['MATERIAL UNIT']
+            unitPriceColumn = self.rowColumns['MATERIAL UNIT']
 
         # VALIDATION
-        validRow = self.validateRow(row, unitPriceColumn)
+        validRow = self.validateRow(row, unitPriceColumn, objType)
         # If validation failed, return without adding row to cleanData
         if(not validRow):
             return
 
+        # With an error budget the output is INVALID once any error was found,
+        # so rows are only validated from then on
+        if(self.errorBudget > 0 and len(self.errorData) > 1):
+            return
+
+        # Rows without quantity carry no estimate amount
+        rawQty = row[self.rowColumns['QTY']]
+        if(rawQty is None):
+            return
+
+        # Parse quantity and unit price into exact fixed-point values, amounts
+        # are computed and rounded to cents in integer arithmetic
+        rawUnitPrice = row[unitPriceColumn]
+        qty = parseAmount(rawQty)
+        unitPrice = parseAmount(rawUnitPrice)
+        # Amounts computed from integer cells only are written as integers
+        integralQty = isinstance(rawQty, int)
+        integralAmount = integralQty and isinstance(rawUnitPrice, int)
+
         try:
             # Create new copy of dictionary template
             newObj = copy.deepcopy(self.dataTemplate)
 
             # Convert code to 'dd dd dd' format
-            rawCode = row[self.usableColumns['CODE']
+            rawCode = row[self.rowColumns['CODE']
                           ].replace(" ", "").replace("-", "")  # Change code to [dddddd] format
             code = rawCode[:2] + " " + rawCode[2:-2] + " " + rawCode[-2:]
 
             # Assign appropriate dictionary values
             newObj["CODE"] = code
             newObj["COST TYPE"] = objType
-            newObj["PHASE"] = row[self.usableColumns['PHASE']]
-            newObj["LOCATION"] = row[self.usableColumns['LOCATION']]
-            newObj["DESCRIPTION"] = row[self.usableColumns['DESCRIPTION']]
-            newObj["QTY."] = round(row[self.usableColumns['QTY']], 2)
-            newObj["UNITS"] = row[self.usableColumns['UNITS']]
-            newObj["UNIT PRICE"] = round(row[unitPriceColumn], 2)
-            newObj["ESTIMATED AMOUNT"] = round(
-                row[self.usableColumns['QTY']] * row[unitPriceColumn], 2)
+            newObj["PHASE"] = row[self.rowColumns['PHASE']]
+            newObj["LOCATION"] = row[self.rowColumns['LOCATION']]
+            newObj["DESCRIPTION"] = row[self.rowColumns['DESCRIPTION']]
+            newObj["QTY."] = centsToNumber(
+                roundToScale(qty[0], qty[1], 2), integralQty)
+            newObj["UNITS"] = row[self.rowColumns['UNITS']]
+            newObj["UNIT PRICE"] = centsToNumber(roundToScale(
+                unitPrice[0], unitPrice[1], 2), isinstance(rawUnitPrice, int))
+            newObj["ESTIMATED AMOUNT"] = centsToNumber(
+                multiplyToCents(qty, unitPrice), integralAmount)
             newObj["GROUPING NAME"] = self.tempHeader
             newObj["SUMMARY NAME"] = self.tempFooter
 
+            # Flag unit prices deviating strongly from company history
+            if(self.priceStatistics is not None):
+                newObj["PRICE OUTLIER"] = self.priceStatistics.checkPrice(
+                    code, objType, newObj["UNIT PRICE"])
+
             # Add new dictionary to class list
             self.cleanData.append(newObj)
         except:
             pass
 
-    def validateRow(self, row, unitPriceColumn):
+    def validateRow(self, row, unitPriceColumn, objType):
         """
         Applies validation rules to each cell in supplied row. If all validations pass,
         True is returned, False otherwise."
@@ -439,25 +956,36 @@ class CleanUpML:
 
         # Validate COST CODE
         codeColumn = self.usableColumns['CODE']
-        validCode = self.validateCode(row[codeColumn])
+        validCode = self.validateCode(row[self.rowColumns['CODE']])
         # If invalid, create error dictionary and add to class' errorData
         if(not validCode):
             errorDict = {"FIELD": "CODE",
-                         "LOCATION": "{}{}".format(ascii_uppercase[codeColumn], self.rowIndex)}
+                         "LOCATION": cellLocation(codeColumn, self.rowIndex)}
             # Only add if not already in the list (potential duplicate if row contains
             # labour and material cost code)
             if(errorDict not in self.errorData):
                 self.errorData.append(errorDict)
 
             valid = False
+        # Check a well-formed code against the catalog, if one was supplied
+        elif(self.catalog is not None):
+            catalogField = self.catalog.checkCode(row[self.rowColumns['CODE']], objType)
+            if(catalogField is not None):
+                errorDict = {"FIELD": catalogField,
+                             "LOCATION": cellLocation(codeColumn, self.rowIndex)}
+                # Only add if not already in the list
+                if(errorDict not in self.errorData):
+                    self.errorData.append(errorDict)
+                valid = False
 
         # Validate DESCRIPTION
         descColumn = self.usableColumns['DESCRIPTION']
-        validDescription = self.validateDescription(row[descColumn])
+        validDescription = self.validateDescription(
+            row[self.rowColumns['DESCRIPTION']])
         # If invalid, create error dictionary and add to class' errorData
         if(not validDescription):
             errorDict = {"FIELD": "DESCRIPTION",
-                         "LOCATION": "{}{}".format(ascii_uppercase[descColumn], self.rowIndex)}
+                         "LOCATION": cellLocation(descColumn, self.rowIndex)}
             # Only add if not already in the list (potential duplicate if row contains
             # labour and material cost code)
             if(errorDict not in self.errorData):
@@ -467,11 +995,11 @@ class CleanUpML:
 
         # Validate QUANTITY
         qtyColumn = self.usableColumns['QTY']
-        validQty = self.validateQty(row[qtyColumn])
+        validQty = self.validateQty(row[self.rowColumns['QTY']])
         # If invalid, create error dictionary and add to class' errorData
         if(not validQty):
             errorDict = {"FIELD": "QUANTITY",
-                         "LOCATION": "{}{}".format(ascii_uppercase[qtyColumn], self.rowIndex)}
+                         "LOCATION": cellLocation(qtyColumn, self.rowIndex)}
             # Only add if not already in the list (potential duplicate if row contains
             # labour and material cost code)
             if(errorDict not in self.errorData):
@@ -535,27 +1063,285 @@ class CleanUpML:
 
         """
 
-        if(unitPrice is None):
-            return False
-
         # Match currency amount (cents optional), optional thousands separators, optional multi-digit fraction, optional brackets surrounding sum
-        validUnitPrice = re.search(
-            r'^[$|(|($]?[+-]?[$]?[0-9]{1,3}(?:,?[0-9]{3})*(?:\.[0-9]*)?[)]?$', str(unitPrice))
-        if(validUnitPrice is not None):
-            return True
+        return parseAmount(unitPrice) is not None
 
-        return False
+    def loadCatalog(self):
+        """
+        Loads the cost-code catalog, compiling its lookup index if needed.
 
-    def main(self):
+        """
+
+        if(self.catalogPath is None):
+            return
+
+        try:
+            self.catalog = CostCatalog(self.catalogPath)
+        except (OSError, ValueError) as e:
+            self.masterError['ERROR'] = 'The cost code catalog could not be read: ' + str(e)
+            writeDocument(self.masterError, self.outputFormat)
+            exit()
+
+    def loadPriceStatistics(self):
+        """
+        Loads the unit-price statistics index.
+
+        """
+
+        if(self.priceStatisticsPath is None):
+            return
+
+        try:
+            self.priceStatistics = PriceStatistics(self.priceStatisticsPath)
+        except (OSError, ValueError, KeyError) as e:
+            self.masterError['ERROR'] = 'The unit price statistics could not be read: ' + str(e)
+            writeDocument(self.masterError, self.outputFormat)
+            exit()
+
+    def mainPreview(self, limit=50, sections=None):
+        """
+        Runs the extraction in preview mode and returns the preview document. The
+        workbook is read lazily, only as far as the previewed rows, so the time to
+        preview doesn't depend on the size of the workbook. Formulas without cached
+        results aren't evaluated in preview mode.
 
+        """
+
+        self.lazyLoad = True
+        self.loadCatalog()
+        self.loadPriceStatistics()
         self.loadWorkbook(path=self.path)
-        self.getHeaderRows()
-        self.digestRows()
+        try:
+            self.getHeaderRows()
+            return self.preview(limit, sections)
+        finally:
+            if(self.workbook is not None):
+                self.workbook.close()
+
+    def sheetExtractor(self, sheetName):
+        """
+        Returns an extractor of one template sheet of the loaded workbook, sharing
+        the options of this one. Master errors it reports name the sheet.
+
+        """
+
+        extractor = copy.copy(self)
+        extractor.usableColumns = copy.deepcopy(CleanUpML.usableColumns)
+        extractor.masterError = {"ERROR": "", "SHEET": sheetName}
+        if(len(self.sheetNames) > 0):
+            extractor.sheet = self.workbook[sheetName]
+        return extractor
+
+    def phase(self, name):
+        """
+        Returns the context recording the named phase of the run in the memory
+        profile, or a context doing nothing if the run isn't profiled.
+
+        """
+
+        if(self.profiler is None):
+            return contextlib.nullcontext()
+        return self.profiler.phase(name)
+
+    def mainAllSheets(self):
+        """
+        Extracts every template sheet of the workbook from a single workbook open.
+        Headers are found here, sheets are then digested concurrently and the merged
+        output, tagged with sheet names and holding per-sheet rollups, is printed
+        (see multiSheet.py).
+
+        """
+
+        with self.phase("load"):
+            self.loadCatalog()
+            self.loadPriceStatistics()
+            self.loadWorkbook(path=self.path)
+
+        # CSV and TSV exports hold a single sheet
+        sheetNames = self.sheetNames or self.schemas.sheetNames()[:1]
+
+        jobs = []
+        with self.phase("header"):
+            for sheetName in sheetNames:
+                extractor = self.sheetExtractor(sheetName)
+                extractor.getHeaderRows()
+                extractor.evaluateMissingFormulas()
+                # Sheets extracted next share the workbook loaded with formulas
+                self.formulaWorkbook = extractor.formulaWorkbook
+                attributes = {"usableColumns": extractor.usableColumns,
+                              "startRowIndex": extractor.startRowIndex,
+                              "rowIndex": extractor.rowIndex,
+                              "errorBudget": self.errorBudget,
+                              "catalog": self.catalog,
+                              "priceStatistics": self.priceStatistics,
+                              "sectionFilter": self.sectionFilter}
+                jobs.append((CleanUpML, attributes, readSheetRows(extractor.sheet), sheetName, "ESTIMATED AMOUNT"))
+
+        with self.phase("digest"):
+            results = extractSheets(jobs, self.workers if self.workers > 1 else None, self.outputFormat)
+        with self.phase("output"):
+            writeDocument(mergeSheets(sheetNames, results, "ESTIMATED AMOUNT",
+                                      self.errorBudget, self.errorRanges), self.outputFormat)
+
+    def main(self):
+
+        # Profile memory per phase, the report is also written if a master error ends the run
+        if(self.memoryProfilePath is not None):
+            self.profiler = MemoryProfiler('materialLabour', self.path, self.memoryProfilePath)
+
+        with self.profiler or contextlib.nullcontext():
+            if(self.allSheets):
+                self.mainAllSheets()
+                return
+
+            with self.phase("load"):
+                self.loadCatalog()
+                self.loadPriceStatistics()
+                self.loadWorkbook(path=self.path)
+            with self.phase("header"):
+                self.getHeaderRows()
+            with self.phase("formulas"):
+                self.evaluateMissingFormulas()
+            self.digestRows()
+
+
+def initShardWorker(usableColumns, startRowIndex, rows, errorBudget, catalog, priceStatistics,
+                    outputFormat, batchPrefix):
+    """
+    Stores the column positions, loaded sheet rows, error budget, cost-code
+    catalog, unit-price statistics, output format and shared memory segment
+    name prefix in the worker process.
+
+    """
+
+    shardContext['usableColumns'] = usableColumns
+    shardContext['startRowIndex'] = startRowIndex
+    shardContext['rows'] = rows
+    shardContext['errorBudget'] = errorBudget
+    shardContext['catalog'] = catalog
+    shardContext['priceStatistics'] = priceStatistics
+    shardContext['outputFormat'] = outputFormat
+    shardContext['batchPrefix'] = batchPrefix
+
+
+def digestShard(job):
+    """
+    Validates and converts all cost code rows of the sections of supplied
+    (index, shard) job in a worker process. Returns the handle of the shared
+    memory segment holding the encoded records (see recordBatches.py) and the
+    errors, in sheet order.
+
+    """
+
+    worker = CleanUpML(errorBudget=shardContext['errorBudget'])
+    worker.usableColumns = shardContext['usableColumns']
+    worker.catalog = shardContext['catalog']
+    worker.priceStatistics = shardContext['priceStatistics']
+    worker.projectColumns()
+    rows = shardContext['rows']
+    startRowIndex = shardContext['startRowIndex']
+    index, shard = job
+
+    for tempHeader, tempFooter, rowIndexes in shard:
+        worker.tempHeader = tempHeader
+        worker.tempFooter = tempFooter
+        for rowIndex in rowIndexes:
+            if(worker.errorBudgetReached()):
+                break
+            worker.rowIndex = rowIndex
+            row = rows[rowIndex - startRowIndex]
+            worker.createLabourObj(row)
+            worker.createMaterialObj(row)
+
+    # Records of a shard with errors are never written
+    if(len(worker.errorData) > 1):
+        return [], worker.errorData[1:]
+    return (shareRecords(worker.cleanData[1:], segmentName(shardContext['batchPrefix'], index),
+                         shardContext['outputFormat']),
+            worker.errorData[1:])
+
+
+def parseArguments(argv):
+    """
+    Parses command line arguments of the script.
+
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Extracts Labour and Material cost codes from the "Est. Summary" sheet of an estimate file.')
+    parser.add_argument('path', help='path to the .xlsx, .xlsm, .csv, .tsv or .snapshot estimate file, or - to read it from stdin')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes used to digest sections, or sheets with --all-sheets '
+                        '(default: 1, sequential; one per sheet with --all-sheets)')
+    parser.add_argument('--error-budget', type=int, default=0,
+                        help='stop scanning after this many data errors (default: 0, scan the whole sheet)')
+    parser.add_argument('--layouts', help='header layout registry file (default: headerLayouts.json in the per-user cache directory)')
+    parser.add_argument('--no-layout-cache', action='store_true',
+                        help='always discover columns from the header rows')
+    parser.add_argument('--format', choices=INPUT_FORMATS,
+                        help='input format (default: detected from the file extension or content)')
+    parser.add_argument('--error-ranges', action='store_true',
+                        help='report errors in adjacent cells of a column as one range, e.g. G14:G9000')
+    parser.add_argument('--progress', action='store_true',
+                        help='write progress events to stderr as JSON lines')
+    parser.add_argument('--schemas', action='append',
+                        help='folder with additional template schema files (may be repeated)')
+    parser.add_argument('--no-formula-evaluation', action='store_true',
+                        help="don't evaluate formulas whose cached results are missing")
+    parser.add_argument('--catalog',
+                        help='cost-code catalog .csv file; codes missing from it, or not allowed for '
+                        'the cost type, are reported as errors')
+    parser.add_argument('--all-sheets', action='store_true',
+                        help='extract every sheet built from the template, found by name or header, '
+                        'concurrently and tag the output with sheet names')
+    parser.add_argument('--section', action='append', metavar='PATTERN',
+                        help='extract only sections whose grouping or summary name matches this name or '
+                        'wildcard pattern, e.g. "ELECTRICAL*" (may be repeated)')
+    parser.add_argument('--price-stats', metavar='INDEX',
+                        help='unit-price statistics index (see priceStatistics.py); each cost code '
+                        'gets a "PRICE OUTLIER" flag, "LOW" or "HIGH" for prices far from history')
+    parser.add_argument('--memory-profile', metavar='REPORT',
+                        help='write a memory profile of the run (RSS and tracemalloc breakdown per '
+                        'phase, top allocation sites) to this .json file')
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default="json",
+                        help='encoding of the printed document (default: json)')
+    parser.add_argument('--preview', type=int, metavar='N',
+                        help='preview mode: print only the first N cost codes, reading the sheet '
+                        'only as far as needed')
+    parser.add_argument('--preview-sections', type=int, metavar='K',
+                        help='preview mode: stop after the first K sections')
+    parser.add_argument('--snapshot', action='store_true',
+                        help='read the workbook through its binary snapshot, compiled next to it '
+                        'on first use and whenever the workbook changes')
+    args = parser.parse_args(argv)
+
+    # Binary output formats need their optional package
+    if(args.output_format != "json"):
+        try:
+            importEncoder(args.output_format)
+        except ValueError as e:
+            parser.error(str(e))
+
+    return args
 
 
 if __name__ == "__main__":
-    cleaned = CleanUpML()
-    cleaned.main()
+    args = parseArguments(sys.argv[1:])
+    cleaned = CleanUpML(path=args.path, workers=args.workers,
+                        errorBudget=args.error_budget,
+                        layoutCache=not args.no_layout_cache, layoutsPath=args.layouts,
+                        inputFormat=args.format, errorRanges=args.error_ranges,
+                        progress=writeToStderr if args.progress else None,
+                        schemaPaths=args.schemas, snapshot=args.snapshot,
+                        evaluateFormulas=not args.no_formula_evaluation,
+                        catalogPath=args.catalog, outputFormat=args.output_format,
+                        sectionFilter=args.section, allSheets=args.all_sheets,
+                        priceStatisticsPath=args.price_stats,
+                        memoryProfilePath=args.memory_profile)
+    if(args.preview is not None or args.preview_sections is not None):
+        writeDocument(cleaned.mainPreview(args.preview, args.preview_sections), args.output_format)
+    else:
+        cleaned.main()
 
 
 # Original template (Sheetname: Est. Summary):
@@ -0,0 +1,251 @@
+"""
+Memory profiling of extraction runs. With a profile path set, an extractor
+records for each phase of its run (loading, header scan, formula
+evaluation, digestion, output) the resident memory (RSS) of the process and
+a tracemalloc breakdown: memory allocated and still held at the end of the
+phase, the peak during the phase and the source lines that allocated the
+most. The report is written to a side file as JSON, e.g.:
+  {"EXTRACTOR": "materialLabour", "FILE": "A6.xlsm", "PEAK RSS MB": 412.3, "PHASES": [
+     {"PHASE": "load", "SECONDS": 14.2, "RSS MB": 398.1, "PEAK RSS MB": 401.0,
+      "ALLOCATED MB": 301.5, "PEAK MB": 305.2,
+      "TOP": [{"SITE": "openpyxl/cell/cell.py:125", "MB": 120.4, "BLOCKS": 1400000}, ...]}, ...],
+   "TOP": [...]}
+"TOP" of a phase lists the sites whose held memory grew the most during the
+phase, the report's "TOP" the sites holding the most memory at the end of
+the run. tracemalloc slows the run down, timings are only comparable
+between profiled runs.
+
+Reports of two runs, e.g. of two releases, are compared with:
+  python memoryProfile.py old.json new.json --tolerance 10
+which prints the change of every phase and exits with status 1 if the peak
+of any phase grew by more than the tolerance (percent).
+
+"""
+
+from contextlib import contextmanager
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+
+# Allocation sites listed per phase and for the whole run
+TOP_SITES = 10
+
+MEGABYTE = 1024 * 1024
+
+
+def residentMemory(pid):
+    """
+    Returns the resident memory of supplied process in bytes, or None if it
+    can't be read on this platform.
+
+    """
+
+    try:
+        with open('/proc/{}/statm'.format(pid)) as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+
+    # psutil is optional, only needed where /proc isn't available
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss
+    except Exception:
+        return None
+
+
+def peakResidentMemory():
+    """
+    Returns the peak resident memory of this process so far in bytes, or None
+    if it can't be read on this platform.
+
+    """
+
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Reported in kilobytes, except on macOS
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        pass
+
+    # psutil is optional, Windows reports the peak working set
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset
+    except Exception:
+        return None
+
+
+def toMegabytes(size):
+    return None if size is None else round(size / MEGABYTE, 1)
+
+
+def heldBySite():
+    """
+    Returns the memory currently held per allocating source line, as a
+    dictionary of "file:line" to (size, blocks). Allocations of tracemalloc
+    and of the profiler itself are left out.
+
+    """
+
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)])
+    sites = {}
+    for statistic in snapshot.statistics('lineno'):
+        frame = statistic.traceback[0]
+        sites["{}:{}".format(frame.filename, frame.lineno)] = (statistic.size, statistic.count)
+    return sites
+
+
+def topSites(sites, before=None):
+    """
+    Returns report entries of the sites holding the most memory, or with
+    "before", of the sites whose held memory grew the most since then.
+
+    """
+
+    if(before is not None):
+        sites = {site: (size - before.get(site, (0, 0))[0], count - before.get(site, (0, 0))[1])
+                 for site, (size, count) in sites.items()}
+    largest = sorted(sites.items(), key=lambda item: item[1][0], reverse=True)[:TOP_SITES]
+    return [{"SITE": site, "MB": toMegabytes(size), "BLOCKS": count}
+            for site, (size, count) in largest if size > 0]
+
+
+class MemoryProfiler:
+    extractorName = ""
+    path = None
+    reportPath = None
+
+    def __init__(self, extractorName, path, reportPath):
+        self.extractorName = extractorName
+        self.path = path
+        self.reportPath = reportPath
+        self.phases = []
+        self.started = None
+        # Memory held per site at the end of the last phase
+        self.sites = {}
+
+    def __enter__(self):
+        tracemalloc.start()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        # Master errors end the run through exit(), the report is still written
+        self.write()
+        tracemalloc.stop()
+        return False
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Records the memory used by the code run inside the context as the named
+        phase.
+
+        """
+
+        tracemalloc.reset_peak()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            # Measured before snapshots are taken, which allocate themselves
+            seconds = time.perf_counter() - started
+            allocated, peak = tracemalloc.get_traced_memory()
+            entry = {"PHASE": name,
+                     "SECONDS": round(seconds, 3),
+                     "RSS MB": toMegabytes(residentMemory(os.getpid())),
+                     "PEAK RSS MB": toMegabytes(peakResidentMemory()),
+                     "ALLOCATED MB": toMegabytes(allocated),
+                     "PEAK MB": toMegabytes(peak)}
+
+            sites = heldBySite()
+            entry["TOP"] = topSites(sites, self.sites)
+            self.sites = sites
+            self.phases.append(entry)
+
+    def report(self):
+        """
+        Returns the report of the phases recorded so far.
+
+        """
+
+        return {"EXTRACTOR": self.extractorName,
+                "FILE": self.path if isinstance(self.path, str) else None,
+                "SECONDS": round(time.perf_counter() - self.started, 3),
+                "PEAK RSS MB": toMegabytes(peakResidentMemory()),
+                "PHASES": self.phases,
+                "TOP": topSites(heldBySite())}
+
+    def write(self):
+        """
+        Writes the report to the report path.
+
+        """
+
+        tempPath = "{}.{}.tmp".format(self.reportPath, os.getpid())
+        with open(tempPath, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        os.replace(tempPath, self.reportPath)
+
+
+def compareReports(old, new, tolerance):
+    """
+    Compares the phases of two reports. Returns one comparison entry per phase
+    of the new report and whether the peak of any phase grew by more than the
+    tolerance (percent).
+
+    """
+
+    oldPhases = {phase["PHASE"]: phase for phase in old["PHASES"]}
+    comparisons = []
+    regressed = False
+
+    for phase in new["PHASES"]:
+        entry = {"PHASE": phase["PHASE"], "PEAK MB": phase["PEAK MB"],
+                 "ALLOCATED MB": phase["ALLOCATED MB"]}
+        oldPhase = oldPhases.get(phase["PHASE"])
+        if(oldPhase is not None):
+            entry["OLD PEAK MB"] = oldPhase["PEAK MB"]
+            entry["OLD ALLOCATED MB"] = oldPhase["ALLOCATED MB"]
+            # Growth of phases that allocate next to nothing isn't meaningful
+            limit = max(oldPhase["PEAK MB"], 1) * (1 + tolerance / 100)
+            entry["REGRESSION"] = phase["PEAK MB"] > limit
+            regressed = regressed or entry["REGRESSION"]
+        comparisons.append(entry)
+
+    return comparisons, regressed
+
+
+def parseArguments(argv):
+    """
+    Parses command line arguments of the script.
+
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Compares two memory profile reports of extraction runs.')
+    parser.add_argument('old', help='report of the earlier run')
+    parser.add_argument('new', help='report of the later run')
+    parser.add_argument('--tolerance', type=float, default=10,
+                        help='growth of a phase peak in percent reported as a regression (default: 10)')
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parseArguments(sys.argv[1:])
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    comparisons, regressed = compareReports(old, new, args.tolerance)
+    for comparison in comparisons:
+        print(json.dumps(comparison))
+    sys.exit(1 if regressed else 0)
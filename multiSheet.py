@@ -0,0 +1,169 @@
+"""
+Extraction of workbooks carrying several estimate sheets built from the same
+template, e.g. one "Est. Summary" sheet per building or phase. The workbook is
+opened once by the extractor, which finds the header of every template sheet.
+The sheets are then digested concurrently, one worker process per sheet, and
+their outputs are merged in workbook order with every cost code and error
+tagged with its sheet, e.g.:
+  [{"DATA": "VALID", "SHEETS": [{"SHEET": "Est. Summary - A", "RECORDS": 120, "ERRORS": 0,
+                                  "ESTIMATED AMOUNT": 81250.4}, ...]},
+   {"CODE": "", ..., "SUMMARY NAME": "", "SHEET": "Est. Summary - A"}, ...]
+
+The rollup of every sheet (record and error counts and the amount total) is
+listed in the leading DATA entry of both VALID and INVALID documents. Snapshots
+hold the sheets named like a template, sheets found only by their header are
+read from the workbook itself.
+
+Worker processes tag the records and total the amounts of their sheet, then
+pass the records back encoded in shared memory (see recordBatches.py), so the
+parent writes them without decoding them.
+
+"""
+
+from multiprocessing import Pool
+import os
+
+from currency import centsToNumber, toCents
+from errorLocations import compressErrorLocations
+from inputAdapters import RowSheet
+from recordBatches import BatchedDocument, batchPrefix, releaseSegments, segmentName, shareRecords
+
+
+# Rows probed for a template header in sheets not named like a template
+PROBE_ROWS = 200
+
+
+def discoverSheets(workbook, schemas, probe):
+    """
+    Returns the names of the template sheets of supplied workbook, in workbook
+    order. Sheets named like a template (see TemplateSchema.sheetPatterns) are
+    always included, other sheets only if "probe" finds a template header in them.
+
+    """
+
+    names = []
+    for name in workbook.sheetnames:
+        if(schemas.matchesSheet(name) or probe(workbook[name])):
+            names.append(name)
+    return names
+
+
+def readSheetRows(sheet, maxRow=None):
+    """
+    Returns the cell values of supplied sheet as a list of row tuples, starting
+    at row 1.
+
+    """
+
+    return list(sheet.iter_rows(min_row=1, max_row=maxRow, values_only=True))
+
+
+def digestSheet(job):
+    """
+    Digests one sheet. The job holds the extractor class, the attributes of the
+    extractor that found the sheet header (column positions, first data row,
+    options), the sheet rows, the sheet name and the key of the record amounts.
+    Returns the created dictionaries tagged with the sheet name, their number,
+    the errors in sheet order and the amount total in cents with whether all
+    amounts are integral.
+
+    """
+
+    extractorClass, attributes, rows, sheetName, amountKey = job
+
+    extractor = extractorClass()
+    for name, value in attributes.items():
+        setattr(extractor, name, value)
+    extractor.sheet = RowSheet(rows)
+    extractor.projectColumns()
+
+    for _ in extractor.iterDigestRows():
+        pass
+
+    records = []
+    total = 0
+    integral = True
+    for record in extractor.cleanData[1:]:
+        records.append(dict(record, SHEET=sheetName))
+        total += toCents(record[amountKey]) or 0
+        integral = integral and isinstance(record[amountKey], int)
+
+    return records, len(records), extractor.errorData[1:], total, integral
+
+
+def digestSheetShared(job):
+    """
+    Digests one sheet in a worker process, see "digestSheet". The job holds the
+    sheet index, segment name prefix and output format followed by the sheet
+    job. Records are returned as the handle of a shared memory segment holding
+    them encoded, or as an empty list if the sheet has errors.
+
+    """
+
+    index, prefix, outputFormat, sheetJob = job
+    records, recordCount, errors, total, integral = digestSheet(sheetJob)
+
+    # Records of a sheet with errors are never written
+    if(len(errors) > 0):
+        return [], recordCount, errors, total, integral
+    return (shareRecords(records, segmentName(prefix, index), outputFormat),
+            recordCount, errors, total, integral)
+
+
+def extractSheets(jobs, workers=None, outputFormat="json"):
+    """
+    Digests the jobs of all sheets across "workers" processes (one per sheet,
+    up to the number of CPUs, if None). Returns the results in job order.
+
+    """
+
+    if(workers is None):
+        workers = min(len(jobs), os.cpu_count() or 1)
+
+    # A single sheet isn't worth starting a process for
+    if(workers <= 1 or len(jobs) <= 1):
+        return [digestSheet(job) for job in jobs]
+
+    prefix = batchPrefix()
+    try:
+        with Pool(min(workers, len(jobs))) as pool:
+            return pool.map(digestSheetShared, [(index, prefix, outputFormat, job)
+                                                for index, job in enumerate(jobs)])
+    except BaseException:
+        releaseSegments(prefix, len(jobs))
+        raise
+
+
+def mergeSheets(sheetNames, results, amountKey, errorBudget=0, errorRanges=False):
+    """
+    Merges the results of all sheets into one output document, tagging every
+    error with its sheet. Error budget and error ranges apply per sheet.
+
+    """
+
+    batches = []
+    errorData = []
+    rollups = []
+
+    for sheetName, (sheetBatch, recordCount, sheetErrors, total, integral) in zip(sheetNames, results):
+        # Report no more errors than the budget allows
+        if(errorBudget > 0):
+            sheetErrors = sheetErrors[:errorBudget]
+        # Collapse errors in adjacent cells of one column into ranges
+        if(errorRanges):
+            sheetErrors = compressErrorLocations([{}] + sheetErrors)[1:]
+
+        batches.append(sheetBatch)
+        for error in sheetErrors:
+            errorData.append(dict(error, SHEET=sheetName))
+
+        rollups.append({"SHEET": sheetName,
+                        "RECORDS": recordCount,
+                        "ERRORS": len(sheetErrors),
+                        amountKey: centsToNumber(total, integral)})
+
+    document = BatchedDocument({"DATA": "VALID", "SHEETS": rollups}, batches)
+    if(len(errorData) > 0):
+        document.release()
+        return [{"DATA": "INVALID", "SHEETS": rollups}] + errorData
+    return document
@@ -0,0 +1,100 @@
+"""
+Encodings the extraction scripts can write their VALID/INVALID/ERROR
+documents in. JSON stays the default and is printed exactly as before.
+Binary encodings are more compact and much cheaper to decode for services
+consuming the output directly:
+- "msgpack": MessagePack, needs the optional "msgpack" package
+- "cbor": CBOR (RFC 8949), needs the optional "cbor2" package
+
+Binary documents are written to the binary stdout. Lists are streamed item by
+item instead of being encoded into one buffer first.
+
+"""
+
+import json
+import sys
+
+
+OUTPUT_FORMATS = ("json", "msgpack", "cbor")
+
+# Packages needed by the encodings
+OUTPUT_PACKAGES = {
+    "json": "json",
+    "msgpack": "msgpack",
+    "cbor": "cbor2",
+}
+
+
+def importEncoder(outputFormat):
+    """
+    Imports the package of an encoding. Raises ValueError if it isn't
+    installed.
+
+    """
+
+    try:
+        return __import__(OUTPUT_PACKAGES[outputFormat])
+    except ImportError:
+        raise ValueError('The "{}" output format needs the "{}" package to be installed'.format(
+            outputFormat, OUTPUT_PACKAGES[outputFormat]))
+
+
+def encodeDocument(document, outputFormat="json"):
+    """
+    Returns supplied document encoded in the output format, as bytes.
+
+    """
+
+    if(outputFormat == "json"):
+        return (json.dumps(document) + "\n").encode('utf-8')
+    if(outputFormat == "msgpack"):
+        return importEncoder(outputFormat).packb(document)
+    return importEncoder(outputFormat).dumps(document)
+
+
+def decodeDocument(data, outputFormat="json"):
+    """
+    Decodes a document written in the output format.
+
+    """
+
+    if(outputFormat == "json"):
+        return json.loads(data)
+    if(outputFormat == "msgpack"):
+        return importEncoder(outputFormat).unpackb(data)
+    return importEncoder(outputFormat).loads(data)
+
+
+def writeDocument(document, outputFormat="json"):
+    """
+    Writes supplied document to stdout in the output format.
+
+    """
+
+    # Documents of record batches held in shared memory write themselves
+    # (see recordBatches.py)
+    if(hasattr(document, "writeTo")):
+        document.write(outputFormat)
+        return
+
+    if(outputFormat == "json"):
+        print(json.dumps(document))
+        return
+
+    encoder = importEncoder(outputFormat)
+    # Text printed so far must come first
+    sys.stdout.flush()
+    stream = sys.stdout.buffer
+
+    if(outputFormat == "msgpack"):
+        packer = encoder.Packer()
+        if(isinstance(document, list)):
+            stream.write(packer.pack_array_header(len(document)))
+            for item in document:
+                stream.write(packer.pack(item))
+        else:
+            stream.write(packer.pack(document))
+    else:
+        encoder.dump(document, stream)
+
+    stream.flush()
@@ -0,0 +1,290 @@
+"""
+Unit-price statistics of past estimates, used to flag unit prices that deviate
+strongly from company history for the same CODE and COST TYPE. Statistics are
+kept per key in a quantile sketch: unit prices are counted in logarithmic
+buckets, each bucket spanning 2% of its value, so quantiles are known to
+within 1% from a few hundred counters whatever the number of prices seen.
+Sketches only ever add counts, so estimates are ingested incrementally.
+
+The index is persisted as JSON, holding per key (the code in "dd dd dd"
+format and the cost type) the count, median and the outlier fences worked
+out when the index was saved, e.g.:
+  {"VERSION": 1, "SOURCES": ["9c1e..."], "PRICES": {
+     "01 10 00|Labour": {"COUNT": 42, "ZERO": 0, "BUCKETS": {"232": 17, ...},
+                         "MEDIAN": 20.41, "LOW": 9.87, "HIGH": 43.1}, ...}}
+
+A unit price is an outlier if it lies outside the fences, set OUTLIER_FACTOR
+times the interquartile spread (taken on the log scale, prices are skewed)
+below the first or above the third quartile. Keys with less than MIN_COUNT
+prices aren't flagged. Checking a price is a single dictionary lookup.
+
+Estimates are ingested from VALID materialLabour output documents, each
+document only once, e.g.:
+  python materialLabour.py A6.xlsm | python priceStatistics.py prices.json -
+  python priceStatistics.py prices.json A6.json A7.json
+
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import sys
+
+from costCatalog import codeNumber
+
+
+INDEX_VERSION = 1
+
+# Relative accuracy of the quantile sketches
+ACCURACY = 0.01
+GAMMA = (1 + ACCURACY) / (1 - ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+
+# Fences lie this many interquartile spreads outside the quartiles
+OUTLIER_FACTOR = 3.0
+# Smallest quartile ratio used for the spread, so keys whose history holds a
+# single price don't flag every small deviation
+MIN_SPREAD = 1.1
+# Keys need this many prices before their prices are flagged
+MIN_COUNT = 10
+
+# Cost types of the records whose unit prices are kept
+COST_TYPES = ("Labour", "Material")
+
+
+def normalizeCode(code):
+    """
+    Returns supplied cost code in the "dd dd dd" format, whichever accepted
+    format it was written in (see costCatalog.codeNumber), so all spellings of
+    a code share their history. Invalid codes are returned unchanged.
+
+    """
+
+    number = codeNumber(code)
+    if(number is None):
+        return code
+    return "{:02d} {:02d} {:02d}".format(number // 10000, number // 100 % 100, number % 100)
+
+
+def priceKey(code, costType):
+    return "{}|{}".format(normalizeCode(code), costType)
+
+
+def bucketOf(price):
+    """
+    Returns the sketch bucket of a positive unit price.
+
+    """
+
+    return math.ceil(math.log(price) / LOG_GAMMA)
+
+
+def bucketValue(bucket):
+    """
+    Returns the value representing a sketch bucket, within ACCURACY of every
+    price counted in it.
+
+    """
+
+    return 2 * GAMMA ** bucket / (GAMMA + 1)
+
+
+def quantile(entry, fraction):
+    """
+    Returns the quantile of supplied key statistics at the fraction (0 to 1).
+
+    """
+
+    rank = fraction * (entry["COUNT"] - 1)
+    seen = entry["ZERO"]
+    if(rank < seen):
+        return 0
+    for bucket in sorted(entry["BUCKETS"], key=int):
+        seen += entry["BUCKETS"][bucket]
+        if(rank < seen):
+            return bucketValue(int(bucket))
+    return bucketValue(max(int(bucket) for bucket in entry["BUCKETS"]))
+
+
+def documentHash(document):
+    """
+    Returns the SHA-256 hash identifying an ingested document. Only the fields
+    ingested from its records are hashed, so outputs of the same estimate with
+    derived keys ("PRICE OUTLIER", "SHEET") are recognized as the same document.
+
+    """
+
+    prices = [[record.get("CODE"), record.get("COST TYPE"), record.get("UNIT PRICE")]
+              for record in document[1:]]
+    return hashlib.sha256(json.dumps(prices).encode('utf-8')).hexdigest()
+
+
+class PriceStatistics:
+    path = None
+    sources = []
+    prices = {}
+    # Outlier fences by (code, cost type), the only part used when checking rows
+    fences = {}
+
+    def __init__(self, path, create=False):
+        self.path = path
+        self.sources = []
+        self.prices = {}
+
+        # A missing index is an error unless a new one is being created
+        try:
+            with open(self.path) as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            if(not create):
+                raise
+            index = {"VERSION": INDEX_VERSION, "SOURCES": [], "PRICES": {}}
+
+        if(index.get("VERSION") != INDEX_VERSION):
+            raise ValueError("Unsupported statistics index version")
+        self.sources = index["SOURCES"]
+        self.prices = index["PRICES"]
+        self.fences = self.compileFences()
+
+    def __getstate__(self):
+        # Worker processes only check prices, sketches stay in this process
+        return {"path": self.path, "fences": self.fences}
+
+    def compileFences(self):
+        """
+        Returns the outlier fences of all keys with enough history, by (code,
+        cost type).
+
+        """
+
+        fences = {}
+        for key, entry in self.prices.items():
+            if(entry["COUNT"] >= MIN_COUNT and entry.get("LOW") is not None):
+                code, costType = key.rsplit("|", 1)
+                fences[(code, costType)] = (entry["LOW"], entry["HIGH"])
+        return fences
+
+    def add(self, code, costType, unitPrice):
+        """
+        Counts one unit price of supplied key.
+
+        """
+
+        entry = self.prices.setdefault(priceKey(code, costType),
+                                       {"COUNT": 0, "ZERO": 0, "BUCKETS": {}})
+        entry["COUNT"] += 1
+        if(unitPrice <= 0):
+            entry["ZERO"] += 1
+        else:
+            bucket = str(bucketOf(unitPrice))
+            entry["BUCKETS"][bucket] = entry["BUCKETS"].get(bucket, 0) + 1
+
+    def ingest(self, document):
+        """
+        Adds the unit prices of a VALID materialLabour output document. Returns
+        the number of prices added, or None if the document was ingested before.
+        Other documents hold no prices and aren't recorded.
+
+        """
+
+        if(len(document) == 0 or document[0].get("DATA") != "VALID"):
+            return 0
+
+        digest = documentHash(document)
+        if(digest in self.sources):
+            return None
+
+        added = 0
+        for record in document[1:]:
+            unitPrice = record.get("UNIT PRICE")
+            if(record.get("COST TYPE") in COST_TYPES and isinstance(unitPrice, (int, float))):
+                self.add(record["CODE"], record["COST TYPE"], unitPrice)
+                added += 1
+
+        self.sources.append(digest)
+        return added
+
+    def summarize(self):
+        """
+        Works out median and outlier fences of every key from its sketch.
+
+        """
+
+        for entry in self.prices.values():
+            entry["MEDIAN"] = round(quantile(entry, 0.5), 2)
+            firstQuartile = quantile(entry, 0.25)
+            thirdQuartile = quantile(entry, 0.75)
+            if(firstQuartile <= 0):
+                # Spread of zero prices can't be taken on the log scale
+                entry["LOW"] = None
+                entry["HIGH"] = None
+                continue
+            spread = max(thirdQuartile / firstQuartile, MIN_SPREAD) ** OUTLIER_FACTOR
+            entry["LOW"] = round(firstQuartile / spread, 2)
+            entry["HIGH"] = round(thirdQuartile * spread, 2)
+        self.fences = self.compileFences()
+
+    def save(self):
+        """
+        Summarizes the sketches and persists the index atomically.
+
+        """
+
+        self.summarize()
+        tempPath = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tempPath, 'w') as f:
+            json.dump({"VERSION": INDEX_VERSION, "SOURCES": self.sources,
+                       "PRICES": self.prices}, f)
+        os.replace(tempPath, self.path)
+
+    def checkPrice(self, code, costType, unitPrice):
+        """
+        Checks supplied unit price against the history of its key. Returns "LOW"
+        or "HIGH" for outliers, None otherwise or if the key has too little
+        history.
+
+        """
+
+        fence = self.fences.get((normalizeCode(code), costType))
+        if(fence is None):
+            return None
+        if(unitPrice < fence[0]):
+            return "LOW"
+        if(unitPrice > fence[1]):
+            return "HIGH"
+        return None
+
+
+def parseArguments(argv):
+    """
+    Parses command line arguments of the script.
+
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Adds the unit prices of materialLabour outputs to a unit-price statistics index.')
+    parser.add_argument('path', help='statistics index .json file, created if missing')
+    parser.add_argument('documents', nargs='+',
+                        help='materialLabour output .json documents, or - to read one from stdin')
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parseArguments(sys.argv[1:])
+    statistics = PriceStatistics(args.path, create=True)
+
+    for source in args.documents:
+        if(source == "-"):
+            document = json.load(sys.stdin)
+        else:
+            with open(source) as f:
+                document = json.load(f)
+        added = statistics.ingest(document)
+        if(added is None):
+            print(json.dumps({"SOURCE": source, "SKIPPED": "already ingested"}))
+        else:
+            print(json.dumps({"SOURCE": source, "PRICES": added}))
+
+    statistics.save()
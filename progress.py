@@ -0,0 +1,87 @@
+"""
+Progress reporting for long-running extractions. The extractors pass their
+progress to a reporter, which forwards it to a callback (library use) or
+writes it to stderr as one JSON object per line (command line use), e.g.:
+  {"EVENT": "START", "ROWS": 0, "TOTAL": 200000, "SECTIONS": 0, "ERRORS": 0}
+  {"EVENT": "PROGRESS", "ROWS": 51000, "TOTAL": 200000, "SECTIONS": 12, "ERRORS": 0}
+  {"EVENT": "DONE", "ROWS": 200000, "TOTAL": 200000, "SECTIONS": 48, "ERRORS": 3}
+
+TOTAL is estimated from the sheet dimensions. Events are emitted at most once
+per interval. To keep the row loop cheap, extractors only call "update" once
+"nextCheckRow" is reached and the clock is read only then.
+
+"""
+
+import json
+import sys
+import time
+
+
+def writeToStderr(event):
+    """
+    Writes supplied progress event to stderr as one JSON line.
+
+    """
+
+    sys.stderr.write(json.dumps(event) + "\n")
+    sys.stderr.flush()
+
+
+class ProgressReporter:
+    callback = None
+    interval = 0.5
+    # Rows between clock checks
+    checkRows = 1000
+
+    total = 0
+    nextCheckRow = 0
+    nextReport = 0.0
+
+    def __init__(self, callback=None, interval=0.5, checkRows=1000):
+        self.callback = callback or writeToStderr
+        self.interval = interval
+        self.checkRows = checkRows
+
+    def start(self, total):
+        """
+        Emits the START event with the estimated total number of rows.
+
+        """
+
+        self.total = max(0, total)
+        self.nextCheckRow = self.checkRows
+        self.nextReport = time.monotonic() + self.interval
+        self.emit("START", 0, 0, 0)
+
+    def update(self, rows, sections, errors):
+        """
+        Emits a PROGRESS event if the interval has passed since the last one.
+
+        """
+
+        self.nextCheckRow = rows + self.checkRows
+
+        now = time.monotonic()
+        if(now >= self.nextReport):
+            self.nextReport = now + self.interval
+            self.emit("PROGRESS", rows, sections, errors)
+
+    def finish(self, rows, sections, errors):
+        """
+        Emits the DONE event.
+
+        """
+
+        self.emit("DONE", rows, sections, errors)
+
+    def emit(self, eventName, rows, sections, errors):
+        """
+        Passes one event to the callback.
+
+        """
+
+        self.callback({"EVENT": eventName,
+                       "ROWS": rows,
+                       "TOTAL": max(self.total, rows),
+                       "SECTIONS": sections,
+                       "ERRORS": errors})
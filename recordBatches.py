@@ -0,0 +1,229 @@
+"""
+Hand-off of extracted records from pool workers to the parent process through
+shared memory. Returning records from a worker pickles every dictionary,
+copies the pickle through a pipe and unpickles it in the parent, which then
+encodes the records again for the output. Instead, a worker encodes its
+records in the output format itself and stores them in a shared memory
+segment, only the small segment handle is pickled. The parent writes the
+segments straight to the output, the records never exist as Python objects in
+the parent.
+
+A segment holds the records of one shard or sheet encoded exactly as they
+appear inside the output document: JSON objects separated by ", ", MessagePack
+or CBOR items back to back. The output is byte-identical to the one written
+from the record dictionaries.
+
+Segments are unlinked by the parent once written or released. Segment names
+share a prefix per run, so segments of shards left unread (e.g. once the error
+budget is used up) are found and released too.
+
+"""
+
+from itertools import count
+from multiprocessing import resource_tracker, shared_memory
+import json
+import os
+import sys
+
+from outputEncoding import importEncoder
+
+
+# Numbers segment name prefixes of the runs of this process
+prefixCounter = count()
+
+
+def batchPrefix():
+    """
+    Returns a new segment name prefix, unique to this run of this process. Called
+    in the parent before workers are started.
+
+    """
+
+    # Workers must register their segments with the tracker of the parent, a
+    # tracker of their own would unlink them when the worker exits
+    resource_tracker.ensure_running()
+    return "estb{}_{}".format(os.getpid(), next(prefixCounter))
+
+
+def segmentName(prefix, index):
+    return "{}_{}".format(prefix, index)
+
+
+def cborArrayHeader(length):
+    """
+    Returns the CBOR header of an array of supplied length.
+
+    """
+
+    if(length < 24):
+        return bytes([0x80 + length])
+    for code, size in ((24, 1), (25, 2), (26, 4), (27, 8)):
+        if(length < 1 << (8 * size)):
+            return bytes([0x80 + code]) + length.to_bytes(size, 'big')
+    raise ValueError("Array too long for CBOR")
+
+
+def arrayHeader(length, outputFormat):
+    """
+    Returns the header of an array of supplied length in a binary output format.
+
+    """
+
+    if(outputFormat == "msgpack"):
+        return importEncoder(outputFormat).Packer().pack_array_header(length)
+    return cborArrayHeader(length)
+
+
+def encodeRecords(records, outputFormat="json"):
+    """
+    Returns supplied records encoded as the items of an output document, without
+    the enclosing array.
+
+    """
+
+    if(outputFormat == "json"):
+        return json.dumps(records)[1:-1].encode('utf-8')
+    if(outputFormat == "msgpack"):
+        encoded = importEncoder(outputFormat).packb(records)
+    else:
+        encoded = importEncoder(outputFormat).dumps(records)
+    return encoded[len(arrayHeader(len(records), outputFormat)):]
+
+
+class SharedBatch:
+    """
+    Handle of a shared memory segment holding encoded records, passed from the
+    worker to the parent.
+
+    """
+
+    name = ""
+    count = 0
+    size = 0
+
+    def __init__(self, name, count, size):
+        self.name = name
+        self.count = count
+        self.size = size
+
+    def __len__(self):
+        return self.count
+
+
+def shareRecords(records, name, outputFormat="json"):
+    """
+    Encodes supplied records into a new shared memory segment of supplied name.
+    Returns the handle of the segment, or an empty list if there are no records.
+
+    """
+
+    if(len(records) == 0):
+        return []
+
+    payload = encodeRecords(records, outputFormat)
+    segment = shared_memory.SharedMemory(name=name, create=True, size=len(payload))
+    segment.buf[:len(payload)] = payload
+    segment.close()
+    return SharedBatch(name, len(records), len(payload))
+
+
+def releaseSegments(prefix, length):
+    """
+    Unlinks the segments named with supplied prefix and indexes below "length"
+    that still exist.
+
+    """
+
+    for index in range(length):
+        try:
+            segment = shared_memory.SharedMemory(name=segmentName(prefix, index))
+        except FileNotFoundError:
+            continue
+        segment.close()
+        segment.unlink()
+
+
+class BatchedDocument:
+    """
+    Output document of a leading DATA entry followed by records held in batches.
+    A batch is either a SharedBatch or a list of record dictionaries. Writing the
+    document releases its shared memory segments.
+
+    """
+
+    header = {}
+    batches = []
+
+    def __init__(self, header, batches=None):
+        self.header = header
+        self.batches = batches or []
+
+    def __len__(self):
+        return 1 + sum(len(batch) for batch in self.batches)
+
+    def release(self):
+        """
+        Unlinks the shared memory segments of the document.
+
+        """
+
+        for batch in self.batches:
+            if(isinstance(batch, SharedBatch)):
+                try:
+                    segment = shared_memory.SharedMemory(name=batch.name)
+                except FileNotFoundError:
+                    continue
+                segment.close()
+                segment.unlink()
+        self.batches = []
+
+    def write(self, outputFormat="json"):
+        """
+        Writes the document to stdout in the output format, the same way
+        "writeDocument" writes the list of its entries.
+
+        """
+
+        try:
+            # Text printed so far must come first
+            sys.stdout.flush()
+            stream = getattr(sys.stdout, 'buffer', None)
+            if(stream is None):
+                # Captured JSON output (see extractors.runExtraction) is text
+                self.writeTo(lambda data: sys.stdout.write(bytes(data).decode('utf-8')), outputFormat)
+            else:
+                self.writeTo(stream.write, outputFormat)
+                stream.flush()
+        finally:
+            self.release()
+
+    def writeTo(self, write, outputFormat):
+        """
+        Passes the encoded document to supplied write function in parts.
+
+        """
+
+        if(outputFormat == "json"):
+            write(b"[" + json.dumps(self.header).encode('utf-8'))
+        else:
+            write(arrayHeader(len(self), outputFormat) + encodeRecords([self.header], outputFormat))
+
+        for batch in self.batches:
+            if(len(batch) == 0):
+                continue
+            if(outputFormat == "json"):
+                write(b", ")
+
+            if(isinstance(batch, SharedBatch)):
+                segment = shared_memory.SharedMemory(name=batch.name)
+                try:
+                    view = segment.buf[:batch.size]
+                    write(view)
+                    view.release()
+                finally:
+                    segment.close()
+            else:
+                write(encodeRecords(batch, outputFormat))
+
+        if(outputFormat == "json"):
+            write(b"]\n")
@@ -0,0 +1,453 @@
+"""
+Pre-parsed binary snapshots of estimate workbooks. Parsing the zipped XML of
+a workbook is the most expensive step of every extraction, and the same
+workbook is often read several times (materialLabour, subcontracted, the diff
+tool). A snapshot is compiled once from the sheets the templates use and is
+read afterwards through memory-mapping, without reopening the workbook.
+
+The snapshot stores every sheet column by column. Each column holds one type
+tag byte per row followed by one 8-byte slot per row (int64, float64 or an
+index into the sheet's string table), so any range of rows of a column is
+decoded straight from the mapped file. Layout:
+  magic | directory offset | sheet columns and string tables ... | directory
+where the directory is JSON, e.g.:
+  {"VERSION": 1, "SOURCE_HASH": "<sha256>",
+   "SOURCE_SHEETS": ["Est. Summary", "Notes"],
+   "SHEETS": {"Est. Summary": {"MAX_ROW": 900, "MAX_COLUMN": 30, ...}}}
+"SOURCE_SHEETS" lists all sheets of the workbook. Extracting all sheets
+(--all-sheets) also finds template sheets by their header, so it needs a
+snapshot of every sheet, compiled with:
+  python snapshots.py A6.xlsm --all-sheets
+
+The snapshot of "A6.xlsm" is "A6.xlsm.snapshot" next to it. It's recompiled
+whenever the SHA-256 hash of the workbook differs from the one it was
+compiled from. Compile a snapshot from the command line with:
+  python snapshots.py A6.xlsm
+
+"""
+
+from array import array
+from datetime import date, datetime, time
+from openpyxl import load_workbook
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+
+from formulaEvaluator import FormulaEvaluator, hasUncachedFormulas, loadFormulaWorkbook
+from inputAdapters import CsvCell, SNAPSHOT_MAGIC
+from templateSchemas import SchemaRegistry
+
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_EXTENSION = '.snapshot'
+
+# Extractors whose template sheets are compiled by default
+SNAPSHOT_EXTRACTORS = ("materialLabour", "subcontracted")
+
+# Master error of extracting all sheets from a snapshot of the template sheets only
+INCOMPLETE_SNAPSHOT_ERROR = ('The snapshot holds only the known template sheets of the workbook. '
+                             'Please compile it with --all-sheets to extract all sheets')
+
+# Magic followed by the offset of the directory
+HEADER = struct.Struct('<8sQ')
+
+# Cell type tags
+EMPTY = 0
+INTEGER = 1
+FLOAT = 2
+STRING = 3
+BOOLEAN = 4
+# Stored as text in the string table
+BIG_INTEGER = 5
+DATETIME = 6
+DATE = 7
+TIME = 8
+
+# Converters of tags stored as text
+TEXT_TYPES = {
+    BIG_INTEGER: int,
+    DATETIME: datetime.fromisoformat,
+    DATE: date.fromisoformat,
+    TIME: time.fromisoformat,
+}
+
+# Rows decoded at once when streaming
+BLOCK_ROWS = 4096
+
+
+def fileHash(path):
+    """
+    Returns the SHA-256 hash of supplied file.
+
+    """
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def snapshotPath(path):
+    """
+    Returns the snapshot path of supplied workbook path.
+
+    """
+
+    return path + SNAPSHOT_EXTENSION
+
+
+def encodeCell(value, strings, stringIndex):
+    """
+    Returns the (tag, slot) pair of supplied cell value. Texts are added to the
+    string table and their slot is the index in it.
+
+    """
+
+    if(value is None):
+        return EMPTY, 0
+    if(isinstance(value, bool)):
+        return BOOLEAN, int(value)
+    if(isinstance(value, int)):
+        if(-2 ** 63 <= value < 2 ** 63):
+            return INTEGER, value
+        tag, text = BIG_INTEGER, str(value)
+    elif(isinstance(value, float)):
+        return FLOAT, struct.unpack('<q', struct.pack('<d', value))[0]
+    elif(isinstance(value, datetime)):
+        tag, text = DATETIME, value.isoformat()
+    elif(isinstance(value, date)):
+        tag, text = DATE, value.isoformat()
+    elif(isinstance(value, time)):
+        tag, text = TIME, value.isoformat()
+    else:
+        # Texts, and any other value as its text
+        tag, text = STRING, str(value)
+
+    index = stringIndex.get(text)
+    if(index is None):
+        index = stringIndex[text] = len(strings)
+        strings.append(text)
+    return tag, index
+
+
+def writeSheet(f, sheet):
+    """
+    Writes the columns and string table of supplied worksheet at the current
+    file position and returns its directory entry.
+
+    """
+
+    maxRow = sheet.max_row
+    maxColumn = sheet.max_column
+    rows = list(sheet.iter_rows(min_row=1, max_row=maxRow, min_col=1,
+                                max_col=maxColumn, values_only=True))
+
+    strings = []
+    stringIndex = {}
+    columnOffsets = []
+    for column in range(maxColumn):
+        tags = bytearray(maxRow)
+        slots = array('q', bytes(8 * maxRow))
+        for rowNumber, row in enumerate(rows):
+            tags[rowNumber], slots[rowNumber] = encodeCell(
+                row[column], strings, stringIndex)
+
+        # Tags, padded so slots stay 8-byte aligned
+        columnOffsets.append(f.tell())
+        f.write(tags)
+        f.write(bytes(-maxRow % 8))
+        f.write(slots.tobytes())
+
+    # String table: offsets of every string (plus the end) and the UTF-8 blob
+    encoded = [text.encode('utf-8') for text in strings]
+    offsets = array('q', [0])
+    for text in encoded:
+        offsets.append(offsets[-1] + len(text))
+    stringOffset = f.tell()
+    f.write(offsets.tobytes())
+    f.write(b''.join(encoded))
+    f.write(bytes(-f.tell() % 8))
+
+    return {"MAX_ROW": maxRow,
+            "MAX_COLUMN": maxColumn,
+            # Lengths the scripts use to bound their header scan
+            "ROW_DIMENSIONS": len(sheet.row_dimensions),
+            "COLUMN_DIMENSIONS": len(sheet.column_dimensions),
+            "COLUMNS": columnOffsets,
+            "STRINGS": stringOffset,
+            "STRING_COUNT": len(strings)}
+
+
+def defaultSheetNames(sheetNames):
+    """
+    Returns those of supplied workbook sheet names that match the template
+    schemas of the snapshot extractors, in workbook order.
+
+    """
+
+    registries = [SchemaRegistry(extractorName) for extractorName in SNAPSHOT_EXTRACTORS]
+    return [name for name in sheetNames
+            if any(registry.matchesSheet(name) for registry in registries)]
+
+
+def compileSnapshot(path, sheetNames=None, outputPath=None, allSheets=False):
+    """
+    Parses supplied workbook once and writes the snapshot of its template
+    sheets (every sheet matching a known template by default, every sheet of
+    the workbook with "allSheets" set).
+    Formulas without cached results are evaluated first. The file is replaced
+    atomically, so concurrent readers never see a partial snapshot. Returns
+    the snapshot path.
+
+    """
+
+    outputPath = outputPath or snapshotPath(path)
+    sourceHash = fileHash(path)
+    wb = load_workbook(filename=path, data_only=True)
+    if(allSheets):
+        sheetNames = wb.sheetnames
+    sheetNames = [name for name in sheetNames or defaultSheetNames(wb.sheetnames)
+                  if name in wb.sheetnames]
+    formulaWb = loadFormulaWorkbook(path) if hasUncachedFormulas(path, sheetNames) else None
+
+    directory = {"VERSION": SNAPSHOT_VERSION,
+                 "SOURCE_HASH": sourceHash,
+                 "SOURCE_SHEETS": wb.sheetnames,
+                 "SHEETS": {}}
+
+    tempPath = "{}.{}.tmp".format(outputPath, os.getpid())
+    try:
+        with open(tempPath, 'wb') as f:
+            f.write(HEADER.pack(SNAPSHOT_MAGIC, 0))
+            for name in sheetNames:
+                if(formulaWb is not None):
+                    FormulaEvaluator(wb[name], formulaWb[name]).evaluateAll()
+                directory["SHEETS"][name] = writeSheet(f, wb[name])
+
+            directoryOffset = f.tell()
+            f.write(json.dumps(directory).encode('utf-8'))
+            f.seek(0)
+            f.write(HEADER.pack(SNAPSHOT_MAGIC, directoryOffset))
+        os.replace(tempPath, outputPath)
+    except BaseException:
+        if(os.path.exists(tempPath)):
+            os.remove(tempPath)
+        raise
+
+    return outputPath
+
+
+def loadSnapshot(path, allSheets=False):
+    """
+    Returns the snapshot of supplied workbook, compiling it first if it's
+    missing or was compiled from a different version of the workbook. With
+    "allSheets" set, a snapshot missing any sheet of the workbook is compiled
+    again with all of them.
+
+    """
+
+    outputPath = snapshotPath(path)
+    sourceHash = fileHash(path)
+
+    if(os.path.exists(outputPath)):
+        try:
+            snapshot = SnapshotWorkbook(outputPath)
+            if(snapshot.sourceHash == sourceHash and (snapshot.holdsAllSheets or not allSheets)):
+                return snapshot
+            snapshot.close()
+        # Unreadable snapshots are simply compiled again
+        except ValueError:
+            pass
+
+    compileSnapshot(path, outputPath=outputPath, allSheets=allSheets)
+    return SnapshotWorkbook(outputPath)
+
+
+class SnapshotWorkbook:
+    """
+    Opened snapshot, exposing its sheets like an openpyxl workbook
+    (sheetnames, workbook[sheetName]). Paths are memory-mapped, buffers and
+    bytes are read directly.
+
+    """
+
+    data = None
+    directory = {}
+    sourceHash = None
+
+    def __init__(self, source):
+        if(isinstance(source, str)):
+            with open(source, 'rb') as f:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        elif(isinstance(source, (bytes, bytearray))):
+            self.data = bytes(source)
+        else:
+            source.seek(0)
+            self.data = source.read()
+
+        if(len(self.data) < HEADER.size):
+            raise ValueError('Not a snapshot file')
+        magic, directoryOffset = HEADER.unpack_from(self.data, 0)
+        if(magic != SNAPSHOT_MAGIC or directoryOffset == 0):
+            raise ValueError('Not a snapshot file')
+
+        self.directory = json.loads(bytes(self.data[directoryOffset:]))
+        if(self.directory.get("VERSION") != SNAPSHOT_VERSION):
+            raise ValueError('Unsupported snapshot version')
+        self.sourceHash = self.directory["SOURCE_HASH"]
+
+    @property
+    def sheetnames(self):
+        return list(self.directory["SHEETS"])
+
+    @property
+    def holdsAllSheets(self):
+        """
+        Checks if every sheet of the source workbook was compiled. Snapshots
+        compiled before the workbook's sheets were listed are never complete.
+
+        """
+
+        sourceSheets = self.directory.get("SOURCE_SHEETS")
+        return sourceSheets is not None and all(name in self.directory["SHEETS"] for name in sourceSheets)
+
+    def __getitem__(self, sheetName):
+        info = self.directory["SHEETS"].get(sheetName)
+        if(info is None):
+            # Same message as openpyxl, the scripts report it as a missing sheet
+            raise KeyError("Worksheet {0} does not exist.".format(sheetName))
+        return SnapshotSheet(self, info)
+
+    def close(self):
+        if(isinstance(self.data, mmap.mmap)):
+            self.data.close()
+
+
+class SnapshotSheet:
+    """
+    Sheet of a snapshot, exposing the subset of the openpyxl worksheet interface
+    the scripts use, like "CsvSheet" does.
+
+    """
+
+    workbook = None
+    max_row = 0
+    max_column = 0
+
+    def __init__(self, workbook, info):
+        self.workbook = workbook
+        self.columnOffsets = info["COLUMNS"]
+        self.max_row = info["MAX_ROW"]
+        self.max_column = info["MAX_COLUMN"]
+
+        # Only the lengths of these are used by the scripts
+        self.row_dimensions = range(info["ROW_DIMENSIONS"])
+        self.column_dimensions = range(info["COLUMN_DIMENSIONS"])
+
+        # String table, decoded once
+        data = workbook.data
+        count = info["STRING_COUNT"]
+        offsets = memoryview(data)[info["STRINGS"]:info["STRINGS"] + 8 * (count + 1)].cast('q')
+        blobStart = info["STRINGS"] + 8 * (count + 1)
+        self.strings = [data[blobStart + offsets[i]:blobStart + offsets[i + 1]].decode('utf-8')
+                        for i in range(count)]
+
+    def readColumn(self, column, start, stop):
+        """
+        Decodes the values of supplied 0-based column for 0-based rows start to
+        stop (exclusive), straight from the mapped file.
+
+        """
+
+        tagOffset = self.columnOffsets[column]
+        slotOffset = tagOffset + self.max_row + (-self.max_row % 8)
+        view = memoryview(self.workbook.data)
+        tags = view[tagOffset + start:tagOffset + stop]
+        slots = view[slotOffset + 8 * start:slotOffset + 8 * stop]
+        integers = slots.cast('q')
+        floats = slots.cast('d')
+
+        values = []
+        for index, tag in enumerate(tags):
+            if(tag == EMPTY):
+                values.append(None)
+            elif(tag == STRING):
+                values.append(self.strings[integers[index]])
+            elif(tag == INTEGER):
+                values.append(integers[index])
+            elif(tag == FLOAT):
+                values.append(floats[index])
+            elif(tag == BOOLEAN):
+                values.append(integers[index] != 0)
+            else:
+                values.append(TEXT_TYPES[tag](self.strings[integers[index]]))
+        return values
+
+    def iter_rows(self, min_row=1, max_row=None, min_col=1, max_col=None, values_only=False):
+        """
+        Streams rows in the shape openpyxl's Worksheet.iter_rows returns them.
+        Row and column numbers are 1-based and inclusive.
+
+        """
+
+        # Like openpyxl, bounds of 0 (e.g. empty dimension lengths) are unbounded
+        min_row = min_row or 1
+        min_col = min_col or 1
+        max_row = max_row or self.max_row
+        max_col = max_col or self.max_column
+        width = max_col - min_col + 1
+        storedColumns = range(min_col - 1, min(max_col, self.max_column))
+        padding = [None] * (width - len(storedColumns))
+
+        # Decode the stored rows block by block, column by column
+        start = min_row - 1
+        stop = min(max_row, self.max_row)
+        while(start < stop):
+            blockStop = min(start + BLOCK_ROWS, stop)
+            columns = [self.readColumn(column, start, blockStop)
+                       for column in storedColumns]
+            columns.extend([[None] * (blockStop - start)] * len(padding))
+            for row in zip(*columns):
+                yield row if values_only else tuple(CsvCell(value) for value in row)
+            start = blockStop
+
+        # openpyxl yields empty rows for rows past the end of the sheet
+        for _ in range(max(min_row, self.max_row + 1), max_row + 1):
+            row = (None,) * width
+            yield row if values_only else tuple(CsvCell(value) for value in row)
+
+    def __getitem__(self, rowNumber):
+        """
+        Returns cells of supplied 1-based row number, like sheet[rowNumber].
+
+        """
+
+        return next(self.iter_rows(min_row=rowNumber, max_row=rowNumber))
+
+
+def parseArguments(argv):
+    """
+    Parses command line arguments of the script.
+
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Compiles the template sheets of an estimate workbook into a binary snapshot.')
+    parser.add_argument('path', help='path to the .xlsx or .xlsm estimate file')
+    parser.add_argument('--output', help='snapshot path (default: the workbook path + .snapshot)')
+    parser.add_argument('--sheet', action='append', dest='sheets',
+                        help='sheet to compile (may be repeated, default: all known template sheets)')
+    parser.add_argument('--all-sheets', action='store_true',
+                        help='compile every sheet of the workbook, needed to extract all sheets from the snapshot')
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parseArguments(sys.argv[1:])
+    print(compileSnapshot(args.path, sheetNames=args.sheets, outputPath=args.output,
+                          allSheets=args.all_sheets))
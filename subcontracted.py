@@ -1,11 +1,31 @@
 from openpyxl import load_workbook, Workbook
+from operator import itemgetter
 import pandas as pd
 import numpy as np
+import argparse
 import sys
 import re
+import contextlib
 import copy
 import json
-from string import ascii_uppercase
+from zipfile import BadZipFile
+
+from currency import parseAmount, roundToScale, centsToNumber
+from costCatalog import CostCatalog
+from errorLocations import cellLocation, compressErrorLocations
+from formulaEvaluator import FormulaEvaluator, hasUncachedFormulas, loadFormulaWorkbook
+from headerLayouts import HeaderLayoutRegistry
+from inputAdapters import CsvSheet, DELIMITERS, INPUT_FORMATS, readSource, detectFormat
+from multiSheet import PROBE_ROWS, discoverSheets, extractSheets, mergeSheets, readSheetRows
+from memoryProfile import MemoryProfiler
+from outputEncoding import OUTPUT_FORMATS, importEncoder, writeDocument
+from progress import ProgressReporter, writeToStderr
+from snapshots import INCOMPLETE_SNAPSHOT_ERROR, SnapshotWorkbook, loadSnapshot
+from templateSchemas import SchemaRegistry
+
+
+# Rows scanned for the header in preview mode, where sheets are read lazily
+PREVIEW_HEADER_ROWS = 200
 
 
 class CleanUpML:
@@ -33,27 +53,148 @@ class CleanUpML:
         "SUBTRADE": 0,
     }
 
+    # Once usable columns are known, rows are read in the narrowest column window
+    # holding them and projected to compact tuples of only the usable cells.
+    # "rowColumns" gives the position of each usable column inside those tuples
+    minColumn = 1
+    maxColumn = 1
+    rowColumns = {}
+    rowGetter = None
+
     masterError = {"ERROR": ""}
 
     # path = 'C:\\Users\\zarnowm\\Documents\\GitHub\\subtradesConverter\\TestA1.xlsm'
-    path = sys.argv[1]
-
-    def __init__(self):
-        pass
+    path = None
+
+    # Number of data errors after which scanning stops, 0 scans the whole sheet
+    errorBudget = 0
+
+    # Known header layouts are reused from the registry file at "layoutsPath"
+    # (default registry file if None) unless "layoutCache" is False
+    layoutCache = True
+    layoutsPath = None
+
+    # Format of the input, one of "INPUT_FORMATS", detected from the path or
+    # content if None
+    inputFormat = None
+
+    # Errors of one field in adjacent cells of a column are reported as a range
+    errorRanges = False
+
+    # Reporter receiving progress events, None if progress isn't reported
+    progress = None
+
+    # Read workbooks through their compiled snapshot
+    snapshot = False
+
+    # Evaluate formulas whose cached results are missing, the workbook source
+    # checked for them and the workbook holding them, loaded on first use
+    evaluateFormulas = True
+    formulaSource = None
+    formulaWorkbook = None
+
+    # Cost-code catalog CSV the codes are checked against, None skips the check
+    catalogPath = None
+    catalog = None
+
+    # Encoding of the printed document, one of "OUTPUT_FORMATS"
+    outputFormat = "json"
+
+    # Read the workbook lazily (preview mode) and the workbook read that way
+    lazyLoad = False
+    workbook = None
+
+    # Memory profile report file, None if the run isn't profiled, and the profiler
+    memoryProfilePath = None
+    profiler = None
+
+    # Extract every template sheet of the workbook, and the names of those found
+    allSheets = False
+    sheetNames = []
+
+    # Known template schemas and the one detected for the current sheet
+    schemas = None
+    schema = None
+
+    def __init__(self, path=None, errorBudget=0, layoutCache=True, layoutsPath=None,
+                 inputFormat=None, errorRanges=False, progress=None,
+                 schemaPaths=None, snapshot=False, evaluateFormulas=True,
+                 catalogPath=None, outputFormat="json", allSheets=False, memoryProfilePath=None):
+        self.path = path
+        self.errorBudget = errorBudget
+        self.layoutCache = layoutCache
+        self.layoutsPath = layoutsPath
+        self.inputFormat = inputFormat
+        self.errorRanges = errorRanges
+        # Progress callback receives one event dictionary per report
+        self.progress = ProgressReporter(progress) if progress is not None else None
+        self.snapshot = snapshot
+        self.evaluateFormulas = evaluateFormulas
+        self.catalogPath = catalogPath
+        # Binary encodings need their optional package, fail before extracting
+        if(outputFormat != "json"):
+            importEncoder(outputFormat)
+        self.outputFormat = outputFormat
+        self.allSheets = allSheets
+        self.memoryProfilePath = memoryProfilePath
+        # Schema folders searched in addition to the built-in schemas
+        self.schemas = SchemaRegistry('subcontracted', schemaPaths)
+
+        # Give every instance its own copy of the mutable state so several
+        # extractions can run in one process
+        self.cleanData = copy.deepcopy(CleanUpML.cleanData)
+        self.errorData = copy.deepcopy(CleanUpML.errorData)
+        self.usableColumns = copy.deepcopy(CleanUpML.usableColumns)
+        self.masterError = copy.deepcopy(CleanUpML.masterError)
 
     def loadWorkbook(self, path):
         """
-        Loads the Excel workbook and extracts the sheet 'Subtrades'.
-        Sheet name has to be the exact match to 'Subtrades'.
+        Loads the Excel workbook and extracts the sheet 'Subtrades', or the first sheet
+        named by another known template schema. Sheet name has to be an exact match. With
+        "allSheets" set, all template sheets of the workbook are found instead. CSV and TSV
+        exports of the sheet are read directly through "CsvSheet" and compiled
+        snapshots through "SnapshotWorkbook". With "snapshot" set, workbook paths
+        are read through their snapshot, compiled on first use (of every sheet
+        with "allSheets" set, so sheets are also found by header). Path may also
+        be "-" (stdin), workbook bytes or a binary file object.
 
         """
 
         try:
-            wb = load_workbook(filename=path, data_only=True)
-            self.sheet = wb['Subtrades']
+            source = readSource(path)
+            inputFormat = detectFormat(source, self.inputFormat)
+            if(inputFormat in DELIMITERS):
+                self.sheet = CsvSheet(
+                    source, delimiter=DELIMITERS[inputFormat])
+            else:
+                if(inputFormat == "snapshot"):
+                    wb = SnapshotWorkbook(source)
+                    # Sheets found only by their header are missing from snapshots
+                    # of the template sheets
+                    if(self.allSheets and not wb.holdsAllSheets):
+                        raise ValueError(INCOMPLETE_SNAPSHOT_ERROR)
+                elif(self.snapshot and isinstance(source, str)):
+                    wb = loadSnapshot(source, allSheets=self.allSheets)
+                else:
+                    wb = load_workbook(filename=source, data_only=True,
+                                       read_only=self.lazyLoad)
+                self.workbook = wb
+                if(self.allSheets):
+                    self.sheetNames = discoverSheets(wb, self.schemas, self.probeSheet)
+                    sheetNames = self.sheetNames
+                else:
+                    sheetNames = [name for name in self.schemas.sheetNames()
+                                  if name in wb.sheetnames]
+                self.sheet = wb[sheetNames[0] if len(sheetNames) > 0 else 'Subtrades']
+                # Workbooks saved without cached formula results get them evaluated
+                # once the usable columns are known, snapshots were evaluated when compiled
+                if(self.evaluateFormulas and not self.lazyLoad and not isinstance(wb, SnapshotWorkbook)):
+                    self.formulaSource = source
         # Handle any possible exceptions resulting from incorrect file format/structure
         except Exception as e:
-            if("file format" in str(e)):
+            if(str(e) == INCOMPLETE_SNAPSHOT_ERROR):
+                self.masterError['ERROR'] = INCOMPLETE_SNAPSHOT_ERROR
+            elif("file format" in str(e) or isinstance(e, BadZipFile)):
                 self.masterError['ERROR'] = 'You have selected an invalid file. The estimate file must be of type .xlsx or .xlsm'
             elif("Worksheet" in str(e)):
                 self.masterError['ERROR'] = 'The file must have a worksheet titled "Subtrades". Please ensure that worksheet exists in the selected file'
@@ -62,8 +203,7 @@ class CleanUpML:
 
         # If errors occured, print and exit
         if(len(self.masterError['ERROR']) > 0):
-            jsonError = json.dumps(self.masterError)
-            print(jsonError)
+            writeDocument(self.masterError, self.outputFormat)
             exit()
 
     def getHeaderRows(self):
@@ -72,8 +212,14 @@ class CleanUpML:
 
         """
 
-        maxCol = len(self.sheet.column_dimensions)
-        maxRow = len(self.sheet.row_dimensions)
+        if(self.lazyLoad):
+            # Lazily read sheets have no dimension records, only the header area
+            # at the top of the sheet is scanned
+            maxCol = self.sheet.max_column
+            maxRow = min(self.sheet.max_row or PREVIEW_HEADER_ROWS, PREVIEW_HEADER_ROWS)
+        else:
+            maxCol = len(self.sheet.column_dimensions)
+            maxRow = len(self.sheet.row_dimensions)
 
         # Create a map of the excel file in usable format
         text = []
@@ -84,72 +230,138 @@ class CleanUpML:
                                           values_only=True):
             text.append(value)
 
-        # Scan the map for cell containing "STATUS" which indicates first cell of the header
-        for i in text:
-            for j in i:
-                if j == 'STATUS':
-                    # File data starts after two headers
-                    self.startRowIndex = text.index(i) + 2
-                    self.rowIndex = text.index(i) + 2
-
-        # If "STATUS" wasn't found, return an error and exit, otherwise proceed to find required columns
-        if(self.startRowIndex == 0):
-            self.masterError['ERROR'] = 'Column Heading error, please ensure the template header structure is unchanged. Missing header: STATUS'
-            jsonError = json.dumps(self.masterError)
-            print(jsonError)
+        # Find the template schema by its header marker (e.g. "STATUS"), scanning the map once
+        markerRow = self.detectSchema(text)
+
+        # If no marker was found, return an error and exit, otherwise proceed to find required columns
+        if(markerRow is None):
+            self.masterError['ERROR'] = 'Column Heading error, please ensure the template header structure is unchanged. Missing header: ' + \
+                ', '.join(schema.markerName for schema in self.schemas.schemas)
+            writeDocument(self.masterError, self.outputFormat)
             exit()
         else:
+            # File data starts after the header rows
+            self.startRowIndex = markerRow + self.schema.dataOffset
+            self.rowIndex = markerRow + self.schema.dataOffset
             self.findUsableColumns(
-                text[self.startRowIndex - 3], text[self.startRowIndex - 2])
+                self.schemas.headerRows(self.schema, markerRow, text) or [])
+            self.projectColumns()
 
-    def findUsableColumns(self, rawHeaderOne, rawHeaderTwo):
+    def probeSheet(self, sheet):
         """
-        Extracts the column position of all columns required for script's functionality.
+        Checks if the top rows of supplied sheet hold the header of a known
+        template schema with all required columns. Returns True or False.
 
         """
 
-        # Clean header rows of white spaces
-        headerRowOne = self.stripWhiteSpaces(rawHeaderOne)
-        headerRowTwo = self.stripWhiteSpaces(rawHeaderTwo)
+        text = readSheetRows(sheet, min(sheet.max_row or PROBE_ROWS, PROBE_ROWS))
+        schema, markerRow = self.schemas.detect(
+            text, self.stripWhiteSpaces, list(CleanUpML.usableColumns))
+        if(schema is None):
+            return False
+        headerRows = self.schemas.headerRows(schema, markerRow, text)
+        if(headerRows is None):
+            return False
+        _, missing = schema.resolveColumns(
+            [self.stripWhiteSpaces(row) for row in headerRows], list(CleanUpML.usableColumns))
+        return len(missing) == 0
 
-        # CODE COLUMN
-        # Look for "COST" in first header row and "CODE" in second header row
-        if("COST" in headerRowOne and "CODE" in headerRowTwo
-           and headerRowOne.index("COST") == headerRowTwo.index("CODE")):
-            self.usableColumns['CODE'] = headerRowOne.index("COST")
+    def detectSchema(self, text):
+        """
+        Selects the template schema matching supplied sheet map and returns the
+        0-based row of its header marker, or None if no known marker was found.
 
-        # DESCRIPTION COLUMN
-        # Look for "DESCRIPTION" in second header row
-        if("DESCRIPTION" in headerRowTwo):
-            self.usableColumns['DESCRIPTION'] = headerRowTwo.index(
-                "DESCRIPTION")
+        """
 
-        # TOTAL COLUMN
-        # Look for "Final Bid" in first header row
-        if("FinalBid" in headerRowOne):
-            self.usableColumns['TOTAL'] = headerRowOne.index(
-                "FinalBid")
+        self.schema, markerRow = self.schemas.detect(
+            text, self.stripWhiteSpaces, list(CleanUpML.usableColumns))
+        return markerRow
 
-        # SUBTRADE COLUMN
-        # Look for "SUBTRADE" in second header row
-        if("SUBTRADE" in headerRowTwo):
-            self.usableColumns['SUBTRADE'] = headerRowTwo.index(
-                "SUBTRADE")
+    def evaluateMissingFormulas(self):
+        """
+        Fills in usable columns of the data rows whose formulas have no cached
+        results, so they are digested as if the workbook had been recalculated.
+        Only the part of the sheet is scanned for them, the workbook is loaded
+        with its formulas if any usable column has one.
+
+        """
 
-        # If any columns were invalid, add to missingColumnList
-        missingColumnList = []
+        if(self.formulaSource is None or not hasUncachedFormulas(
+                self.formulaSource, [self.sheet.title], self.usableColumns.values())):
+            return
+
+        if(self.formulaWorkbook is None):
+            self.formulaWorkbook = loadFormulaWorkbook(self.formulaSource)
+        evaluator = FormulaEvaluator(self.sheet, self.formulaWorkbook[self.sheet.title])
+        evaluator.evaluateColumns(self.usableColumns.values(), self.startRowIndex)
+
+    def projectColumns(self):
+        """
+        Works out the narrowest column window holding all usable columns and how
+        rows read in that window are projected to compact tuples of usable cells.
+
+        """
+
+        columns = sorted(set(self.usableColumns.values()))
+
+        # Window is 1-based and inclusive, like iter_rows arguments
+        self.minColumn = columns[0] + 1
+        self.maxColumn = columns[-1] + 1
+
+        self.rowColumns = {}
         for key, value in self.usableColumns.items():
-            if(value == 0):
-                missingColumnList.append(key)
+            self.rowColumns[key] = columns.index(value)
+
+        self.rowGetter = itemgetter(*[column - columns[0] for column in columns])
+
+    def iterProjectedRows(self, minRow):
+        """
+        Yields compact tuples of the usable cells of all rows starting at supplied
+        row number.
+
+        """
+
+        return map(self.rowGetter, self.sheet.iter_rows(min_row=minRow,
+                                                        min_col=self.minColumn,
+                                                        max_col=self.maxColumn,
+                                                        values_only=True))
+
+    def findUsableColumns(self, rawHeaderRows):
+        """
+        Extracts the column position of all columns required for script's functionality,
+        following the column rules of the detected template schema.
+
+        """
+
+        # Reuse column positions of a known header layout
+        if(self.layoutCache):
+            registry = HeaderLayoutRegistry(self.layoutsPath)
+            fingerprint = registry.fingerprint(self.schema.name, rawHeaderRows,
+                                               self.schema.definitionHash)
+            knownColumns = registry.lookup(fingerprint)
+            if(knownColumns is not None):
+                self.usableColumns = knownColumns
+                return
+
+        # Clean header rows of white spaces and resolve columns
+        headerRows = [self.stripWhiteSpaces(row) for row in rawHeaderRows]
+        columns, missingColumnList = self.schema.resolveColumns(
+            headerRows, list(CleanUpML.usableColumns))
+        self.usableColumns.update(columns)
+
+        # If any columns were invalid, list them in the error message
         missingColumns = ', '.join(missingColumnList)
 
         # Print error message with missing columns and exit
         if(len(missingColumnList) > 0):
             self.masterError['ERROR'] = 'Column Heading error, please ensure the template header structure is unchanged. Missing headers: ' + missingColumns
-            jsonError = json.dumps(self.masterError)
-            print(jsonError)
+            writeDocument(self.masterError, self.outputFormat)
             exit()
 
+        # Remember newly seen layout
+        if(self.layoutCache):
+            registry.remember(fingerprint, self.usableColumns)
+
     def stripWhiteSpaces(self, input):
         """
         Strips all white spaces from entities inside supplied list
@@ -173,30 +385,112 @@ class CleanUpML:
 
         """
 
+        if(self.progress is not None):
+            self.progress.start(self.sheet.max_row - self.startRowIndex + 1)
+
+        # Digest all workable rows
+        with self.phase("digest"):
+            for _ in self.iterDigestRows():
+                pass
+
+        # Report no more errors than the budget allows
+        if(self.errorBudget > 0):
+            del self.errorData[self.errorBudget + 1:]
+
+        # Collapse errors in adjacent cells of one column into ranges
+        if(self.errorRanges):
+            self.errorData = compressErrorLocations(self.errorData)
+
+        if(self.progress is not None):
+            self.progress.finish(self.rowIndex - self.startRowIndex, 0,
+                                 len(self.errorData) - 1)
+
+        # Write output in the selected format (JSON by default)
+        with self.phase("output"):
+            if(len(self.errorData) > 1):
+                writeDocument(self.errorData, self.outputFormat)
+            else:
+                writeDocument(self.cleanData, self.outputFormat)
+
+        # SAVE OUTPUT IN TXT
+        # f = open('output.txt', 'w')
+        # print(jsonData, file=f)
+
+    def iterDigestRows(self):
+        """
+        Digests workable rows lazily, yielding after each row. Created dictionaries
+        and errors are collected in "cleanData" and "errorData", so callers can stop
+        early without the rest of the sheet being read.
+
+        """
+
         # Iterate over all workable rows
-        for row in self.sheet.iter_rows(min_row=self.startRowIndex, values_only=True):
+        for row in self.iterProjectedRows(self.startRowIndex):
+
+            # Stop scanning once the error budget is used up
+            if(self.errorBudgetReached()):
+                return
+
+            # Report progress, the reporter limits how often
+            if(self.progress is not None and self.rowIndex - self.startRowIndex >= self.progress.nextCheckRow):
+                self.progress.update(self.rowIndex - self.startRowIndex, 0,
+                                     len(self.errorData) - 1)
 
             # Skip empty row
             emptyRow = self.checkIfEmptyRow(row)
-            if(emptyRow):
-                self.rowIndex += 1
-                continue
-            else:
+            if(not emptyRow):
                 self.createSubtradeObj(row)
-                self.rowIndex += 1
+            self.rowIndex += 1
 
-        # Convert output to JSON format and print
-        jsonData = json.dumps(self.cleanData)
-        jsonErrors = json.dumps(self.errorData)
+            yield
 
-        if(len(self.errorData) > 1):
-            print(jsonErrors)
-        else:
-            print(jsonData)
+    def preview(self, limit=50):
+        """
+        Digests rows only until "limit" subtrade lines were created (no limit if
+        None). Returns the preview document with a flag telling if the sheet
+        continues and the row count estimated from the sheet dimensions, e.g.:
+          {"DATA": "PREVIEW", "RECORDS": [...], "ERRORS": [...], "MORE": true, "ESTIMATED ROWS": 300}
 
-        # SAVE OUTPUT IN TXT
-        # f = open('output.txt', 'w')
-        # print(jsonData, file=f)
+        """
+
+        digested = self.iterDigestRows()
+        more = False
+        for _ in digested:
+            if(limit is not None and len(self.cleanData) - 1 >= limit):
+                # Digest one more row to tell if the sheet continues
+                more = next(digested, StopIteration) is not StopIteration
+                break
+        digested.close()
+
+        # Collapse errors in adjacent cells of one column into ranges
+        errors = self.errorData
+        if(self.errorRanges):
+            errors = compressErrorLocations(errors)
+
+        records = self.cleanData[1:] if limit is None else self.cleanData[1:limit + 1]
+        return {"DATA": "PREVIEW",
+                "RECORDS": records,
+                "ERRORS": errors[1:],
+                "MORE": more or len(records) < len(self.cleanData) - 1,
+                "ESTIMATED ROWS": self.estimateRowCount()}
+
+    def estimateRowCount(self):
+        """
+        Returns the number of workable rows estimated from the sheet dimensions,
+        without reading the rows.
+
+        """
+
+        return max(0, (self.sheet.max_row or 0) - self.startRowIndex + 1)
+
+    def errorBudgetReached(self):
+        """
+        Returns True if an error budget is set and the number of data errors
+        found so far has reached it, False otherwise.
+
+        """
+
+        return self.errorBudget > 0 and len(self.errorData) - 1 >= self.errorBudget
 
     def checkIfEmptyRow(self, row):
         """
@@ -205,8 +499,8 @@ class CleanUpML:
 
         """
         # Loop through all usable columns to check for cell values.
-        for i in range(0, 14):
-            if row[i] is not None:
+        for value in row:
+            if value is not None:
                 return False
         return True
 
@@ -218,10 +512,11 @@ class CleanUpML:
         """
 
         # If "Final Bid Amount" for this row is not a valid dollar value,
-        # or zero, return without creating an object
-        validTotal = re.search(
-            r'^[$|(|($]?[+-]?[$]?[0-9]{1,3}(?:,?[0-9]{3})*(?:\.[0-9]*)?[)]?$', str(row[self.usableColumns["TOTAL"]]))
-        if(validTotal is None or row[self.usableColumns["TOTAL"]] == 0):
+        # or zero, return without creating an object. Zero is tested on the
+        # exact value, so totals below half a cent are kept
+        rawTotal = row[self.rowColumns["TOTAL"]]
+        amount = parseAmount(rawTotal)
+        if(amount is None or amount[0] == 0):
             return
         else:
             # VALIDATION
@@ -231,20 +526,26 @@ class CleanUpML:
             if(not validRow):
                 return
 
+            # With an error budget the output is INVALID once any error was found,
+            # so rows are only validated from then on
+            if(self.errorBudget > 0 and len(self.errorData) > 1):
+                return
+
             try:
                 # Create new copy of dictionary template
                 newObj = copy.deepcopy(self.dataTemplate)
 
                 # Convert code to 'dd dd dd' format
-                rawCode = row[self.usableColumns['CODE']
+                rawCode = row[self.rowColumns['CODE']
                               ].replace(" ", "").replace("-", "")  # Change code to [dddddd] format
                 code = rawCode[:2] + " " + rawCode[2:-2] + " " + rawCode[-2:]
 
                 # Assign appropriate dictionary values
                 newObj["CODE"] = code
-                newObj["DESCRIPTION"] = row[self.usableColumns['DESCRIPTION']]
-                newObj["TOTAL"] = row[self.usableColumns['TOTAL']]
-                newObj["SUBTRADE"] = row[self.usableColumns['SUBTRADE']]
+                newObj["DESCRIPTION"] = row[self.rowColumns['DESCRIPTION']]
+                newObj["TOTAL"] = centsToNumber(
+                    roundToScale(amount[0], amount[1], 2), isinstance(rawTotal, int))
+                newObj["SUBTRADE"] = row[self.rowColumns['SUBTRADE']]
 
                 # Add new dictionary to class list
                 self.cleanData.append(newObj)
@@ -262,32 +563,41 @@ class CleanUpML:
 
         # Validate COST CODE
         codeColumn = self.usableColumns['CODE']
-        validCode = self.validateCode(row[codeColumn])
+        validCode = self.validateCode(row[self.rowColumns['CODE']])
         # If invalid, create error dictionary and add to class' errorData
         if(not validCode):
             errorDict = {"FIELD": "CODE",
-                         "LOCATION": "{}{}".format(ascii_uppercase[codeColumn], self.rowIndex)}
+                         "LOCATION": cellLocation(codeColumn, self.rowIndex)}
             self.errorData.append(errorDict)
             valid = False
+        # Check a well-formed code against the catalog, if one was supplied
+        elif(self.catalog is not None):
+            catalogField = self.catalog.checkCode(row[self.rowColumns['CODE']], "Subcontract")
+            if(catalogField is not None):
+                errorDict = {"FIELD": catalogField,
+                             "LOCATION": cellLocation(codeColumn, self.rowIndex)}
+                self.errorData.append(errorDict)
+                valid = False
 
         # Validate DESCRIPTION
         descColumn = self.usableColumns['DESCRIPTION']
-        validDescription = self.validateDescriptionAndSubtrade(row[descColumn])
+        validDescription = self.validateDescriptionAndSubtrade(
+            row[self.rowColumns['DESCRIPTION']])
         # If invalid, create error dictionary and add to class' errorData
         if(not validDescription):
             errorDict = {"FIELD": "DESCRIPTION",
-                         "LOCATION": "{}{}".format(ascii_uppercase[descColumn], self.rowIndex)}
+                         "LOCATION": cellLocation(descColumn, self.rowIndex)}
             self.errorData.append(errorDict)
             valid = False
 
         # Validate SUBTRADE
         subtradeColumn = self.usableColumns['SUBTRADE']
         validSubtrade = self.validateDescriptionAndSubtrade(
-            row[subtradeColumn])
+            row[self.rowColumns['SUBTRADE']])
         # If invalid, create error dictionary and add to class' errorData
         if(not validSubtrade):
             errorDict = {"FIELD": "SUBTRADE",
-                         "LOCATION": "{}{}".format(ascii_uppercase[subtradeColumn], self.rowIndex)}
+                         "LOCATION": cellLocation(subtradeColumn, self.rowIndex)}
             self.errorData.append(errorDict)
             valid = False
 
@@ -323,13 +633,188 @@ class CleanUpML:
             return False
         return True
 
-    def main(self):
+    def loadCatalog(self):
+        """
+        Loads the cost-code catalog, compiling its lookup index if needed.
+
+        """
+
+        if(self.catalogPath is None):
+            return
+
+        try:
+            self.catalog = CostCatalog(self.catalogPath)
+        except (OSError, ValueError) as e:
+            self.masterError['ERROR'] = 'The cost code catalog could not be read: ' + str(e)
+            writeDocument(self.masterError, self.outputFormat)
+            exit()
 
+    def mainPreview(self, limit=50):
+        """
+        Runs the extraction in preview mode and returns the preview document. The
+        workbook is read lazily, only as far as the previewed rows, so the time to
+        preview doesn't depend on the size of the workbook. Formulas without cached
+        results aren't evaluated in preview mode.
+
+        """
+
+        self.lazyLoad = True
+        self.loadCatalog()
         self.loadWorkbook(path=self.path)
-        self.getHeaderRows()
-        self.digestRows()
+        try:
+            self.getHeaderRows()
+            return self.preview(limit)
+        finally:
+            if(self.workbook is not None):
+                self.workbook.close()
+
+    def sheetExtractor(self, sheetName):
+        """
+        Returns an extractor of one template sheet of the loaded workbook, sharing
+        the options of this one. Master errors it reports name the sheet.
+
+        """
+
+        extractor = copy.copy(self)
+        extractor.usableColumns = copy.deepcopy(CleanUpML.usableColumns)
+        extractor.masterError = {"ERROR": "", "SHEET": sheetName}
+        if(len(self.sheetNames) > 0):
+            extractor.sheet = self.workbook[sheetName]
+        return extractor
+
+    def phase(self, name):
+        """
+        Returns the context recording the named phase of the run in the memory
+        profile, or a context doing nothing if the run isn't profiled.
+
+        """
+
+        if(self.profiler is None):
+            return contextlib.nullcontext()
+        return self.profiler.phase(name)
+
+    def mainAllSheets(self):
+        """
+        Extracts every template sheet of the workbook from a single workbook open.
+        Headers are found here, sheets are then digested concurrently and the merged
+        output, tagged with sheet names and holding per-sheet rollups, is printed
+        (see multiSheet.py).
+
+        """
+
+        with self.phase("load"):
+            self.loadCatalog()
+            self.loadWorkbook(path=self.path)
+
+        # CSV and TSV exports hold a single sheet
+        sheetNames = self.sheetNames or self.schemas.sheetNames()[:1]
+
+        jobs = []
+        with self.phase("header"):
+            for sheetName in sheetNames:
+                extractor = self.sheetExtractor(sheetName)
+                extractor.getHeaderRows()
+                extractor.evaluateMissingFormulas()
+                # Sheets extracted next share the workbook loaded with formulas
+                self.formulaWorkbook = extractor.formulaWorkbook
+                attributes = {"usableColumns": extractor.usableColumns,
+                              "startRowIndex": extractor.startRowIndex,
+                              "rowIndex": extractor.rowIndex,
+                              "errorBudget": self.errorBudget,
+                              "catalog": self.catalog}
+                jobs.append((CleanUpML, attributes, readSheetRows(extractor.sheet), sheetName, "TOTAL"))
+
+        with self.phase("digest"):
+            results = extractSheets(jobs, outputFormat=self.outputFormat)
+        with self.phase("output"):
+            writeDocument(mergeSheets(sheetNames, results, "TOTAL",
+                                      self.errorBudget, self.errorRanges), self.outputFormat)
+
+    def main(self):
+
+        # Profile memory per phase, the report is also written if a master error ends the run
+        if(self.memoryProfilePath is not None):
+            self.profiler = MemoryProfiler('subcontracted', self.path, self.memoryProfilePath)
+
+        with self.profiler or contextlib.nullcontext():
+            if(self.allSheets):
+                self.mainAllSheets()
+                return
+
+            with self.phase("load"):
+                self.loadCatalog()
+                self.loadWorkbook(path=self.path)
+            with self.phase("header"):
+                self.getHeaderRows()
+            with self.phase("formulas"):
+                self.evaluateMissingFormulas()
+            self.digestRows()
+
+
+def parseArguments(argv):
+    """
+    Parses command line arguments of the script.
+
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Extracts subtrade cost codes from the "Subtrades" sheet of an estimate file.')
+    parser.add_argument('path', help='path to the .xlsx, .xlsm, .csv, .tsv or .snapshot estimate file, or - to read it from stdin')
+    parser.add_argument('--error-budget', type=int, default=0,
+                        help='stop scanning after this many data errors (default: 0, scan the whole sheet)')
+    parser.add_argument('--layouts', help='header layout registry file (default: headerLayouts.json in the per-user cache directory)')
+    parser.add_argument('--no-layout-cache', action='store_true',
+                        help='always discover columns from the header rows')
+    parser.add_argument('--format', choices=INPUT_FORMATS,
+                        help='input format (default: detected from the file extension or content)')
+    parser.add_argument('--error-ranges', action='store_true',
+                        help='report errors in adjacent cells of a column as one range, e.g. G14:G9000')
+    parser.add_argument('--progress', action='store_true',
+                        help='write progress events to stderr as JSON lines')
+    parser.add_argument('--schemas', action='append',
+                        help='folder with additional template schema files (may be repeated)')
+    parser.add_argument('--no-formula-evaluation', action='store_true',
+                        help="don't evaluate formulas whose cached results are missing")
+    parser.add_argument('--catalog',
+                        help='cost-code catalog .csv file; codes missing from it, or not allowed for '
+                        'the cost type, are reported as errors')
+    parser.add_argument('--memory-profile', metavar='REPORT',
+                        help='write a memory profile of the run (RSS and tracemalloc breakdown per '
+                        'phase, top allocation sites) to this .json file')
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default="json",
+                        help='encoding of the printed document (default: json)')
+    parser.add_argument('--all-sheets', action='store_true',
+                        help='extract every sheet built from the template, found by name or header, '
+                        'concurrently and tag the output with sheet names')
+    parser.add_argument('--preview', type=int, metavar='N',
+                        help='preview mode: print only the first N subtrade lines, reading the sheet '
+                        'only as far as needed')
+    parser.add_argument('--snapshot', action='store_true',
+                        help='read the workbook through its binary snapshot, compiled next to it '
+                        'on first use and whenever the workbook changes')
+    args = parser.parse_args(argv)
+
+    # Binary output formats need their optional package
+    if(args.output_format != "json"):
+        try:
+            importEncoder(args.output_format)
+        except ValueError as e:
+            parser.error(str(e))
+
+    return args
 
 
 if __name__ == "__main__":
-    cleaned = CleanUpML()
-    cleaned.main()
+    args = parseArguments(sys.argv[1:])
+    cleaned = CleanUpML(path=args.path, errorBudget=args.error_budget,
+                        layoutCache=not args.no_layout_cache, layoutsPath=args.layouts,
+                        inputFormat=args.format, errorRanges=args.error_ranges,
+                        progress=writeToStderr if args.progress else None,
+                        schemaPaths=args.schemas, snapshot=args.snapshot,
+                        evaluateFormulas=not args.no_formula_evaluation,
+                        catalogPath=args.catalog, outputFormat=args.output_format,
+                        allSheets=args.all_sheets, memoryProfilePath=args.memory_profile)
+    if(args.preview is not None):
+        writeDocument(cleaned.mainPreview(args.preview), args.output_format)
+    else:
+        cleaned.main()
@@ -0,0 +1,220 @@
+"""
+Declarative schemas of the estimate templates. A schema describes where the
+header of a template starts, which header rows hold the column headings and
+how each column used by an extractor is found in them, e.g.:
+  {"name": "Est. Summary",
+   "extractor": "materialLabour",
+   "sheet": "Est. Summary",
+   "sheetPatterns": ["Est. Summary", "Est. Summary *"],
+                                names of all sheets built from the template,
+                                e.g. one per building (multi-sheet workbooks)
+   "marker": "CS",              cell marking the first header row
+   "markerName": "CS CODE",     header reported if the marker is missing
+   "headerRows": [0, 1],        header rows, relative to the marker row
+   "dataOffset": 3,             first data row, relative to the marker row
+   "columns": [
+     {"name": "QTY", "match": {"2": "QTY."}},
+     {"name": "CODE", "relativeTo": "PHASE", "offset": 1, "match": {"2": "CODE"}},
+     {"name": "UNITS", "relativeTo": "QTY", "offset": 1, "require": {"DESCRIPTION": 2}},
+     ...]}
+
+Column rules:
+- "match" maps header rows (1 = first) to the heading text, whitespace
+  removed. Without "relativeTo", the first cell holding that text is used and
+  with several rows their first matches must be in the same column.
+- "relativeTo"/"offset" place the column relative to an earlier column, the
+  "match" headings then have to be found at that position.
+- "require" lists earlier columns that must sit at the given offsets from the
+  "relativeTo" column.
+
+Schemas are JSON files, built-in ones live in the "schemas" folder next to
+this file. Further folders can be supplied by the extractors or through the
+ESTIMATE_SCHEMAS environment variable (separated by os.pathsep), so a new
+template is onboarded by dropping a schema file into one of them. Schemas in
+later folders replace built-in schemas of the same name.
+
+"""
+
+from fnmatch import fnmatchcase
+import glob
+import hashlib
+import json
+import os
+
+
+# Folder of the built-in schemas
+SCHEMA_DIRECTORY = os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), 'schemas')
+
+
+class TemplateSchema:
+    name = ""
+    extractor = ""
+    sheet = ""
+    sheetPatterns = []
+    marker = ""
+    markerName = ""
+    headerRows = [0, 1]
+    dataOffset = 0
+    columns = []
+    # Hash of the definition, changes whenever the schema file is edited
+    definitionHash = ""
+
+    def __init__(self, definition):
+        self.name = definition["name"]
+        self.definitionHash = hashlib.sha1(
+            json.dumps(definition, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+        self.extractor = definition["extractor"]
+        self.sheet = definition.get("sheet", self.name)
+        self.sheetPatterns = definition.get(
+            "sheetPatterns", [self.sheet, self.sheet + " *"])
+        self.marker = definition["marker"]
+        self.markerName = definition.get("markerName", self.marker)
+        self.headerRows = definition.get("headerRows", [0, 1])
+        self.dataOffset = definition["dataOffset"]
+
+        # Compile rules into tuples with 0-based header row numbers
+        self.columns = []
+        for rule in definition["columns"]:
+            match = [(int(row) - 1, text)
+                     for row, text in rule.get("match", {}).items()]
+            require = list(rule.get("require", {}).items())
+            self.columns.append((rule["name"], match, rule.get("relativeTo"),
+                                 rule.get("offset", 0), require))
+
+    def resolveColumns(self, headerRows, requiredColumns):
+        """
+        Resolves column positions in supplied header rows (whitespace removed).
+        Returns the dictionary of found columns and the list of required columns
+        that weren't found.
+
+        """
+
+        # First position of every heading, one pass per header row
+        firstPositions = []
+        for row in headerRows:
+            positions = {}
+            for position in range(len(row) - 1, -1, -1):
+                positions[row[position]] = position
+            firstPositions.append(positions)
+
+        columns = {}
+        for name, match, relativeTo, offset, require in self.columns:
+            if(relativeTo is not None):
+                base = columns.get(relativeTo)
+                if(base is None):
+                    continue
+                position = base + offset
+                if(any(position >= len(headerRows[row]) or headerRows[row][position] != text
+                       for row, text in match)):
+                    continue
+                if(any(columns.get(other) != base + otherOffset for other, otherOffset in require)):
+                    continue
+            else:
+                positions = set(firstPositions[row].get(text)
+                                for row, text in match)
+                if(None in positions or len(positions) != 1):
+                    continue
+                position = positions.pop()
+
+            columns[name] = position
+
+        missing = [name for name in requiredColumns if name not in columns]
+        return columns, missing
+
+
+class SchemaRegistry:
+    extractor = ""
+    schemas = []
+
+    def __init__(self, extractor, directories=None):
+        self.extractor = extractor
+
+        searched = [SCHEMA_DIRECTORY] + list(directories or [])
+        if(os.environ.get("ESTIMATE_SCHEMAS")):
+            searched.extend(os.environ["ESTIMATE_SCHEMAS"].split(os.pathsep))
+
+        # Schemas by name, later folders replace earlier ones
+        schemas = {}
+        for directory in searched:
+            for path in sorted(glob.glob(os.path.join(directory, '*.json'))):
+                with open(path) as f:
+                    schema = TemplateSchema(json.load(f))
+                if(schema.extractor == extractor):
+                    schemas[schema.name] = schema
+        self.schemas = list(schemas.values())
+
+    def sheetNames(self):
+        """
+        Returns the distinct sheet names of the schemas, in registry order.
+
+        """
+
+        names = []
+        for schema in self.schemas:
+            if(schema.sheet not in names):
+                names.append(schema.sheet)
+        return names
+
+    def matchesSheet(self, sheetName):
+        """
+        Returns True if supplied sheet name matches the sheet name patterns of
+        any schema, False otherwise.
+
+        """
+
+        return any(fnmatchcase(sheetName, pattern)
+                   for schema in self.schemas for pattern in schema.sheetPatterns)
+
+    def detect(self, text, stripWhiteSpaces, requiredColumns):
+        """
+        Finds the schema of supplied sheet rows. All markers are looked for in a
+        single pass, the last row holding a marker is that schema's marker row.
+        If several schemas have their marker present, the first whose columns all
+        resolve is chosen. Returns the schema and its 0-based marker row, or
+        (None, None) if no marker was found.
+
+        """
+
+        markers = {}
+        for schema in self.schemas:
+            markers.setdefault(schema.marker, []).append(schema)
+
+        markerRows = {}
+        for rowNumber, row in enumerate(text):
+            for cell in row:
+                if(cell in markers):
+                    markerRows[cell] = rowNumber
+
+        candidates = [(schema, markerRows[schema.marker])
+                      for schema in self.schemas if schema.marker in markerRows]
+        if(len(candidates) == 0):
+            return None, None
+        if(len(candidates) == 1):
+            return candidates[0]
+
+        for schema, markerRow in candidates:
+            headerRows = self.headerRows(schema, markerRow, text)
+            if(headerRows is None):
+                continue
+            _, missing = schema.resolveColumns(
+                [stripWhiteSpaces(row) for row in headerRows], requiredColumns)
+            if(len(missing) == 0):
+                return schema, markerRow
+
+        # No schema fits completely, report against the first one found
+        return candidates[0]
+
+    def headerRows(self, schema, markerRow, text):
+        """
+        Returns the raw header rows of supplied schema, or None if they lie
+        outside the sheet.
+
+        """
+
+        rows = []
+        for offset in schema.headerRows:
+            if(not 0 <= markerRow + offset < len(text)):
+                return None
+            rows.append(text[markerRow + offset])
+        return rows
@@ -0,0 +1,360 @@
+"""
+Script designed to watch one or more folders for new or changed estimate
+files (.xlsx or .xlsm) and run the extraction scripts on them. A file is
+only picked up once its size and modification time stayed unchanged for
+the debounce period, so partially copied files are never read.
+
+Every extraction is recorded in a checkpoint manifest (the state file), an
+append-only JSON lines file synced to disk after each entry, e.g.:
+  {"FILE": "...", "HASH": "9c1e...", "EXTRACTOR": "materialLabour", "VERSION": "943233e4f6b8954d",
+   "STATUS": "DONE", "OUTPUT": "..."}
+An extraction gets a RUNNING entry when submitted and a DONE, KILLED or
+FAILED entry when it ends, the last entry counts. Files whose content (by
+SHA-256 hash) was extracted (DONE) by the current version of an extractor
+(see extractors.extractorVersion) and whose output still exists are skipped,
+so a restarted run picks up where it stopped: completed work is kept as is,
+killed, failed and interrupted extractions are run again and the manifest
+is appended to.
+
+Extraction runs in worker processes of a "BatchScheduler", which kills
+extractions over the per-file time or memory limit and writes an ERROR
+document for them instead. Files at or above the large file size are run in
+a separate lane so small estimates keep flowing. The output of each
+extractor is written next to the estimate file, e.g.:
+  A6 Estimate.xlsm -> A6 Estimate.materialLabour.json
+or to the sink folder when one is supplied. Every handled file is logged to
+stdout as one JSON line, e.g.:
+  {"FILE": "A6 Estimate.xlsm", "EXTRACTOR": "materialLabour", "STATUS": "DONE", "OUTPUT": "..."}
+
+"""
+
+from collections import deque
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+from batchScheduler import BatchScheduler
+from extractors import EXTRACTORS, extractorVersion
+
+
+class WatchFolder:
+    directories = []
+    sink = None
+    extractorNames = list(EXTRACTORS)
+    workers = 2
+    interval = 2.0
+    debounce = 5.0
+    statePath = None
+    largeWorkers = 1
+    timeLimit = 600.0
+    memoryLimit = 2048
+    largeFileSize = 5
+
+    def __init__(self, directories, sink=None, extractorNames=None, workers=2,
+                 interval=2.0, debounce=5.0, statePath=None, largeWorkers=1,
+                 timeLimit=600.0, memoryLimit=2048, largeFileSize=5):
+        self.directories = directories
+        self.sink = sink
+        self.extractorNames = extractorNames or list(EXTRACTORS)
+        self.workers = workers
+        self.interval = interval
+        self.debounce = debounce
+        self.statePath = statePath or os.path.join(
+            directories[0], '.processed-estimates.jsonl')
+        # Per-file limits (seconds, megabytes) and large lane routing
+        self.largeWorkers = largeWorkers
+        self.timeLimit = timeLimit
+        self.memoryLimit = memoryLimit
+        self.largeFileSize = largeFileSize
+
+        # Last (size, mtime) handled for each file
+        self.handled = {}
+        # Files waiting to settle: path -> ((size, mtime), time first seen unchanged)
+        self.settling = {}
+        # Settled files waiting for a free worker
+        self.ready = deque()
+        # Scheduler running the extractions, created by "run"
+        self.scheduler = None
+        # Content hashes already processed, per extractor
+        self.processed = set()
+        # Current version of each extractor
+        self.versions = {extractorName: extractorVersion(extractorName)
+                         for extractorName in self.extractorNames}
+
+        self.loadState()
+
+    def loadState(self):
+        """
+        Loads (content hash, extractor) pairs of previously completed extractions
+        from the manifest. Extractions of another extractor version, whose output
+        is gone or whose last entry isn't DONE (e.g. KILLED) are run again. Entries
+        of older state files, holding only HASH and EXTRACTOR, count as completed.
+
+        """
+
+        if(not os.path.exists(self.statePath)):
+            return
+
+        # Last entry of every (content hash, extractor)
+        latest = {}
+        line = "\n"
+        with open(self.statePath) as f:
+            for line in f:
+                if(line.strip()):
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Line cut short by a crash
+                        continue
+                    latest[(entry["HASH"], entry["EXTRACTOR"])] = entry
+
+        # Entries appended from now on must not continue a line cut short
+        if(not line.endswith("\n")):
+            with open(self.statePath, 'a') as f:
+                f.write("\n")
+
+        for (contentHash, extractorName), entry in latest.items():
+            if(entry.get("STATUS", "DONE") != "DONE"):
+                continue
+            if(entry.get("VERSION", self.versions.get(extractorName)) != self.versions.get(extractorName)):
+                continue
+            if("OUTPUT" in entry and not os.path.exists(entry["OUTPUT"])):
+                continue
+            self.processed.add((contentHash, extractorName))
+
+    def saveState(self, path, contentHash, extractorName, status, outputPath=None):
+        """
+        Appends an entry to the manifest and syncs it to disk. Completed (DONE)
+        extractions are remembered as processed.
+
+        """
+
+        if(status == "DONE"):
+            self.processed.add((contentHash, extractorName))
+
+        entry = {"FILE": path, "HASH": contentHash, "EXTRACTOR": extractorName,
+                 "VERSION": self.versions[extractorName], "STATUS": status}
+        if(outputPath is not None):
+            entry["OUTPUT"] = outputPath
+        with open(self.statePath, 'a') as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def scan(self):
+        """
+        Stats the estimate files of all watched folders. Changed files are
+        debounced and moved to the ready queue once they stop changing.
+
+        """
+
+        now = time.monotonic()
+        present = set()
+
+        for directory in self.directories:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    # Skip non-estimate files and Excel lock files
+                    if(not entry.name.endswith(('.xlsx', '.xlsm')) or entry.name.startswith('~$')
+                       or not entry.is_file()):
+                        continue
+
+                    stat = entry.stat()
+                    signature = (stat.st_size, stat.st_mtime_ns)
+                    present.add(entry.path)
+
+                    if(self.handled.get(entry.path) == signature):
+                        continue
+
+                    # Restart the debounce period whenever the file changes
+                    settling = self.settling.get(entry.path)
+                    if(settling is None or settling[0] != signature):
+                        self.settling[entry.path] = (signature, now)
+                    elif(now - settling[1] >= self.debounce):
+                        del self.settling[entry.path]
+                        self.handled[entry.path] = signature
+                        self.ready.append(entry.path)
+
+        # Forget files that were removed while settling
+        for path in list(self.settling):
+            if(path not in present):
+                del self.settling[path]
+
+    def dispatch(self):
+        """
+        Submits ready files to their scheduler lane. Files whose lane has no room
+        for the jobs of all extractors stay queued while files of the other lane
+        keep being submitted.
+
+        """
+
+        for _ in range(len(self.ready)):
+            path = self.ready.popleft()
+            lane = self.scheduler.laneOf(path)
+            if(not self.scheduler.accepting(lane, len(self.extractorNames))):
+                self.ready.append(path)
+                continue
+
+            try:
+                contentHash = self.hashFile(path)
+            except OSError:
+                # File vanished or is locked, it will be picked up again if it changes
+                self.handled.pop(path, None)
+                continue
+
+            for extractorName in self.extractorNames:
+                if((contentHash, extractorName) in self.processed):
+                    self.log(path, extractorName, "SKIPPED")
+                    continue
+                self.saveState(path, contentHash, extractorName, "RUNNING")
+                self.scheduler.submit((path, extractorName, contentHash),
+                                      extractorName, path, lane)
+
+    def collect(self, timeout):
+        """
+        Waits up to supplied timeout for running extractions and writes the
+        output of the finished ones. Extractions killed for exceeding a limit
+        get their ERROR document written as output.
+
+        """
+
+        for (path, extractorName, contentHash), status, output in self.scheduler.poll(timeout):
+            if(status == "FAILED"):
+                self.saveState(path, contentHash, extractorName, "FAILED")
+                self.log(path, extractorName, "FAILED",
+                         error=json.loads(output)["ERROR"])
+                continue
+
+            outputPath = self.writeOutput(
+                path, extractorName, contentHash, output)
+            self.saveState(path, contentHash, extractorName, status, outputPath)
+            if(status == "KILLED"):
+                self.log(path, extractorName, "KILLED", output=outputPath,
+                         error=json.loads(output)["ERROR"])
+            else:
+                self.log(path, extractorName, "DONE", output=outputPath)
+
+    def writeOutput(self, path, extractorName, contentHash, output):
+        """
+        Writes extractor output next to the estimate file, or to the sink folder.
+        Output is written to a temporary file first so readers never see partial
+        results. Returns the output path.
+
+        """
+
+        stem = os.path.splitext(os.path.basename(path))[0]
+        if(self.sink is None):
+            outputPath = os.path.join(os.path.dirname(path),
+                                      "{}.{}.json".format(stem, extractorName))
+        else:
+            # Hash prefix keeps same named files from different folders apart
+            outputPath = os.path.join(self.sink,
+                                      "{}.{}.{}.json".format(stem, contentHash[:12], extractorName))
+
+        tempPath = outputPath + '.tmp'
+        with open(tempPath, 'w') as f:
+            f.write(output)
+        os.replace(tempPath, outputPath)
+
+        return outputPath
+
+    def hashFile(self, path):
+        """
+        Returns the SHA-256 hex digest of supplied file's content.
+
+        """
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def log(self, path, extractorName, status, **details):
+        """
+        Prints one JSON line describing how a file was handled.
+
+        """
+
+        entry = {"FILE": path, "EXTRACTOR": extractorName, "STATUS": status}
+        for key, value in details.items():
+            entry[key.upper()] = value
+        print(json.dumps(entry), flush=True)
+
+    def run(self, once=False):
+        """
+        Watches the folders until interrupted. With "once", files present at start
+        are processed without debouncing and the function returns when done.
+
+        """
+
+        if(once):
+            self.debounce = 0
+
+        self.scheduler = BatchScheduler(workers=self.workers, largeWorkers=self.largeWorkers,
+                                        timeLimit=self.timeLimit, memoryLimit=self.memoryLimit,
+                                        largeFileSize=self.largeFileSize)
+        try:
+            while True:
+                self.scan()
+                if(once):
+                    # Files are seen once to record them and once more to settle
+                    self.scan()
+                self.dispatch()
+
+                if(once and len(self.ready) == 0 and self.scheduler.pending() == 0):
+                    return
+
+                self.collect(self.interval if not once else 0.1)
+        finally:
+            self.scheduler.shutdown()
+
+
+def parseArguments(argv):
+    """
+    Parses command line arguments of the script.
+
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Watches folders for estimate files and runs the extraction scripts on them.')
+    parser.add_argument('directories', nargs='+', help='folders to watch')
+    parser.add_argument('--sink', help='folder to write outputs to (default: next to each estimate file)')
+    parser.add_argument('--extractors', nargs='+', choices=list(EXTRACTORS), default=list(EXTRACTORS),
+                        help='extractors to run on each file (default: all)')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='number of worker processes for small files (default: 2)')
+    parser.add_argument('--large-workers', type=int, default=1,
+                        help='number of worker processes for large files (default: 1)')
+    parser.add_argument('--large-file-size', type=float, default=5,
+                        help='size in MB from which files run in the large file lane (default: 5)')
+    parser.add_argument('--time-limit', type=float, default=600,
+                        help='seconds an extraction may run before it is killed (default: 600, 0 for no limit)')
+    parser.add_argument('--memory-limit', type=float, default=2048,
+                        help='resident memory in MB an extraction may use before it is killed '
+                        '(default: 2048, 0 for no limit)')
+    parser.add_argument('--interval', type=float, default=2.0,
+                        help='seconds between folder scans (default: 2)')
+    parser.add_argument('--debounce', type=float, default=5.0,
+                        help='seconds a file must stay unchanged before it is processed (default: 5)')
+    parser.add_argument('--state', help='checkpoint manifest recording every extraction, a restarted '
+                        'run skips completed ones (default: .processed-estimates.jsonl in the first folder)')
+    parser.add_argument('--once', action='store_true',
+                        help='process the files currently present and exit')
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parseArguments(sys.argv[1:])
+    watcher = WatchFolder(args.directories, sink=args.sink, extractorNames=args.extractors,
+                          workers=args.workers, interval=args.interval, debounce=args.debounce,
+                          statePath=args.state, largeWorkers=args.large_workers,
+                          timeLimit=args.time_limit, memoryLimit=args.memory_limit,
+                          largeFileSize=args.large_file_size)
+    try:
+        watcher.run(once=args.once)
+    except KeyboardInterrupt:
+        pass